@@ -1,5 +1,393 @@
+import argparse
+import gc
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+from wsgiref.util import setup_testing_defaults
+
+LISTEN_FD_ENV = 'SKYPHARMA_LISTEN_FD'
+WARM_PATHS = ['/', '/medicines/']
+STOP_TIMEOUT = 30
+# After a failed catalogue publish (say, the database is down), wait this long.
+CATALOGUE_RETRY = 10
+# Workers are single-threaded, so a client that stops sending (or reading)
+# holds one for at most this long.
+REQUEST_TIMEOUT = 30
+
+
+def log(message):
+    print(f'[{os.getpid()}] {message}', file=sys.stderr, flush=True)
+
+
+def load_application():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'skypharma_project.settings')
+    from django.core.wsgi import get_wsgi_application
+    return get_wsgi_application()
+
+
+def report_checks():
+    # Deployment problems only visible with several workers (per-process
+    # caches) are logged here, since nobody runs `manage.py check` under us.
+    from django.core import checks
+
+    for message in checks.run_checks():
+        if message.level >= checks.WARNING:
+            log(f'check: {message}')
+
+
+def publish_catalogue():
+    # Published before forking so every worker maps the same fresh catalogue.
+    from django.db import connections
+    from pharmacy import catalogue
+
+    if not catalogue.enabled():
+        return
+    try:
+        snapshot = catalogue.publish()
+        log(f"catalogue snapshot v{snapshot['version']}: {snapshot['medicines']} medicines, "
+            f"{snapshot['bytes'] // 1024} KiB")
+    except Exception as error:
+        log(f'could not publish the catalogue snapshot: {error}')
+    connections.close_all()
+
+
+def warm(application):
+    from django.db import connections
+    from django.template import engines
+    from django.urls import get_resolver
+
+    get_resolver().url_patterns
+    get_resolver()._populate()
+
+    for engine in engines.all():
+        for directory in getattr(engine, 'template_dirs', []):
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    if name.endswith('.html'):
+                        try:
+                            engine.get_template(os.path.relpath(os.path.join(root, name), directory))
+                        except Exception as error:
+                            log(f'warm: could not load template {name}: {error}')
+
+    for path in WARM_PATHS:
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET'}
+        setup_testing_defaults(environ)
+        try:
+            response = application(environ, lambda status, headers, exc_info=None: None)
+            for _ in response:
+                pass
+            if hasattr(response, 'close'):
+                response.close()
+        except Exception as error:
+            log(f'warm: request to {path} failed: {error}')
+
+    # Database connections must never be shared between forked workers.
+    connections.close_all()
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class Worker:
+    def __init__(self, sock, application, max_requests, access_log, timeout=REQUEST_TIMEOUT):
+        self.server = WSGIServer(sock.getsockname()[:2], QuietHandler if not access_log else WSGIRequestHandler,
+                                 bind_and_activate=False)
+        self.server.socket.close()
+        self.server.socket = sock
+        self.server.server_name = socket.getfqdn(sock.getsockname()[0])
+        self.server.server_port = sock.getsockname()[1]
+        self.server.setup_environ()
+        self.server.set_app(application)
+        self.server.timeout = 1.0
+        self.max_requests = max_requests
+        self.request_timeout = timeout
+        self.stopping = False
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        handled = 0
+        while not self.stopping:
+            selector = selectors.DefaultSelector()
+            selector.register(self.server.socket, selectors.EVENT_READ)
+            ready = selector.select(self.server.timeout)
+            selector.close()
+            if not ready or self.stopping:
+                continue
+            try:
+                request, address = self.server.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                continue
+            request.settimeout(self.request_timeout)
+            try:
+                self.server.finish_request(request, address)
+            except TimeoutError:
+                log(f'dropped {address[0]}: no progress for {self.request_timeout}s')
+            except Exception:
+                self.server.handle_error(request, address)
+            finally:
+                self.server.shutdown_request(request)
+            handled += 1
+            if self.max_requests and handled >= self.max_requests:
+                log(f'worker recycling after {handled} requests')
+                break
+
+
+class Arbiter:
+    def __init__(self, options):
+        self.options = options
+        self.workers = {}
+        self.running = True
+        self.reloading = False
+        self.catalogue_retry_at = 0.0
+
+    def listen(self):
+        inherited = os.environ.pop(LISTEN_FD_ENV, None)
+        if inherited:
+            sock = socket.socket(fileno=int(inherited))
+        else:
+            host, _, port = self.options.bind.rpartition(':')
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host or '0.0.0.0', int(port)))
+            sock.listen(self.options.backlog)
+        sock.setblocking(False)
+        return sock
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            log(f'worker {pid} started')
+            return
+        try:
+            Worker(self.sock, self.application, self.options.max_requests, self.options.access_log,
+                   self.options.timeout).run()
+        except Exception as error:
+            log(f'worker crashed: {error}')
+            os._exit(1)
+        os._exit(0)
+
+    def handle_stop(self, signum, frame):
+        self.running = False
+
+    def handle_reload(self, signum, frame):
+        self.reloading = True
+
+    def stop_workers(self):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.workers.pop(pid, None)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            os.kill(pid, signal.SIGKILL)
+        self.reap()
+
+    def reap(self):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.workers.clear()
+                return
+            if not pid:
+                return
+            self.workers.pop(pid, None)
+            self.retire_metrics(pid)
+
+    def retire_metrics(self, pid):
+        from pharmacy import metrics
+
+        try:
+            metrics.mark_dead(pid)
+        except OSError as error:
+            log(f'could not archive metrics of worker {pid}: {error}')
+
+    def refresh_catalogue(self):
+        # The only place the snapshot is republished while serving: workers
+        # just mark it stale, so there is one publisher however many workers
+        # there are, and none of them is lost when a worker is recycled.
+        from django.db import connections
+        from pharmacy import catalogue
+
+        if not catalogue.enabled() or time.monotonic() < self.catalogue_retry_at:
+            return
+        try:
+            snapshot = catalogue.publish_if_stale()
+            if snapshot:
+                log(f"catalogue snapshot v{snapshot['version']}: {snapshot['medicines']} medicines")
+        except Exception as error:
+            log(f'could not publish the catalogue snapshot: {error}')
+            self.catalogue_retry_at = time.monotonic() + CATALOGUE_RETRY
+        finally:
+            # Never hand a database connection to the next forked worker.
+            connections.close_all()
+
+    def reexec(self):
+        # Graceful reload: let workers finish what they are serving, then
+        # replace this process with a fresh interpreter that inherits the
+        # listening socket, so queued connections are never refused.
+        log('reloading')
+        self.stop_workers()
+        self.sock.set_inheritable(True)
+        os.environ[LISTEN_FD_ENV] = str(self.sock.fileno())
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def run(self):
+        cold_start = LISTEN_FD_ENV not in os.environ
+        started = time.perf_counter()
+        self.application = load_application()
+        loaded = time.perf_counter()
+        if cold_start:
+            # Workers share one metrics directory; start counting from zero
+            # unless this is a SIGHUP reload of an already running server.
+            from pharmacy import metrics
+            metrics.clear_directory()
+        report_checks()
+        publish_catalogue()
+        if not self.options.no_warm:
+            warm(self.application)
+        warmed = time.perf_counter()
+        self.sock = self.listen()
+
+        # Everything imported and warmed so far is shared copy-on-write with
+        # the workers; freezing keeps the collector from touching those pages.
+        gc.collect()
+        gc.freeze()
+        log(f'ready: import={(loaded - started) * 1000:.0f}ms warm={(warmed - loaded) * 1000:.0f}ms '
+            f'listening on {self.sock.getsockname()[0]}:{self.sock.getsockname()[1]}')
+
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        while self.running:
+            if self.reloading:
+                self.reexec()
+            self.reap()
+            self.refresh_catalogue()
+            while len(self.workers) < self.options.workers and self.running:
+                self.spawn()
+            time.sleep(0.2)
+        log('shutting down')
+        self.stop_workers()
+
+
+def rss_kib(pid):
+    values = {}
+    for filename, fields in (('status', ('VmRSS',)), ('smaps_rollup', ('Pss', 'Shared_Clean', 'Shared_Dirty'))):
+        try:
+            with open(f'/proc/{pid}/{filename}') as proc:
+                for line in proc:
+                    name, _, rest = line.partition(':')
+                    if name in fields:
+                        values[name] = int(rest.split()[0])
+        except OSError:
+            pass
+    return values
+
+
+def benchmark(options):
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    command = [sys.executable, os.path.abspath(__file__), 'serve', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(options.workers)]
+    if options.no_warm:
+        command.append('--no-warm')
+    started = time.perf_counter()
+    server = subprocess.Popen(command, stderr=subprocess.PIPE, text=True)
+    worker_pids = []
+    try:
+        for line in server.stderr:
+            sys.stderr.write(line)
+            if 'worker' in line and 'started' in line:
+                worker_pids.append(int(line.split('worker ')[1].split()[0]))
+            if len(worker_pids) >= options.workers:
+                break
+
+        first_response = None
+        deadline = time.monotonic() + 60
+        while first_response is None and time.monotonic() < deadline:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=5) as response:
+                    response.read()
+                first_response = time.perf_counter() - started
+            except OSError:
+                time.sleep(0.01)
+
+        latencies = []
+        for _ in range(options.requests):
+            request_started = time.perf_counter()
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/medicines/', timeout=5) as response:
+                response.read()
+            latencies.append(time.perf_counter() - request_started)
+
+        print(f'time to first response: {first_response * 1000:.0f} ms' if first_response
+              else 'no response within 60s')
+        if latencies:
+            latencies.sort()
+            print(f'/medicines/ over {len(latencies)} requests: '
+                  f'first {latencies[0] * 1000:.1f} ms, median {latencies[len(latencies) // 2] * 1000:.1f} ms')
+        master = rss_kib(server.pid)
+        print(f"master {server.pid}: rss={master.get('VmRSS', 0)} KiB pss={master.get('Pss', 0)} KiB")
+        for pid in worker_pids:
+            memory = rss_kib(pid)
+            print(f"worker {pid}: rss={memory.get('VmRSS', 0)} KiB pss={memory.get('Pss', 0)} KiB "
+                  f"shared={memory.get('Shared_Clean', 0) + memory.get('Shared_Dirty', 0)} KiB")
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
 def main():
-    print("Hello from repl-nix-workspace!")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description='Skypharma preforking production server')
+    parser.add_argument('command', nargs='?', default='serve', choices=['serve', 'bench'])
+    parser.add_argument('--bind', default=os.environ.get('BIND', '0.0.0.0:5000'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 2)))
+    parser.add_argument('--max-requests', type=int, default=int(os.environ.get('MAX_REQUESTS', 1000)),
+                        help='Recycle a worker after this many requests (0 disables)')
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--timeout', type=float, default=float(os.environ.get('REQUEST_TIMEOUT', REQUEST_TIMEOUT)),
+                        help='Drop a connection after this many seconds without progress')
+    parser.add_argument('--no-warm', action='store_true', help='Skip warming URLs, templates and pages before forking')
+    parser.add_argument('--access-log', action='store_true')
+    parser.add_argument('--requests', type=int, default=50, help='bench: requests timed after the first response')
+    options = parser.parse_args()
+
+    os.environ['SKYPHARMA_WORKERS'] = str(options.workers)
+    # Keep the templates warm() compiles: with reloading on (the DEBUG
+    # default) every worker would recompile them on every request.
+    os.environ.setdefault('TEMPLATE_RELOAD', '0')
+    os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), f'skypharma-metrics-{os.getuid()}'))
+    os.environ.setdefault('CATALOGUE_DIR', os.path.join(tempfile.gettempdir(), f'skypharma-catalogue-{os.getuid()}'))
+    if options.command == 'bench':
+        benchmark(options)
+    else:
+        Arbiter(options).run()
 
 
 if __name__ == "__main__":
@@ -1,5 +1,55 @@
+from django import forms
 from django.contrib import admin
-from .models import Category, Medicine, Cart, Order, OrderItem, RefillReminder
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils.functional import cached_property
+from .models import (Category, Medicine, Cart, Order, OrderItem, RefillReminder, ArchivedOrder, ArchivedOrderItem,
+                     Promotion)
+from . import bulk
+from .forms import StockFormMixin
+from .analytics import PREFIX_END
+
+# Below this many rows an exact COUNT(*) is cheap enough to keep.
+ESTIMATE_THRESHOLD = 10000
+
+
+# Unfiltered changelists on PostgreSQL take the planner's row estimate instead
+# of counting the whole table; filtered ones (and other databases) still count.
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if connection.vendor == 'postgresql' and query is not None and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                               [self.object_list.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] >= ESTIMATE_THRESHOLD:
+                return row[0]
+        return super().count
+
+
+# Admin search as case-insensitive prefix ranges over indexed keys (like the
+# customer analytics search) instead of LIKE '%term%' scans. Digits also
+# match the primary key.
+class PrefixSearchMixin:
+    prefix_search_keys = {}
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip().lower()
+        if not term:
+            return queryset, False
+        queryset = queryset.alias(**{name: expression for name, expression in self.prefix_search_keys.items()
+                                     if not isinstance(expression, str)})
+        query = Q()
+        for name, expression in self.prefix_search_keys.items():
+            key = expression if isinstance(expression, str) else name
+            query |= Q(**{f'{key}__gte': term, f'{key}__lt': term + PREFIX_END})
+        if term.isdigit():
+            query |= Q(pk=int(term))
+        return queryset.filter(query), False
 
 
 @admin.register(Category)
@@ -8,12 +58,40 @@ class CategoryAdmin(admin.ModelAdmin):
     search_fields = ['name']
 
 
+class MedicineAdminForm(StockFormMixin, forms.ModelForm):
+    class Meta:
+        model = Medicine
+        fields = '__all__'
+
+
 @admin.register(Medicine)
-class MedicineAdmin(admin.ModelAdmin):
-    list_display = ['name', 'category', 'price', 'stock', 'featured', 'requires_prescription']
-    list_filter = ['category', 'featured', 'requires_prescription']
-    search_fields = ['name', 'description']
+class MedicineAdmin(PrefixSearchMixin, admin.ModelAdmin):
+    list_display = ['name', 'category', 'price', 'stock', 'featured', 'requires_prescription', 'striped']
+    list_filter = ['category', 'featured', 'requires_prescription', 'striped']
+    list_select_related = ['category']
+    # Striping is switched on and off with the rebalance_stock command.
+    readonly_fields = ['striped']
+    search_fields = ['name']
+    search_help_text = 'Name starts with, or medicine id'
+    prefix_search_keys = {'name_key': Lower('name')}
     list_editable = ['price', 'stock', 'featured']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    form = MedicineAdminForm
+
+    def get_changelist_form(self, request, **kwargs):
+        kwargs.setdefault('form', MedicineAdminForm)
+        return super().get_changelist_form(request, **kwargs)
+
+
+@admin.register(Promotion)
+class PromotionAdmin(admin.ModelAdmin):
+    list_display = ['name', 'kind', 'value', 'medicine', 'category', 'manufacturer', 'starts_at', 'ends_at',
+                    'is_active']
+    list_filter = ['is_active', 'kind', 'starts_at']
+    list_select_related = ['medicine', 'category']
+    autocomplete_fields = ['medicine', 'category']
+    search_fields = ['name']
 
 
 class OrderItemInline(admin.TabularInline):
@@ -21,24 +99,93 @@ class OrderItemInline(admin.TabularInline):
     extra = 0
     readonly_fields = ['medicine', 'quantity', 'price']
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('medicine')
+
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(PrefixSearchMixin, admin.ModelAdmin):
     list_display = ['id', 'user', 'total_amount', 'status', 'created_at']
+    # Both filters are served by the (status, created_at) and created_at indexes.
     list_filter = ['status', 'created_at']
-    search_fields = ['user__username', 'shipping_address']
-    list_editable = ['status']
+    list_select_related = ['user']
+    search_fields = ['user__username']
+    search_help_text = 'Order number, or customer username/email starts with'
+    prefix_search_keys = {'username': 'user__stats__username_key', 'email': 'user__stats__email_key'}
+    autocomplete_fields = ['user']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # Status only changes through the actions below, which follow the order
+    # state machine and log each change.
+    readonly_fields = ['status', 'version']
     inlines = [OrderItemInline]
+    actions = ['mark_confirmed', 'mark_shipped', 'mark_delivered', 'mark_cancelled']
+
+    def save_model(self, request, obj, form, change):
+        # Only write the fields this form changed: a full save would put back
+        # the status and version it loaded, undoing a concurrent transition.
+        if not change:
+            super().save_model(request, obj, form, change)
+        elif form.changed_data:
+            obj.save(update_fields=[*form.changed_data, 'updated_at'])
+
+    def _set_status(self, request, queryset, status):
+        batches = bulk.apply_order_status(queryset, status, actor=request.user)
+        self.message_user(request, f'{bulk.summarize(batches, "orders")}.')
+
+    @admin.action(description='Mark selected orders as confirmed')
+    def mark_confirmed(self, request, queryset):
+        self._set_status(request, queryset, 'confirmed')
+
+    @admin.action(description='Mark selected orders as shipped')
+    def mark_shipped(self, request, queryset):
+        self._set_status(request, queryset, 'shipped')
+
+    @admin.action(description='Mark selected orders as delivered')
+    def mark_delivered(self, request, queryset):
+        self._set_status(request, queryset, 'delivered')
+
+    @admin.action(description='Mark selected orders as cancelled')
+    def mark_cancelled(self, request, queryset):
+        self._set_status(request, queryset, 'cancelled')
+
+
+class ArchivedOrderItemInline(admin.TabularInline):
+    model = ArchivedOrderItem
+    extra = 0
+    readonly_fields = ['medicine', 'medicine_name', 'quantity', 'price']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('medicine')
+
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(PrefixSearchMixin, admin.ModelAdmin):
+    list_display = ['id', 'user', 'total_amount', 'status', 'created_at', 'archived_at']
+    list_filter = ['status']
+    list_select_related = ['user']
+    search_fields = ['user__username']
+    search_help_text = 'Order number, or customer username/email starts with'
+    prefix_search_keys = OrderAdmin.prefix_search_keys
+    inlines = [ArchivedOrderItemInline]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
     list_display = ['user', 'medicine', 'quantity', 'created_at']
     list_filter = ['created_at']
+    list_select_related = ['user', 'medicine']
+    autocomplete_fields = ['user', 'medicine']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(RefillReminder)
 class RefillReminderAdmin(admin.ModelAdmin):
-    list_display = ['user', 'medicine_name', 'reminder_date', 'is_active']
-    list_filter = ['is_active', 'reminder_date']
+    list_display = ['user', 'medicine_name', 'reminder_date', 'is_active', 'is_automatic', 'interval_days']
+    list_filter = ['is_active', 'is_automatic', 'reminder_date']
+    list_select_related = ['user']
+    autocomplete_fields = ['user', 'medicine']
     search_fields = ['medicine_name', 'user__username']
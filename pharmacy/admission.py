@@ -0,0 +1,184 @@
+import math
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from . import metrics
+from .clientip import client_ip
+
+KEY_PREFIX = 'admission'
+OUTCOMES = ['admitted', 'rejected_user', 'rejected_global', 'rejected_concurrency']
+# Concurrency slots leaked by a killed worker are forgotten once no checkout
+# has started for this long.
+SLOT_TIMEOUT = 60
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status, retry_after, reason):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def _cache():
+    return caches[getattr(settings, 'ADMISSION_CACHE', 'default')]
+
+
+def _limits(name):
+    return getattr(settings, 'ADMISSION_CONTROL', {}).get(name)
+
+
+def _incr(cache, key, timeout=None):
+    # cache.incr is atomic on Redis, Memcached and LocMem; add() only creates
+    # the key if no other worker got there first.
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=timeout)
+        return cache.incr(key)
+
+
+def _count(name, outcome):
+    _incr(_cache(), f'{KEY_PREFIX}:{name}:{outcome}')
+    metrics.ADMISSIONS.labels(name, outcome).inc()
+
+
+class RateLimit:
+    # Sliding-window counter: at most `burst` requests per window of
+    # burst / rate seconds, with the previous window counted in proportion to
+    # how much of it still overlaps. Both windows are plain counters changed
+    # only with incr/decr, so concurrent workers never overwrite each other.
+    def __init__(self, key, rate, burst):
+        self.key = key
+        self.burst = max(1, burst)
+        self.window = self.burst / rate
+        self.taken = None
+
+    def take(self, now=None):
+        now = time.time() if now is None else now
+        index, offset = divmod(now, self.window)
+        cache = _cache()
+        key = f'{self.key}:{int(index)}'
+        count = _incr(cache, key, timeout=math.ceil(2 * self.window) + 1)
+        self.taken = key
+        previous = cache.get(f'{self.key}:{int(index) - 1}', 0)
+        overlap = 1 - offset / self.window
+        excess = count + previous * overlap - self.burst
+        if excess <= 0:
+            return 0
+        # Rejected requests don't use up the allowance.
+        self.refund()
+        until_next = self.window - offset
+        return min(excess / previous * self.window, until_next) if previous else until_next
+
+
+    def refund(self):
+        # Gives back the request counted by the last take().
+        if self.taken is not None:
+            try:
+                _cache().decr(self.taken)
+            except ValueError:
+                pass
+            self.taken = None
+
+
+def client_key(request):
+    # Guests are keyed on their address as the proxy reports it (see
+    # TRUSTED_PROXIES); cookies would let a client reset its own limit.
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    return f'ip:{client_ip(request)}'
+
+
+def admit(name, request):
+    limits = _limits(name)
+    if not limits:
+        return
+    user_bucket = None
+    if limits.get('user_rate'):
+        user_bucket = RateLimit(f'{KEY_PREFIX}:{name}:{client_key(request)}',
+                                limits['user_rate'], limits.get('user_burst', 1))
+        wait = user_bucket.take()
+        if wait:
+            _count(name, 'rejected_user')
+            raise AdmissionRejected(429, wait, 'Too many requests, please slow down.')
+    if limits.get('rate'):
+        bucket = RateLimit(f'{KEY_PREFIX}:{name}:global', limits['rate'], limits.get('burst', 1))
+        wait = bucket.take()
+        if wait:
+            # Turned away by the global limit: the caller's own allowance is
+            # given back, so a busy site doesn't also throttle them later.
+            if user_bucket is not None:
+                user_bucket.refund()
+            _count(name, 'rejected_global')
+            raise AdmissionRejected(503, wait, 'We are very busy right now, please try again shortly.')
+    _count(name, 'admitted')
+
+
+@contextmanager
+def concurrency_slot(name):
+    limits = _limits(name) or {}
+    limit = limits.get('concurrency')
+    if not limit:
+        yield
+        return
+    cache = _cache()
+    key = f'{KEY_PREFIX}:{name}:in_flight'
+    in_flight = _incr(cache, key, timeout=SLOT_TIMEOUT)
+    # Keep the counter alive while checkouts keep arriving, so it cannot
+    # expire under requests that are still running.
+    cache.touch(key, SLOT_TIMEOUT)
+    try:
+        if in_flight > limit:
+            _count(name, 'rejected_concurrency')
+            raise AdmissionRejected(503, limits.get('retry_after', 1),
+                                    'We are very busy right now, please try again shortly.')
+        yield
+    finally:
+        try:
+            # Never below zero: slots taken before an expiry are not counted
+            # any more and must not hand out extra ones when released.
+            if cache.decr(key) < 0:
+                cache.incr(key)
+        except ValueError:
+            pass
+
+
+def rejected_response(rejection):
+    response = HttpResponse(rejection.reason, status=rejection.status, content_type='text/plain')
+    response['Retry-After'] = str(max(1, math.ceil(rejection.retry_after)))
+    return response
+
+
+def admission_control(name):
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            methods = (_limits(name) or {}).get('methods')
+            if not methods or request.method in methods:
+                try:
+                    admit(name, request)
+                except AdmissionRejected as rejection:
+                    return rejected_response(rejection)
+            return view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def admission_stats():
+    cache = _cache()
+    stats = {}
+    for name, limits in getattr(settings, 'ADMISSION_CONTROL', {}).items():
+        keys = [f'{KEY_PREFIX}:{name}:{outcome}' for outcome in OUTCOMES]
+        values = cache.get_many(keys + [f'{KEY_PREFIX}:{name}:in_flight'])
+        stats[name] = {
+            'limits': limits,
+            'in_flight': values.get(f'{KEY_PREFIX}:{name}:in_flight', 0),
+            **{outcome: values.get(key, 0) for outcome, key in zip(OUTCOMES, keys)},
+        }
+    return stats
@@ -0,0 +1,147 @@
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db.models import Count, F, Max, Q, Sum
+
+from .models import ArchivedOrder, CustomerStats, Order, RefillReminder
+
+PAGE_SIZE = 50
+REBUILD_CHUNK = 5000
+PREFIX_END = '\U0010ffff'
+
+SORT_FIELDS = {
+    'username': 'username_key',
+    'orders': 'order_count',
+    'value': 'lifetime_value',
+    'last_order': 'last_order_at',
+    'reminders': 'active_reminders',
+}
+DEFAULT_SORT = '-value'
+
+
+def refresh_customer_stats(user_ids):
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return 0
+    orders = {}
+    for model in (Order, ArchivedOrder):
+        for row in model.objects.filter(user__in=user_ids).order_by().values('user').annotate(
+            order_count=Count('id'),
+            lifetime_value=Sum('total_amount', filter=~Q(status='cancelled')),
+            last_order_at=Max('created_at'),
+        ):
+            merged = orders.setdefault(row['user'], {'order_count': 0, 'lifetime_value': 0, 'last_order_at': None})
+            merged['order_count'] += row['order_count']
+            merged['lifetime_value'] += row['lifetime_value'] or 0
+            if row['last_order_at'] and (not merged['last_order_at'] or row['last_order_at'] > merged['last_order_at']):
+                merged['last_order_at'] = row['last_order_at']
+    reminders = dict(
+        RefillReminder.objects.filter(user__in=user_ids, is_active=True).order_by()
+        .values_list('user').annotate(total=Count('id'))
+    )
+    stats = []
+    for user_id, username, email in User.objects.filter(pk__in=user_ids).values_list('id', 'username', 'email'):
+        order_row = orders.get(user_id, {})
+        stats.append(CustomerStats(
+            user_id=user_id,
+            username_key=username.lower(),
+            email_key=email.lower(),
+            order_count=order_row.get('order_count', 0),
+            lifetime_value=order_row.get('lifetime_value') or 0,
+            last_order_at=order_row.get('last_order_at'),
+            active_reminders=reminders.get(user_id, 0),
+        ))
+    CustomerStats.objects.bulk_create(
+        stats,
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=['username_key', 'email_key', 'order_count', 'lifetime_value',
+                       'last_order_at', 'active_reminders', 'updated_at'],
+    )
+    return len(stats)
+
+
+def rebuild_customer_stats():
+    last_id = 0
+    total = 0
+    while True:
+        ids = list(User.objects.filter(pk__gt=last_id).order_by('pk')
+                   .values_list('pk', flat=True)[:REBUILD_CHUNK])
+        if not ids:
+            return total
+        total += refresh_customer_stats(ids)
+        last_id = ids[-1]
+
+
+def _parse_sort(sort):
+    key = (sort or DEFAULT_SORT).lstrip('-')
+    if key not in SORT_FIELDS:
+        sort, key = DEFAULT_SORT, DEFAULT_SORT.lstrip('-')
+    return sort, SORT_FIELDS[key], sort.startswith('-')
+
+
+def encode_cursor(stats, field):
+    value = getattr(stats, field)
+    if value is None:
+        value = ''
+    elif hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return f'{value}|{stats.pk}'
+
+
+def decode_cursor(cursor, field):
+    if not cursor or '|' not in cursor:
+        return None
+    raw_value, _, raw_pk = cursor.rpartition('|')
+    try:
+        pk = int(raw_pk)
+        value = CustomerStats._meta.get_field(field).to_python(raw_value) if raw_value else None
+    except (ValueError, ValidationError):
+        return None
+    return value, pk
+
+
+def _after(field, descending, value, pk):
+    # Nulls (customers without orders) always sort last, whatever the direction.
+    pk_lookup = 'user__lt' if descending else 'user__gt'
+    if value is None:
+        return Q(**{f'{field}__isnull': True, pk_lookup: pk})
+    value_lookup = f'{field}__lt' if descending else f'{field}__gt'
+    after = Q(**{value_lookup: value}) | Q(**{field: value, pk_lookup: pk})
+    if CustomerStats._meta.get_field(field).null:
+        after |= Q(**{f'{field}__isnull': True})
+    return after
+
+
+def customer_page(sort=None, query='', cursor=None, page_size=PAGE_SIZE):
+    sort, field, descending = _parse_sort(sort)
+    stats = CustomerStats.objects.select_related('user')
+
+    query = query.strip().lower()
+    if query:
+        end = query + PREFIX_END
+        stats = stats.filter(
+            Q(username_key__gte=query, username_key__lt=end)
+            | Q(email_key__gte=query, email_key__lt=end)
+        )
+
+    position = decode_cursor(cursor, field)
+    if position:
+        stats = stats.filter(_after(field, descending, *position))
+
+    if descending:
+        ordering = [F(field).desc(nulls_last=True), '-user']
+    else:
+        ordering = [F(field).asc(nulls_last=True), 'user']
+    rows = list(stats.order_by(*ordering)[:page_size + 1])
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1], field)
+    return {
+        'rows': rows,
+        'sort': sort,
+        'query': query,
+        'next_cursor': next_cursor,
+    }
+
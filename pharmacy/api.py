@@ -0,0 +1,366 @@
+import hashlib
+import json
+from decimal import Decimal
+from functools import wraps
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.http import HttpResponse, HttpResponseNotModified
+from django.views.decorators.http import require_safe
+
+from . import pricing
+from .inventory import striped_total
+from .models import (ArchivedOrder, ArchivedOrderItem, Category, Medicine, Order, OrderItem,
+                     OrderStatusEvent, RefillReminder)
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+MAX_IDS = 200
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _media_url(name):
+    return settings.MEDIA_URL + name if name else None
+
+
+def _money(value):
+    # SQLite hands annotated decimals back without their scale.
+    return Decimal(value).quantize(pricing.CENT)
+
+
+# Each resource maps public field names to .values() lookups, optionally with
+# a function applied to the raw value. Rows never become model instances.
+CATEGORY_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'description': 'description',
+    'image': ('image', _media_url),
+}
+MEDICINE_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'description': 'description',
+    'category': 'category_id',
+    'price': 'price',
+    'effective_price': ('effective_price', _money),
+    'stock': 'stock',
+    'image': ('image', _media_url),
+    'requires_prescription': 'requires_prescription',
+    'dosage': 'dosage',
+    'manufacturer': 'manufacturer',
+    'featured': 'featured',
+    'updated_at': 'updated_at',
+}
+ORDER_FIELDS = {
+    'id': 'id',
+    'status': 'status',
+    'total_amount': 'total_amount',
+    'shipping_address': 'shipping_address',
+    'phone': 'phone',
+    'notes': 'notes',
+    'created_at': 'created_at',
+    'updated_at': 'updated_at',
+}
+ORDER_ITEM_FIELDS = {
+    'id': 'id',
+    'medicine': 'medicine_id',
+    'medicine_name': 'medicine_name',
+    'quantity': 'quantity',
+    'price': 'price',
+}
+ORDER_EVENT_FIELDS = {
+    'status': 'status',
+    'created_at': 'created_at',
+}
+REMINDER_FIELDS = {
+    'id': 'id',
+    'medicine_name': 'medicine_name',
+    'dosage': 'dosage',
+    'reminder_date': 'reminder_date',
+    'notes': 'notes',
+    'is_active': 'is_active',
+    'medicine': 'medicine_id',
+    'is_automatic': 'is_automatic',
+    'interval_days': 'interval_days',
+}
+
+
+def _selected_fields(request, available):
+    requested = request.GET.get('fields')
+    if not requested:
+        return dict(available)
+    names = ['id'] + [name.strip() for name in requested.split(',') if name.strip() and name.strip() != 'id']
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ApiError(f"Unknown field(s): {', '.join(unknown)}. Available: {', '.join(available)}.")
+    return {name: available[name] for name in names}
+
+
+def _values(queryset, fields, *extra, **expressions):
+    lookups = {name: spec[0] if isinstance(spec, tuple) else spec for name, spec in fields.items()}
+    transforms = [(name, spec[1]) for name, spec in fields.items() if isinstance(spec, tuple)]
+    extra = list(extra) + list(expressions)
+    rows = queryset.values(*(set(lookups.values()) | set(extra) - set(expressions)), **expressions)
+    result = []
+    for row in rows:
+        item = {name: row[lookup] for name, lookup in lookups.items()}
+        for name, transform in transforms:
+            item[name] = transform(item[name])
+        for name in extra:
+            item[name] = row[name]
+        result.append(item)
+    return result
+
+
+def _embeds(request, allowed):
+    embeds = [name.strip() for name in request.GET.get('embed', '').split(',') if name.strip()]
+    unknown = [name for name in embeds if name not in allowed]
+    if unknown:
+        raise ApiError(f"Cannot embed: {', '.join(unknown)}. Available: {', '.join(allowed)}.")
+    return embeds
+
+
+def _ids(request):
+    raw = request.GET.get('ids')
+    if raw is None:
+        return None
+    try:
+        ids = [int(value) for value in raw.split(',') if value.strip()]
+    except ValueError:
+        raise ApiError('ids must be a comma-separated list of integers.')
+    if len(ids) > MAX_IDS:
+        raise ApiError(f'At most {MAX_IDS} ids per request.')
+    return ids
+
+
+def _limit(request):
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError('limit must be an integer.')
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def _cursor(request):
+    after = request.GET.get('after')
+    if not after:
+        return None
+    try:
+        return int(after)
+    except ValueError:
+        raise ApiError('Invalid cursor.')
+
+
+def _next_url(request, rows, limit):
+    if len(rows) <= limit:
+        return None
+    params = request.GET.copy()
+    params['after'] = rows[limit - 1]['id']
+    return f'{request.path}?{urlencode(params, doseq=True)}'
+
+
+def _json_response(request, payload, status=200):
+    body = json.dumps(payload, cls=DjangoJSONEncoder, separators=(',', ':')).encode()
+    etag = '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+    # The compression middleware weakens ETags, so compare without W/.
+    if status == 200:
+        candidates = [tag.strip().removeprefix('W/') for tag in request.headers.get('If-None-Match', '').split(',')]
+        if etag in candidates or '*' in candidates:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+    response = HttpResponse(body, status=status, content_type='application/json')
+    if status == 200:
+        response['ETag'] = etag
+    return response
+
+
+def api_view(login=False):
+    def decorator(view_func):
+        @require_safe
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if login and not request.user.is_authenticated:
+                return _json_response(request, {'error': 'Authentication required.'}, status=401)
+            try:
+                payload = view_func(request, *args, **kwargs)
+            except ApiError as error:
+                return _json_response(request, {'error': str(error)}, status=error.status)
+            return _json_response(request, payload)
+        return wrapper
+    return decorator
+
+
+def _fetch(request, queryset, fields, descending=False, extra=()):
+    # Keyset pagination on id: one query per page whatever the depth, and no
+    # COUNT. Returns one row more than the limit so callers can tell whether a
+    # next page exists. Batch requests (?ids=) skip pagination altogether.
+    ids = _ids(request)
+    if ids is not None:
+        return _values(queryset.filter(pk__in=ids).order_by('pk'), fields, *extra)
+    after = _cursor(request)
+    if after is not None:
+        queryset = queryset.filter(pk__lt=after) if descending else queryset.filter(pk__gt=after)
+    return _values(queryset.order_by('-pk' if descending else 'pk')[:_limit(request) + 1], fields, *extra)
+
+
+def _page(request, queryset, fields, extra=()):
+    rows = _fetch(request, queryset, fields, extra=extra)
+    if _ids(request) is not None:
+        return rows, None
+    limit = _limit(request)
+    return rows[:limit], _next_url(request, rows, limit)
+
+
+def _detail(rows):
+    if not rows:
+        raise ApiError('Not found.', status=404)
+    return {'data': rows[0]}
+
+
+def _embed_categories(rows):
+    ids = {row['category'] for row in rows if row.get('category') is not None}
+    categories = {category['id']: category
+                  for category in _values(Category.objects.filter(pk__in=ids), CATEGORY_FIELDS)}
+    for row in rows:
+        row['category'] = categories.get(row['category'])
+
+
+def _medicine_rows(request):
+    fields = _selected_fields(request, MEDICINE_FIELDS)
+    embeds = _embeds(request, ['category'])
+    if 'category' in embeds:
+        fields['category'] = MEDICINE_FIELDS['category']
+    medicines = Medicine.objects.all()
+    if 'effective_price' in fields:
+        # What checkout would charge now: price stays the list price.
+        medicines = pricing.with_effective_price(medicines)
+    if request.GET.get('category'):
+        try:
+            medicines = medicines.filter(category_id=int(request.GET['category']))
+        except ValueError:
+            raise ApiError('category must be an integer id.')
+    if request.GET.get('featured') == '1':
+        medicines = medicines.filter(featured=True)
+    return medicines, fields, embeds
+
+
+def _finish_medicines(rows, embeds):
+    # The stock column of a striped medicine is only a snapshot.
+    for row in rows:
+        if row.pop('striped') and 'stock' in row:
+            row['stock'] = striped_total(row['id'])
+    if 'category' in embeds:
+        _embed_categories(rows)
+
+
+@api_view()
+def medicine_list(request):
+    medicines, fields, embeds = _medicine_rows(request)
+    rows, next_url = _page(request, medicines, fields, extra=('striped',))
+    _finish_medicines(rows, embeds)
+    return {'data': rows, 'next': next_url}
+
+
+@api_view()
+def medicine_detail(request, pk):
+    medicines, fields, embeds = _medicine_rows(request)
+    rows = _values(medicines.filter(pk=pk), fields, 'striped')
+    _finish_medicines(rows, embeds)
+    return _detail(rows)
+
+
+@api_view()
+def category_list(request):
+    rows, next_url = _page(request, Category.objects.all(), _selected_fields(request, CATEGORY_FIELDS))
+    return {'data': rows, 'next': next_url}
+
+
+@api_view()
+def category_detail(request, pk):
+    return _detail(_values(Category.objects.filter(pk=pk), _selected_fields(request, CATEGORY_FIELDS)))
+
+
+def _embed_order_relations(rows, embeds):
+    # Orders may be live or archived (same ids), so each relation costs at
+    # most one query per table regardless of how many orders are on the page.
+    live = [row['id'] for row in rows if not row['archived']]
+    archived = [row['id'] for row in rows if row['archived']]
+    if 'items' in embeds:
+        items = {row['id']: [] for row in rows}
+        fields = {name: spec for name, spec in ORDER_ITEM_FIELDS.items() if name != 'medicine_name'}
+        if live:
+            for item in _values(OrderItem.objects.filter(order_id__in=live).order_by('pk'), fields,
+                                'order_id', medicine_name=F('medicine__name')):
+                items[item.pop('order_id')].append(item)
+        if archived:
+            for item in _values(ArchivedOrderItem.objects.filter(order_id__in=archived).order_by('pk'),
+                                ORDER_ITEM_FIELDS, 'order_id'):
+                items[item.pop('order_id')].append(item)
+        for row in rows:
+            row['items'] = items[row['id']]
+    if 'events' in embeds:
+        events = {row['id']: [] for row in rows}
+        for event in _values(OrderStatusEvent.objects.filter(order_id__in=live + archived)
+                             .order_by('created_at', 'pk'), ORDER_EVENT_FIELDS, 'order_id'):
+            events[event.pop('order_id')].append(event)
+        for row in rows:
+            row['events'] = events[row['id']]
+
+
+@api_view(login=True)
+def order_list(request):
+    fields = _selected_fields(request, ORDER_FIELDS)
+    embeds = _embeds(request, ['items', 'events'])
+    live = Order.objects.filter(user=request.user)
+    archived = ArchivedOrder.objects.filter(user=request.user)
+    if request.GET.get('status'):
+        live = live.filter(status=request.GET['status'])
+        archived = archived.filter(status=request.GET['status'])
+
+    # Newest first across both tables: fetch a page from each and merge.
+    rows = _fetch(request, live, fields, descending=True)
+    archived_rows = _fetch(request, archived, fields, descending=True)
+    for row in rows:
+        row['archived'] = False
+    for row in archived_rows:
+        row['archived'] = True
+    rows = sorted(rows + archived_rows, key=lambda row: row['id'], reverse=_ids(request) is None)
+    next_url = None
+    if _ids(request) is None:
+        limit = _limit(request)
+        next_url = _next_url(request, rows, limit)
+        rows = rows[:limit]
+    _embed_order_relations(rows, embeds)
+    return {'data': rows, 'next': next_url}
+
+
+@api_view(login=True)
+def order_detail(request, pk):
+    fields = _selected_fields(request, ORDER_FIELDS)
+    embeds = _embeds(request, ['items', 'events'])
+    rows = _values(Order.objects.filter(user=request.user, pk=pk), fields)
+    archived = False
+    if not rows:
+        rows = _values(ArchivedOrder.objects.filter(user=request.user, pk=pk), fields)
+        archived = True
+    for row in rows:
+        row['archived'] = archived
+    _embed_order_relations(rows, embeds)
+    return _detail(rows)
+
+
+@api_view(login=True)
+def reminder_list(request):
+    reminders = RefillReminder.objects.filter(user=request.user)
+    if request.GET.get('active') == '1':
+        reminders = reminders.filter(is_active=True)
+    rows, next_url = _page(request, reminders, _selected_fields(request, REMINDER_FIELDS))
+    return {'data': rows, 'next': next_url}
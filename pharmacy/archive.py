@@ -0,0 +1,83 @@
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .models import ArchivedOrder, ArchivedOrderItem, Cart, Order, OrderItem
+from .signals import stats_refresh_paused
+
+ARCHIVABLE_STATUSES = ['delivered', 'cancelled']
+ORDER_FIELDS = ['id', 'user_id', 'total_amount', 'status', 'shipping_address', 'phone',
+                'notes', 'created_at', 'updated_at']
+
+
+def archive_order_batch(ids):
+    orders = Order.objects.filter(pk__in=ids).values(*ORDER_FIELDS)
+    ArchivedOrder.objects.bulk_create([ArchivedOrder(**order) for order in orders])
+    items = OrderItem.objects.filter(order_id__in=ids).values_list(
+        'order_id', 'medicine_id', 'medicine__name', 'quantity', 'price')
+    ArchivedOrderItem.objects.bulk_create([
+        ArchivedOrderItem(order_id=order_id, medicine_id=medicine_id, medicine_name=name,
+                          quantity=quantity, price=price)
+        for order_id, medicine_id, name, quantity, price in items
+    ], batch_size=1000)
+    item_count = OrderItem.objects.filter(order_id__in=ids).delete()[0]
+    # Archiving moves orders without changing any customer's totals.
+    with stats_refresh_paused():
+        Order.objects.filter(pk__in=ids).delete()
+    return item_count
+
+
+def archive_orders(older_than, batch_size=500, statuses=ARCHIVABLE_STATUSES):
+    cutoff = timezone.now() - older_than
+    candidates = Order.objects.filter(status__in=statuses, created_at__lt=cutoff).order_by('created_at', 'pk')
+    while True:
+        with transaction.atomic():
+            ids = list(candidates.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return
+            items = archive_order_batch(ids)
+        yield {'orders': len(ids), 'items': items}
+
+
+def purge_stale_carts(older_than, batch_size=1000):
+    cutoff = timezone.now() - older_than
+    while True:
+        ids = list(Cart.objects.filter(updated_at__lt=cutoff).values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return
+        yield Cart.objects.filter(pk__in=ids).delete()[0]
+
+
+class CustomerOrders:
+    # Paginator-compatible sequence of a customer's live orders followed by
+    # their archived ones. The archive is only read once a page runs past the
+    # last live order.
+    def __init__(self, user):
+        # Explicit order: Meta.ordering is dropped from GROUP BY queries, and
+        # pages sliced from an unordered result repeat or skip orders.
+        self.live = (Order.objects.filter(user=user).annotate(item_count=Count('items'))
+                     .order_by('-created_at', '-pk'))
+        self.archived = (ArchivedOrder.objects.filter(user=user).annotate(item_count=Count('items'))
+                         .order_by('-created_at', '-pk'))
+
+    @cached_property
+    def live_count(self):
+        return self.live.count()
+
+    def count(self):
+        return self.live_count + self.archived.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start, stop = key.start or 0, key.stop
+        rows = []
+        if start < self.live_count:
+            rows += list(self.live[start:min(stop, self.live_count)])
+        if stop > self.live_count:
+            rows += list(self.archived[max(start - self.live_count, 0):stop - self.live_count])
+        return rows
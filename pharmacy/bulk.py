@@ -0,0 +1,165 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Value, When
+from django.db.models.functions import Greatest, Round
+from django.utils import timezone
+
+from . import catalogue, inventory, objectcache, pricing, workflow
+from .models import Medicine, Order
+
+BATCH_SIZE = 500
+PREVIEW_ROWS = 50
+
+
+def _batches(items, size=BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def price_factor(percentage):
+    return (Decimal(100) + percentage) / Decimal(100)
+
+
+def medicines_for_reprice(category=None, manufacturer=''):
+    medicines = Medicine.objects.all()
+    if category:
+        medicines = medicines.filter(category=category)
+    if manufacturer:
+        medicines = medicines.filter(manufacturer__iexact=manufacturer)
+    return medicines
+
+
+def preview_reprice(medicines, percentage):
+    factor = price_factor(percentage)
+    rows = list(medicines.values('id', 'name', 'price')[:PREVIEW_ROWS])
+    for row in rows:
+        row['new_price'] = (row['price'] * factor).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    return {'count': medicines.count(), 'rows': rows}
+
+
+def apply_reprice(medicines, percentage):
+    factor = price_factor(percentage)
+    with transaction.atomic():
+        updated = medicines.update(
+            price=Round(F('price') * Value(factor), 2),
+            updated_at=timezone.now(),
+        )
+        transaction.on_commit(lambda: objectcache.invalidate_all(Medicine))
+        # Percentage promotions follow the new list prices.
+        transaction.on_commit(pricing.compile_prices)
+        transaction.on_commit(catalogue.mark_stale)
+    return [{'batch': 1, 'matched': updated, 'updated': updated}]
+
+
+def parse_stock_lines(text):
+    changes = {}
+    errors = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.replace(',', ' ').split()
+        if len(parts) != 2:
+            errors.append(f'Line {number}: expected "<medicine id> <quantity>"')
+            continue
+        try:
+            medicine_id, quantity = int(parts[0]), int(parts[1])
+        except ValueError:
+            errors.append(f'Line {number}: "{line}" is not two whole numbers')
+            continue
+        changes[medicine_id] = changes.get(medicine_id, 0) + quantity
+    return changes, errors
+
+
+def _new_stock(current, quantity, mode):
+    if mode == 'set':
+        return max(quantity, 0)
+    return max(current + quantity, 0)
+
+
+def preview_stock_changes(changes, mode):
+    rows = []
+    ids = sorted(changes)
+    for chunk in _batches(ids):
+        for row in Medicine.objects.filter(pk__in=chunk).values('id', 'name', 'stock', 'striped'):
+            if row.pop('striped'):
+                row['stock'] = inventory.striped_total(row['id'])
+            row['new_stock'] = _new_stock(row['stock'], changes[row['id']], mode)
+            rows.append(row)
+    found = {row['id'] for row in rows}
+    return {
+        'count': len(rows),
+        'rows': rows[:PREVIEW_ROWS],
+        'missing': [pk for pk in ids if pk not in found],
+    }
+
+
+def apply_stock_changes(changes, mode):
+    batches = []
+    now = timezone.now()
+    with transaction.atomic():
+        for number, chunk in enumerate(_batches(sorted(changes)), 1):
+            quantity = Case(
+                *[When(pk=pk, then=Value(changes[pk])) for pk in chunk],
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+            if mode == 'set':
+                new_stock = Greatest(quantity, Value(0))
+            else:
+                new_stock = Greatest(F('stock') + quantity, Value(0))
+            updated = Medicine.objects.filter(pk__in=chunk, striped=False).update(stock=new_stock, updated_at=now)
+            # Striped medicines keep their units in stripe rows.
+            for pk in Medicine.objects.filter(pk__in=chunk, striped=True).values_list('pk', flat=True):
+                if mode == 'set':
+                    inventory.set_total(pk, max(changes[pk], 0))
+                else:
+                    inventory.adjust(pk, changes[pk])
+                updated += 1
+            batches.append({'batch': number, 'matched': len(chunk), 'updated': updated})
+        transaction.on_commit(lambda: objectcache.invalidate_all(Medicine))
+        transaction.on_commit(catalogue.mark_stale)
+    return batches
+
+
+def orders_for_status_change(order_ids=None, from_status=''):
+    orders = Order.objects.all()
+    if order_ids:
+        orders = orders.filter(pk__in=order_ids)
+    if from_status:
+        orders = orders.filter(status=from_status)
+    return orders
+
+
+def preview_order_status(orders, new_status):
+    by_status = dict(
+        orders.order_by().values_list('status').annotate(total=Count('id'))
+    )
+    labels = dict(Order.STATUS_CHOICES)
+    sources = workflow.source_statuses(new_status)
+    return {
+        'count': sum(by_status.values()),
+        'unchanged': by_status.get(new_status, 0),
+        'blocked': sum(total for status, total in by_status.items()
+                       if status != new_status and status not in sources),
+        'rows': [
+            {'status': labels.get(status, status), 'total': total, 'allowed': status in sources}
+            for status, total in sorted(by_status.items())
+        ],
+    }
+
+
+def apply_order_status(orders, new_status, actor=None):
+    # Goes through the order state machine: only legal transitions are
+    # applied and each one is written to the status event log.
+    return workflow.bulk_transition(orders, new_status, actor=actor)
+
+
+def summarize(batches, noun):
+    updated = sum(batch['updated'] for batch in batches)
+    parts = [f"batch {batch['batch']}: {batch['updated']}/{batch['matched']}" for batch in batches]
+    summary = f'{updated} {noun} updated'
+    if parts:
+        summary += f" ({', '.join(parts)})"
+    return summary
@@ -0,0 +1,375 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Sum
+from django.db.models.fields.files import ImageFieldFile
+
+from .models import Category, Medicine, StockStripe
+from .pricing import with_effective_price
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FILENAME = 'catalogue.snapshot'
+# Touched by saves; a snapshot older than this file is out of date.
+STALE_FILENAME = 'catalogue.stale'
+MAGIC = b'SKYCAT01'
+ALIGNMENT = 64
+
+# magic, version, header length; the JSON header then lists each array's
+# dtype, offset and length.
+_preamble = struct.Struct('8sqq')
+
+_current = None
+_checked = 0.0
+_lock = threading.Lock()
+
+
+def _directory():
+    return getattr(settings, 'CATALOGUE_DIR', '')
+
+
+def enabled():
+    return bool(_directory()) and np is not None
+
+
+def _path(directory=None):
+    return os.path.join(directory or _directory(), FILENAME)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+class _Strings:
+    # Interned string table: each distinct string is stored once and rows
+    # refer to it by index. Index 0 is the empty string.
+    def __init__(self):
+        self.index = {'': 0}
+
+    def __call__(self, value):
+        return self.index.setdefault(value or '', len(self.index))
+
+    def arrays(self):
+        encoded = [value.encode() for value in self.index]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def _snapshot_arrays():
+    strings = _Strings()
+    striped = dict(StockStripe.objects.order_by().values_list('medicine').annotate(total=Sum('quantity')))
+    medicines = list(with_effective_price(Medicine.objects.order_by('name', 'pk')).values_list(
+        'pk', 'price', 'stock', 'striped', 'category_id', 'featured', 'requires_prescription', 'name', 'image',
+        'effective_price', 'current_offer__valid_until'))
+    categories = list(Category.objects.order_by('name', 'pk').values_list('pk', 'name', 'description', 'image'))
+    arrays = {
+        'medicine_id': np.array([row[0] for row in medicines], dtype=np.int64),
+        # Prices in cents, so totals are exact integer sums. medicine_price is
+        # what the customer pays now (after promotions), list_price the label.
+        'medicine_price': np.array([int(row[9].quantize(Decimal('0.01')).scaleb(2)) for row in medicines],
+                                   dtype=np.int64),
+        'medicine_list_price': np.array([int(row[1].scaleb(2)) for row in medicines], dtype=np.int64),
+        # When the offer behind medicine_price ends (Unix seconds, 0 for
+        # never); after that readers charge the list price until a republish.
+        'medicine_offer_until': np.array([int(row[10].timestamp()) if row[10] else 0 for row in medicines],
+                                         dtype=np.int64),
+        'medicine_stock': np.array([striped.get(row[0], 0) if row[3] else row[2] for row in medicines],
+                                   dtype=np.int64),
+        'medicine_category': np.array([row[4] or -1 for row in medicines], dtype=np.int64),
+        'medicine_featured': np.array([row[5] for row in medicines], dtype=np.bool_),
+        'medicine_prescription': np.array([row[6] for row in medicines], dtype=np.bool_),
+        'medicine_name': np.array([strings(row[7]) for row in medicines], dtype=np.int32),
+        'medicine_image': np.array([strings(row[8]) for row in medicines], dtype=np.int32),
+        'category_id': np.array([row[0] for row in categories], dtype=np.int64),
+        'category_name': np.array([strings(row[1]) for row in categories], dtype=np.int32),
+        'category_description': np.array([strings(row[2]) for row in categories], dtype=np.int32),
+        'category_image': np.array([strings(row[3]) for row in categories], dtype=np.int32),
+    }
+    arrays['string_offsets'], arrays['string_data'] = strings.arrays()
+    return arrays
+
+
+def _write(path, version, arrays):
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = [array.dtype.str, offset, len(array)]
+        offset += array.nbytes + -array.nbytes % ALIGNMENT
+    header = json.dumps(layout).encode()
+    start = _preamble.size + len(header)
+    start += -start % ALIGNMENT
+    directory = os.path.dirname(path)
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.catalogue-')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            output.write(_preamble.pack(MAGIC, version, len(header)) + header)
+            output.write(b'\0' * (start - output.tell()))
+            for name, array in arrays.items():
+                output.write(array.tobytes())
+                output.write(b'\0' * (-array.nbytes % ALIGNMENT))
+            output.flush()
+            os.fsync(output.fileno())
+        os.chmod(temporary, 0o644)
+        # Readers that already mapped the old file keep it until they move on.
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return start + offset
+
+
+def publish(directory=None):
+    directory = directory or _directory()
+    os.makedirs(directory, exist_ok=True)
+    path = _path(directory)
+    try:
+        with open(path, 'rb') as existing:
+            version = _preamble.unpack(existing.read(_preamble.size))[1] + 1
+    except (OSError, struct.error):
+        version = 1
+    # The snapshot is stamped with the time its rows were read, so a save
+    # that lands while it is being built still marks it stale.
+    started = time.time()
+    arrays = _snapshot_arrays()
+    size = _write(path, version, arrays)
+    os.utime(path, (started, started))
+    return {'version': version, 'medicines': len(arrays['medicine_id']),
+            'categories': len(arrays['category_id']), 'bytes': size}
+
+
+def mark_stale():
+    # Called on commit of catalogue changes. Only touches a file: web workers
+    # never publish, the main.py arbiter or `publish_catalogue --if-stale`
+    # does, once per CATALOGUE_PUBLISH_DELAY at most.
+    if not enabled():
+        return
+    path = os.path.join(_directory(), STALE_FILENAME)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(_directory(), exist_ok=True)
+        open(path, 'ab').close()
+
+
+def is_stale(directory=None, now=None):
+    # Marked stale by a save, or older than CATALOGUE_MAX_AGE: sales don't
+    # mark it, so this is how stock levels catch up.
+    published = _mtime(_path(directory))
+    if published is None:
+        return True
+    changed = _mtime(os.path.join(directory or _directory(), STALE_FILENAME))
+    now = time.time() if now is None else now
+    return (changed is not None and changed >= published) or now - published >= getattr(
+        settings, 'CATALOGUE_MAX_AGE', 60)
+
+
+def publish_if_stale(directory=None):
+    # A burst of saves within CATALOGUE_PUBLISH_DELAY seconds of the last
+    # publish waits for the next call and produces one new snapshot.
+    now = time.time()
+    if not is_stale(directory, now):
+        return None
+    published = _mtime(_path(directory))
+    if published is not None and now - published < getattr(settings, 'CATALOGUE_PUBLISH_DELAY', 2):
+        return None
+    return publish(directory)
+
+
+class CategoryEntry:
+    __slots__ = ('id', 'pk', 'name', 'description', 'image', 'medicine_count')
+
+    def __str__(self):
+        return self.name
+
+
+class MedicineEntry:
+    # Quacks like a Medicine for the catalogue templates.
+    __slots__ = ('id', 'pk', 'name', 'price', 'effective_price', 'stock', 'category_id', 'category', 'featured',
+                 'requires_prescription', 'image')
+
+    @property
+    def in_stock(self):
+        return self.stock > 0
+
+    def __str__(self):
+        return self.name
+
+
+class CartLine:
+    __slots__ = ('id', 'medicine', 'quantity', 'unit_price', 'total_price')
+
+
+class Snapshot:
+    # Arrays are views straight into the shared read-only mapping, so every
+    # worker uses the same physical pages whatever the catalogue size.
+    def __init__(self, path):
+        with open(path, 'rb') as source:
+            stat = os.fstat(source.fileno())
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+        magic, self.version, header_length = _preamble.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a catalogue snapshot')
+        layout = json.loads(self._map[_preamble.size:_preamble.size + header_length])
+        start = _preamble.size + header_length
+        start += -start % ALIGNMENT
+        for name, (dtype, offset, length) in layout.items():
+            array = np.frombuffer(self._map, dtype=dtype, count=length, offset=start + offset) if length \
+                else np.empty(0, dtype=dtype)
+            setattr(self, name, array)
+        if 'medicine_offer_until' not in layout:
+            # Written before offers carried an expiry.
+            self.medicine_offer_until = np.zeros(len(self.medicine_id), dtype=np.int64)
+        self._by_id = np.argsort(self.medicine_id, kind='stable')
+        self._category_by_id = np.argsort(self.category_id, kind='stable')
+        self._categories = None
+
+    def __len__(self):
+        return len(self.medicine_id)
+
+    def string(self, index):
+        return bytes(self.string_data[self.string_offsets[index]:self.string_offsets[index + 1]]).decode()
+
+    def _find(self, ids, sorted_ids, order):
+        ids = np.asarray(ids, dtype=np.int64)
+        found = np.searchsorted(sorted_ids, ids)
+        found[found == len(sorted_ids)] = 0
+        positions = order[found] if len(order) else found
+        valid = (sorted_ids[found] == ids) if len(order) else np.zeros(len(ids), dtype=bool)
+        return np.where(valid, positions, -1)
+
+    def positions(self, ids):
+        # Row of each medicine id, -1 where the snapshot doesn't have it.
+        return self._find(ids, self.medicine_id[self._by_id], self._by_id)
+
+    def prices(self, positions, now=None):
+        # Cents the customer pays now: offers that have ended since the
+        # snapshot was published fall back to the list price.
+        now = time.time() if now is None else now
+        until = self.medicine_offer_until[positions]
+        return np.where((until > 0) & (until <= now), self.medicine_list_price[positions],
+                        self.medicine_price[positions])
+
+    def select(self, category=None, featured=None, in_stock=None, stock_below=None, limit=None):
+        mask = np.ones(len(self), dtype=bool)
+        if category is not None:
+            mask &= self.medicine_category == category
+        if featured is not None:
+            mask &= self.medicine_featured == featured
+        if in_stock is not None:
+            mask &= (self.medicine_stock > 0) == in_stock
+        if stock_below is not None:
+            mask &= self.medicine_stock < stock_below
+        positions = np.flatnonzero(mask)
+        return positions[:limit] if limit is not None else positions
+
+    def categories(self):
+        if self._categories is None:
+            counts = np.zeros(len(self.category_id), dtype=np.int64)
+            known = self._find(self.medicine_category, self.category_id[self._category_by_id], self._category_by_id)
+            np.add.at(counts, known[known >= 0], 1)
+            field = Category._meta.get_field('image')
+            categories = []
+            for row in range(len(self.category_id)):
+                entry = CategoryEntry()
+                entry.id = entry.pk = int(self.category_id[row])
+                entry.name = self.string(self.category_name[row])
+                entry.description = self.string(self.category_description[row])
+                entry.image = ImageFieldFile(None, field, self.string(self.category_image[row]))
+                entry.medicine_count = int(counts[row])
+                categories.append(entry)
+            self._categories = categories
+        return self._categories
+
+    def category(self, category_id):
+        row = self._find([category_id], self.category_id[self._category_by_id], self._category_by_id)[0]
+        return self.categories()[row] if row >= 0 else None
+
+    def entries(self, positions):
+        categories = self.categories()
+        category_rows = self._find(self.medicine_category[positions],
+                                   self.category_id[self._category_by_id], self._category_by_id)
+        prices = self.prices(positions)
+        field = Medicine._meta.get_field('image')
+        entries = []
+        for position, category_row, price in zip(np.asarray(positions).tolist(), category_rows.tolist(),
+                                                 prices.tolist()):
+            entry = MedicineEntry()
+            entry.id = entry.pk = int(self.medicine_id[position])
+            entry.name = self.string(self.medicine_name[position])
+            entry.price = Decimal(int(self.medicine_list_price[position])).scaleb(-2)
+            entry.effective_price = Decimal(price).scaleb(-2)
+            entry.stock = int(self.medicine_stock[position])
+            entry.category = categories[category_row] if category_row >= 0 else None
+            entry.category_id = entry.category.id if entry.category else None
+            entry.featured = bool(self.medicine_featured[position])
+            entry.requires_prescription = bool(self.medicine_prescription[position])
+            entry.image = ImageFieldFile(None, field, self.string(self.medicine_image[position]))
+            entries.append(entry)
+        return entries
+
+    def line_totals(self, medicine_ids, quantities):
+        # Cents per cart line, or None if a medicine is missing from the snapshot.
+        positions = self.positions(medicine_ids)
+        if (positions < 0).any():
+            return None
+        return self.prices(positions) * np.asarray(quantities, dtype=np.int64)
+
+    def cart_total(self, medicine_ids, quantities):
+        totals = self.line_totals(medicine_ids, quantities)
+        return None if totals is None else Decimal(int(totals.sum())).scaleb(-2)
+
+    def cart_lines(self, rows):
+        # rows are (cart id, medicine id, quantity). Returns the lines and
+        # their total, or None if a medicine is missing from the snapshot.
+        if not rows:
+            return [], Decimal('0.00')
+        cart_ids, medicine_ids, quantities = zip(*rows)
+        totals = self.line_totals(medicine_ids, quantities)
+        if totals is None:
+            return None
+        lines = []
+        for cart_id, medicine, quantity, total in zip(
+                cart_ids, self.entries(self.positions(medicine_ids)), quantities, totals.tolist()):
+            line = CartLine()
+            line.id, line.medicine, line.quantity = cart_id, medicine, quantity
+            line.unit_price = medicine.effective_price
+            line.total_price = Decimal(total).scaleb(-2)
+            lines.append(line)
+        return lines, Decimal(int(totals.sum())).scaleb(-2)
+
+
+def current():
+    # The file is replaced, never rewritten, so a new inode means a new
+    # version. Workers look at most every CATALOGUE_CHECK_INTERVAL seconds and
+    # swap the module reference; pages already rendering keep the old one.
+    global _current, _checked
+    if not enabled():
+        return None
+    now = time.monotonic()
+    if _current is not None and now - _checked < getattr(settings, 'CATALOGUE_CHECK_INTERVAL', 1):
+        return _current
+    with _lock:
+        try:
+            stat = os.stat(_path())
+        except FileNotFoundError:
+            _current = None
+        else:
+            if _current is None or _current.identity != (stat.st_ino, stat.st_mtime_ns):
+                _current = Snapshot(_path())
+        _checked = now
+    return _current
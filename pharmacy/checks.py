@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+PER_PROCESS_CACHES = {'django.core.cache.backends.locmem.LocMemCache'}
+# BaseCache.incr is a get followed by a set, so concurrent updates are lost.
+NON_ATOMIC_CACHES = {
+    'django.core.cache.backends.filebased.FileBasedCache',
+    'django.core.cache.backends.db.DatabaseCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+@register()
+def admission_cache_check(app_configs, **kwargs):
+    alias = getattr(settings, 'ADMISSION_CACHE', 'default')
+    if not getattr(settings, 'ADMISSION_CONTROL', {}) or alias not in settings.CACHES:
+        return []
+    backend = settings.CACHES[alias]['BACKEND']
+    if backend in PER_PROCESS_CACHES:
+        return [Warning(
+            f'ADMISSION_CACHE ({alias!r}) is a per-process LocMemCache.',
+            hint='Every worker enforces its own limits, multiplying them by the worker count. '
+                 'Set REDIS_URL or point the alias at Redis or Memcached.',
+            id='pharmacy.W001',
+        )]
+    if backend in NON_ATOMIC_CACHES:
+        return [Warning(
+            f'ADMISSION_CACHE ({alias!r}) uses {backend.rsplit(".", 1)[-1]}, which cannot increment atomically.',
+            hint='Concurrent requests overwrite each other and limits are not enforced under load. '
+                 'Use Redis or Memcached.',
+            id='pharmacy.W002',
+        )]
+    return []
+
+
+@register()
+def object_cache_check(app_configs, **kwargs):
+    alias = getattr(settings, 'OBJECT_CACHE', 'default')
+    workers = getattr(settings, 'PREFORK_WORKERS', 1)
+    if workers < 2 or alias not in settings.CACHES:
+        return []
+    if settings.CACHES[alias]['BACKEND'] in PER_PROCESS_CACHES:
+        return [Warning(
+            f'OBJECT_CACHE ({alias!r}) is a per-process LocMemCache under {workers} workers.',
+            hint='A save invalidates only the worker that made it; the others serve the old price and stock '
+                 'for up to OBJECT_CACHE_TIMEOUT seconds. Set REDIS_URL or point the alias at Redis or Memcached.',
+            id='pharmacy.W003',
+        )]
+    return []
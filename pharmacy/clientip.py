@@ -0,0 +1,16 @@
+from django.conf import settings
+
+
+def client_ip(request):
+    # REMOTE_ADDR, unless the connection comes from one of TRUSTED_PROXIES:
+    # then the rightmost X-Forwarded-For hop that is not a trusted proxy
+    # itself. Hops further left were written by the client and prove nothing.
+    address = request.META.get('REMOTE_ADDR', '')
+    trusted = getattr(settings, 'TRUSTED_PROXIES', [])
+    if address not in trusted:
+        return address
+    hops = [hop.strip() for hop in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if hop.strip()]
+    for hop in reversed(hops):
+        if hop not in trusted:
+            return hop
+    return address
@@ -0,0 +1,146 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+
+from . import catalogue, objectcache, pricing
+from .models import Cart, Medicine
+
+SALT = 'pharmacy.cookiecart'
+MAX_QUANTITY = 99
+
+
+def _cookie_name():
+    return getattr(settings, 'CART_COOKIE_NAME', 'cart')
+
+
+def _max_items():
+    return getattr(settings, 'CART_COOKIE_MAX_ITEMS', 30)
+
+
+def _max_age():
+    return getattr(settings, 'CART_COOKIE_MAX_AGE', 30 * 24 * 3600)
+
+
+def _signer():
+    return signing.TimestampSigner(salt=SALT)
+
+
+def encode(items):
+    # "12x1.40x3", sorted by medicine id, then signed: about 50 bytes for a
+    # typical cart and far below the 4 KB cookie limit at CART_COOKIE_MAX_ITEMS.
+    return _signer().sign('.'.join(f'{medicine_id}x{quantity}' for medicine_id, quantity in sorted(items.items())))
+
+
+def decode(value):
+    # Tampered, expired or malformed cookies simply read as an empty cart.
+    try:
+        payload = _signer().unsign(value, max_age=_max_age())
+    except signing.BadSignature:
+        return {}
+    items = {}
+    for pair in payload.split('.') if payload else []:
+        medicine_id, _, quantity = pair.partition('x')
+        if not (medicine_id.isdigit() and quantity.isdigit()):
+            return {}
+        if int(quantity) > 0:
+            items[int(medicine_id)] = min(int(quantity), MAX_QUANTITY)
+    return dict(list(items.items())[:_max_items()])
+
+
+class CartFull(Exception):
+    pass
+
+
+class CookieCart:
+    # The anonymous visitor's cart, read from a signed cookie. Views change it
+    # and CookieCartMiddleware writes it back, so browsing and building a cart
+    # never touch the database.
+    def __init__(self, request):
+        self.items = decode(request.COOKIES.get(_cookie_name(), ''))
+        self.changed = False
+        self.cleared = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def count(self):
+        return len(self.items)
+
+    def quantity(self, medicine_id):
+        return self.items.get(medicine_id, 0)
+
+    def set(self, medicine_id, quantity):
+        if quantity <= 0:
+            self.items.pop(medicine_id, None)
+        else:
+            if medicine_id not in self.items and len(self.items) >= _max_items():
+                raise CartFull
+            self.items[medicine_id] = min(quantity, MAX_QUANTITY)
+        self.changed = True
+
+    def remove(self, medicine_id):
+        self.set(medicine_id, 0)
+
+    def clear(self):
+        self.items = {}
+        self.cleared = True
+
+    def lines(self):
+        # Priced from the catalogue snapshot, or else the object cache plus
+        # one read of the current effective prices.
+        rows = [(medicine_id, medicine_id, quantity) for medicine_id, quantity in self.items.items()]
+        snapshot = catalogue.current()
+        if snapshot is not None:
+            priced = snapshot.cart_lines(rows)
+            if priced is not None:
+                return priced
+        medicines = objectcache.get_many(Medicine, list(self.items))
+        prices = pricing.effective_prices(list(medicines))
+        lines = []
+        for medicine_id, quantity in self.items.items():
+            if medicine_id in medicines:
+                line = catalogue.CartLine()
+                line.id, line.medicine, line.quantity = medicine_id, medicines[medicine_id], quantity
+                line.unit_price = prices[medicine_id].quantize(pricing.CENT)
+                line.total_price = line.unit_price * quantity
+                lines.append(line)
+        return lines, sum((line.total_price for line in lines), Decimal('0.00'))
+
+    def save(self, response):
+        if self.cleared and not self.items:
+            response.delete_cookie(_cookie_name(), samesite='Lax')
+        elif self.changed:
+            response.set_cookie(_cookie_name(), encode(self.items), max_age=_max_age(),
+                                httponly=True, samesite='Lax', secure=settings.SESSION_COOKIE_SECURE)
+
+
+def get(request):
+    if not hasattr(request, 'cookie_cart'):
+        request.cookie_cart = CookieCart(request)
+    return request.cookie_cart
+
+
+def merge(user, items):
+    # On login: one read of the customer's existing rows, then one upsert that
+    # adds the cookie quantities to them, capped at MAX_QUANTITY and at the
+    # stock on hand (the same limits add_to_cart applies). Medicines deleted
+    # or sold out since are dropped; existing rows are never reduced.
+    if not items:
+        return 0
+    existing = dict(Cart.objects.filter(user=user, medicine__in=items).values_list('medicine', 'quantity'))
+    stock = {medicine.pk: medicine.stock
+             for medicine in Medicine.objects.filter(pk__in=items).only('pk', 'stock', 'striped')}
+    now = timezone.now()
+    rows = []
+    for medicine_id, quantity in sorted(items.items()):
+        if medicine_id not in stock:
+            continue
+        current = existing.get(medicine_id, 0)
+        merged = max(current, min(current + quantity, MAX_QUANTITY, stock[medicine_id]))
+        if merged > 0:
+            rows.append(Cart(user=user, medicine_id=medicine_id, quantity=merged, created_at=now, updated_at=now))
+    Cart.objects.bulk_create(rows, update_conflicts=True, unique_fields=['user', 'medicine'],
+                             update_fields=['quantity', 'updated_at'])
+    return len(rows)
@@ -1,7 +1,8 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
-from .models import Medicine, RefillReminder, Order
+from .models import Category, Medicine, RefillReminder, Order
+from .bulk import parse_stock_lines
 
 
 class UserRegistrationForm(UserCreationForm):
@@ -19,7 +20,25 @@ class UserRegistrationForm(UserCreationForm):
             field.widget.attrs['class'] = 'form-control'
 
 
-class MedicineForm(forms.ModelForm):
+class StockFormMixin:
+    # Striped stock moves with every sale, so writing back the total the form
+    # showed would undo the sales made since. Record only the change the user
+    # typed; the post_save signal applies it with inventory.adjust.
+    def _post_clean(self):
+        super()._post_clean()
+        field = self.fields.get('stock')
+        if field is None or not self.instance.pk or 'stock' not in self.cleaned_data:
+            return
+        shown = field.hidden_widget().value_from_datadict(self.data, self.files, self['stock'].html_initial_name)
+        try:
+            shown = field.to_python(shown)
+        except forms.ValidationError:
+            shown = None
+        if shown is not None:
+            self.instance._stock_delta = self.cleaned_data['stock'] - shown
+
+
+class MedicineForm(StockFormMixin, forms.ModelForm):
     class Meta:
         model = Medicine
         fields = ['name', 'description', 'category', 'price', 'stock', 'image', 
@@ -56,3 +75,70 @@ class CheckoutForm(forms.Form):
         super().__init__(*args, **kwargs)
         for field in self.fields.values():
             field.widget.attrs['class'] = 'form-control'
+
+
+class BulkRepriceForm(forms.Form):
+    category = forms.ModelChoiceField(queryset=Category.objects.all(), required=False,
+                                      empty_label='All categories')
+    manufacturer = forms.CharField(max_length=200, required=False)
+    percentage = forms.DecimalField(max_digits=5, decimal_places=2, min_value=-90, max_value=500,
+                                    help_text='Use a negative value for a discount, e.g. -15')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field in self.fields.values():
+            field.widget.attrs['class'] = 'form-control'
+
+
+class BulkStockForm(forms.Form):
+    MODE_CHOICES = [
+        ('adjust', 'Adjust stock by quantity'),
+        ('set', 'Set stock to quantity'),
+    ]
+
+    mode = forms.ChoiceField(choices=MODE_CHOICES)
+    lines = forms.CharField(widget=forms.Textarea(attrs={'rows': 10}),
+                            help_text='One "<medicine id> <quantity>" pair per line')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field in self.fields.values():
+            field.widget.attrs['class'] = 'form-control'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        # An empty or invalid field already has its own error.
+        if 'lines' not in cleaned_data:
+            return cleaned_data
+        changes, errors = parse_stock_lines(cleaned_data['lines'])
+        if errors:
+            raise forms.ValidationError(errors)
+        if not changes:
+            raise forms.ValidationError('Paste at least one stock line.')
+        cleaned_data['changes'] = changes
+        return cleaned_data
+
+
+class BulkOrderStatusForm(forms.Form):
+    order_ids = forms.CharField(widget=forms.Textarea(attrs={'rows': 4}), required=False,
+                                help_text='Order numbers separated by commas, spaces or new lines')
+    from_status = forms.ChoiceField(choices=[('', 'Any status')] + Order.STATUS_CHOICES, required=False)
+    status = forms.ChoiceField(choices=Order.STATUS_CHOICES)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field in self.fields.values():
+            field.widget.attrs['class'] = 'form-control'
+
+    def clean_order_ids(self):
+        raw = self.cleaned_data['order_ids'].replace(',', ' ').replace('#', ' ').split()
+        try:
+            return sorted({int(value) for value in raw})
+        except ValueError:
+            raise forms.ValidationError('Order numbers must be whole numbers.')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('order_ids') and not cleaned_data.get('from_status'):
+            raise forms.ValidationError('Enter order numbers or pick a current status to select orders.')
+        return cleaned_data
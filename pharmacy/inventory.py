@@ -0,0 +1,162 @@
+import random
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F, Sum
+
+from . import catalogue, objectcache
+from .models import Medicine, StockStripe
+
+BLIND_ATTEMPTS = 2
+
+
+class OutOfStock(Exception):
+    pass
+
+
+def _cache():
+    return caches[getattr(settings, 'OBJECT_CACHE', 'default')]
+
+
+def _stripe_count():
+    return getattr(settings, 'STOCK_STRIPES', 8)
+
+
+def _total_key(medicine_id):
+    return f'stock:total:{medicine_id}'
+
+
+def striped_total(medicine_id):
+    cache = _cache()
+    total = cache.get(_total_key(medicine_id))
+    if total is None:
+        total = StockStripe.objects.filter(medicine_id=medicine_id).aggregate(total=Sum('quantity'))['total'] or 0
+        cache.set(_total_key(medicine_id), total, timeout=getattr(settings, 'STOCK_TOTAL_TIMEOUT', 2))
+    return total
+
+
+def forget_total(medicine_id):
+    _cache().delete(_total_key(medicine_id))
+
+
+def _split(total, stripes):
+    share, extra = divmod(total, stripes)
+    return [share + (1 if number < extra else 0) for number in range(stripes)]
+
+
+def _take_striped(medicine_id, quantity):
+    # Each sale touches one randomly chosen stripe, so up to K buyers of the
+    # same medicine can commit side by side. The first tries go straight to a
+    # conditional UPDATE without reading anything; only when the chosen
+    # stripes run short are the stripes read and units gathered from several.
+    count = _stripe_count()
+    for stripe in random.sample(range(count), min(BLIND_ATTEMPTS, count)):
+        if StockStripe.objects.filter(medicine_id=medicine_id, stripe=stripe, quantity__gte=quantity).update(
+                quantity=F('quantity') - quantity):
+            return
+    stripes = list(StockStripe.objects.filter(medicine_id=medicine_id, quantity__gt=0)
+                   .values_list('pk', 'quantity'))
+    random.shuffle(stripes)
+    for pk, available in stripes:
+        if available >= quantity and StockStripe.objects.filter(pk=pk, quantity__gte=quantity).update(
+                quantity=F('quantity') - quantity):
+            return
+    remaining = quantity
+    with transaction.atomic():
+        for pk, available in stripes:
+            take = min(available, remaining)
+            if StockStripe.objects.filter(pk=pk, quantity__gte=take).update(quantity=F('quantity') - take):
+                remaining -= take
+            if not remaining:
+                return
+        raise OutOfStock
+
+
+def take(medicine, quantity):
+    # Conditional decrement instead of SELECT ... FOR UPDATE: the statement
+    # only succeeds while enough units are left. Call inside a transaction.
+    if not medicine.striped:
+        if Medicine.objects.filter(pk=medicine.pk, striped=False, stock__gte=quantity).update(
+                stock=F('stock') - quantity):
+            transaction.on_commit(lambda: objectcache.invalidate(Medicine, medicine.pk))
+            return
+        # Striping may have been enabled since the medicine was read; the
+        # stripes then hold the stock and the column is only a snapshot.
+        if not Medicine.objects.filter(pk=medicine.pk, striped=True).exists():
+            raise OutOfStock
+    _take_striped(medicine.pk, quantity)
+    transaction.on_commit(lambda: forget_total(medicine.pk))
+    # Sales don't mark the catalogue stale: listings tolerate stock that is
+    # up to CATALOGUE_MAX_AGE old, and add to cart and checkout read the rows.
+
+
+def _locked_total(medicine_id):
+    # Locks the stripe rows before reading them: an aggregate would drop the
+    # FOR UPDATE and let a sale commit between the read and the rewrite.
+    return sum(stripe.quantity for stripe in
+               StockStripe.objects.select_for_update().filter(medicine_id=medicine_id).order_by('stripe'))
+
+
+def set_total(medicine_id, total, stripes=None):
+    with transaction.atomic():
+        existing = list(StockStripe.objects.select_for_update().filter(medicine_id=medicine_id).order_by('stripe'))
+        stripes = stripes or len(existing) or _stripe_count()
+        if len(existing) != stripes:
+            StockStripe.objects.filter(medicine_id=medicine_id).delete()
+            StockStripe.objects.bulk_create([
+                StockStripe(medicine_id=medicine_id, stripe=number, quantity=quantity)
+                for number, quantity in enumerate(_split(total, stripes))
+            ])
+        else:
+            for stripe, quantity in zip(existing, _split(total, stripes)):
+                stripe.quantity = quantity
+            StockStripe.objects.bulk_update(existing, ['quantity'])
+        Medicine.objects.filter(pk=medicine_id).update(stock=total)
+        transaction.on_commit(lambda: forget_total(medicine_id))
+        transaction.on_commit(catalogue.mark_stale)
+
+
+def adjust(medicine_id, delta):
+    if delta >= 0:
+        stripe = StockStripe.objects.filter(medicine_id=medicine_id).order_by('?').first()
+        if stripe is not None:
+            StockStripe.objects.filter(pk=stripe.pk).update(quantity=F('quantity') + delta)
+            transaction.on_commit(lambda: forget_total(medicine_id))
+            transaction.on_commit(catalogue.mark_stale)
+            return
+    with transaction.atomic():
+        set_total(medicine_id, max(_locked_total(medicine_id) + delta, 0))
+
+
+def rebalance(medicine_id, stripes=None):
+    # Evens the stripes out again. Locks only this medicine's stripe rows for
+    # the moment it takes to rewrite them, and refreshes the stock column
+    # snapshot that list filters and reports read.
+    with transaction.atomic():
+        total = _locked_total(medicine_id)
+        set_total(medicine_id, total, stripes)
+    return total
+
+
+def enable_striping(medicine_id, stripes=None):
+    with transaction.atomic():
+        medicine = Medicine.objects.select_for_update().get(pk=medicine_id)
+        if medicine.striped:
+            return rebalance(medicine_id, stripes)
+        total = medicine.__dict__['stock']
+        set_total(medicine_id, total, stripes or _stripe_count())
+        Medicine.objects.filter(pk=medicine_id).update(striped=True)
+        transaction.on_commit(lambda: objectcache.invalidate(Medicine, medicine_id))
+    return total
+
+
+def disable_striping(medicine_id):
+    with transaction.atomic():
+        Medicine.objects.select_for_update().filter(pk=medicine_id).first()
+        total = _locked_total(medicine_id)
+        Medicine.objects.filter(pk=medicine_id).update(stock=total, striped=False)
+        StockStripe.objects.filter(medicine_id=medicine_id).delete()
+        transaction.on_commit(lambda: objectcache.invalidate(Medicine, medicine_id))
+        transaction.on_commit(lambda: forget_total(medicine_id))
+    return total
@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from pharmacy.archive import ARCHIVABLE_STATUSES, archive_orders, purge_stale_carts
+
+
+class Command(BaseCommand):
+    help = 'Moves old delivered/cancelled orders into the archive tables and purges abandoned carts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365,
+                            help='Archive finished orders placed more than this many days ago (default: 365)')
+        parser.add_argument('--cart-days', type=int, default=30,
+                            help='Delete cart rows untouched for this many days (default: 30, 0 to skip)')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--status', action='append', dest='statuses',
+                            help=f'Order status to archive (default: {", ".join(ARCHIVABLE_STATUSES)})')
+
+    def handle(self, *args, **options):
+        statuses = options['statuses'] or ARCHIVABLE_STATUSES
+        orders = items = 0
+        for number, batch in enumerate(archive_orders(timedelta(days=options['days']),
+                                                      options['batch_size'], statuses), 1):
+            orders += batch['orders']
+            items += batch['items']
+            self.stdout.write(f"Batch {number}: archived {batch['orders']} orders, {batch['items']} items")
+        self.stdout.write(self.style.SUCCESS(f'Archived {orders} orders and {items} order items'))
+
+        if options['cart_days']:
+            carts = sum(purge_stale_carts(timedelta(days=options['cart_days']), options['batch_size']))
+            self.stdout.write(self.style.SUCCESS(f'Deleted {carts} stale cart rows'))
@@ -0,0 +1,59 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+
+def measure(client, url, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        timings.append(time.perf_counter() - started)
+    if response.status_code != 200:
+        raise CommandError(f'{url} returned {response.status_code}')
+    timings.sort()
+    return timings[len(timings) // 2], len(queries), len(response.content)
+
+
+class Command(BaseCommand):
+    help = 'Compares the JSON API with the HTML views it replaces for the mobile app (time, queries, bytes)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--username', help='Customer to fetch orders as (default: the one with most orders)')
+
+    def handle(self, *args, **options):
+        if options['username']:
+            user = User.objects.filter(username=options['username']).first()
+        else:
+            user = User.objects.annotate(total=Count('orders')).order_by('-total', 'pk').first()
+        if user is None:
+            raise CommandError('No users found; run seed_data first')
+        client = Client()
+        client.force_login(user)
+
+        pairs = [('/medicines/', '/api/v1/medicines/?embed=category&limit=200')]
+        order = user.orders.order_by('-pk').first()
+        if order:
+            pairs += [
+                ('/orders/', '/api/v1/orders/?embed=items&limit=20'),
+                (f'/orders/{order.pk}/', f'/api/v1/orders/{order.pk}/?embed=items,events'),
+            ]
+        else:
+            self.stdout.write(f'{user.username} has no orders; only the catalogue is compared')
+
+        self.stdout.write(f"{'url':<48} {'median ms':>10} {'queries':>8} {'KiB':>8}")
+        for html_url, api_url in pairs:
+            for url in (html_url, api_url):
+                elapsed, queries, size = measure(client, url, options['repeat'])
+                self.stdout.write(f'{url[:48]:<48} {elapsed * 1000:>10.2f} {queries:>8} {size / 1024:>8.1f}')
+            etag = client.get(api_url)['ETag']
+            revalidate = client.get(api_url, HTTP_IF_NONE_MATCH=etag)
+            self.stdout.write(f"{'  revalidated with If-None-Match':<48} {'':>10} {'':>8} "
+                              f'{len(revalidate.content) / 1024:>8.1f}  ({revalidate.status_code})')
@@ -0,0 +1,75 @@
+import pickle
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from pharmacy import catalogue
+from pharmacy.models import Cart, Medicine
+
+
+def median_ms(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+class Command(BaseCommand):
+    help = 'Compares catalogue pages, filters and cart totals served from the ORM and from the catalogue snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        if catalogue.np is None:
+            raise CommandError('The catalogue snapshot needs numpy: pip install numpy')
+        repeat = options['repeat']
+        medicines = list(Medicine.objects.select_related('category'))
+        if not medicines:
+            raise CommandError('No medicines found; run seed_data first')
+        user = Cart.objects.values_list('user', flat=True).first()
+        user = User.objects.get(pk=user) if user else User.objects.filter(is_staff=True).first()
+        client = Client()
+        if user:
+            client.force_login(user)
+
+        with tempfile.TemporaryDirectory() as directory:
+            published = catalogue.publish(directory)
+            self.stdout.write(f"{len(medicines)} medicines: {len(pickle.dumps(medicines)) / 1024:.1f} KiB pickled "
+                              f"as model instances, snapshot file {published['bytes'] / 1024:.1f} KiB (shared)")
+            snapshot = catalogue.Snapshot(catalogue._path(directory))
+            pks = [medicine.pk for medicine in medicines[:20]]
+            quantities = [2] * len(pks)
+            rows = [
+                ('featured', lambda: list(Medicine.objects.filter(featured=True)[:8]),
+                 lambda: snapshot.select(featured=True, limit=8)),
+                ('low stock', lambda: list(Medicine.objects.filter(stock__lt=10)[:5]),
+                 lambda: snapshot.select(stock_below=10, limit=5)),
+                ('in stock by category', lambda: list(Medicine.objects.filter(
+                    category_id=medicines[0].category_id, stock__gt=0).values_list('pk', flat=True)),
+                 lambda: snapshot.select(category=medicines[0].category_id, in_stock=True)),
+                ('cart total (20 lines)', lambda: sum(medicine.price * 2 for medicine in Medicine.objects.filter(
+                    pk__in=pks)), lambda: snapshot.cart_total(pks, quantities)),
+            ]
+            self.stdout.write(f"{'lookup':<28} {'orm ms':>9} {'snapshot ms':>12}")
+            for label, orm, vectorised in rows:
+                self.stdout.write(f'{label:<28} {median_ms(orm, repeat):>9.3f} {median_ms(vectorised, repeat):>12.3f}')
+
+            self.stdout.write(f"{'page':<28} {'orm ms':>9} {'queries':>8} {'snapshot ms':>12} {'queries':>8}")
+            for url in ('/', '/medicines/', '/cart/'):
+                results = []
+                for directory_setting in ('', directory):
+                    with override_settings(CATALOGUE_DIR=directory_setting):
+                        catalogue._current = None
+                        with CaptureQueriesContext(connection) as queries:
+                            client.get(url)
+                        results += [median_ms(lambda: client.get(url), repeat), len(queries)]
+                self.stdout.write(f'{url:<28} {results[0]:>9.2f} {results[1]:>8} {results[2]:>12.2f} {results[3]:>8}')
+            catalogue._current = None
@@ -0,0 +1,73 @@
+import time
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand, CommandError
+from django.template import engines
+from django.test import Client, RequestFactory
+from pharmacy.management.commands.bench_templates import TEMPLATES, synthetic_context
+from pharmacy.middleware import COMPRESSORS, compress_bytes, compress_chunks
+
+STREAM_CHUNK = 8 * 1024
+
+
+def measure(body, encoding, level, repeat, streaming):
+    best = float('inf')
+    size = 0
+    for _ in range(repeat):
+        started = time.process_time()
+        if streaming:
+            chunks = (body[start:start + STREAM_CHUNK] for start in range(0, len(body), STREAM_CHUNK))
+            size = sum(len(chunk) for chunk in compress_chunks(chunks, encoding, level))
+        else:
+            size = len(compress_bytes(body, encoding, level))
+        best = min(best, time.process_time() - started)
+    return size, best
+
+
+class Command(BaseCommand):
+    help = 'Reports bytes on the wire and CPU cost of response compression for the largest pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000',
+                            help='Comma-separated synthetic catalogue sizes (default: 1000,10000)')
+        parser.add_argument('--levels', default='1,6,9', help='Comma-separated zlib levels (default: 1,6,9)')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--url', action='append', dest='urls', default=[],
+                            help='Also fetch this path from the real database as the first staff user')
+
+    def handle(self, *args, **options):
+        levels = [int(level) for level in options['levels'].split(',')]
+        pages = []
+
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        engine = engines['django']
+        for size in [int(size) for size in options['sizes'].split(',')]:
+            for template_name in TEMPLATES:
+                html = engine.get_template(template_name).render(synthetic_context(template_name, size), request)
+                pages.append((f'{template_name} x{size}', html.encode()))
+
+        if options['urls']:
+            staff = User.objects.filter(is_staff=True).order_by('pk').first()
+            if staff is None:
+                raise CommandError('--url needs a staff user in the database')
+            client = Client()
+            client.force_login(staff)
+            for url in options['urls']:
+                response = client.get(url)
+                body = b''.join(response.streaming_content) if response.streaming else response.content
+                pages.append((url, body))
+
+        self.stdout.write(f"{'page':<42} {'encoding':<8} {'level':>5} {'mode':<9} "
+                          f"{'raw KiB':>9} {'wire KiB':>9} {'ratio':>6} {'cpu ms':>8}")
+        for label, body in pages:
+            for encoding in COMPRESSORS:
+                for level in levels:
+                    for streaming in (False, True):
+                        size, cpu = measure(body, encoding, level, options['repeat'], streaming)
+                        self.stdout.write(
+                            f'{label[:42]:<42} {encoding:<8} {level:>5} '
+                            f'{"streaming" if streaming else "buffered":<9} '
+                            f'{len(body) / 1024:>9.0f} {size / 1024:>9.1f} '
+                            f'{len(body) / max(size, 1):>6.1f} {cpu * 1000:>8.2f}'
+                        )
@@ -0,0 +1,64 @@
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.urls import resolve
+from pharmacy import metrics
+from pharmacy.middleware import MetricsMiddleware
+
+BUDGET_US = 50
+
+
+def per_call_us(func, iterations):
+    best = float('inf')
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        best = min(best, time.perf_counter() - started)
+    return best / iterations * 1e6
+
+
+class Command(BaseCommand):
+    help = 'Measures the per-request cost of MetricsMiddleware with in-process and multiprocess (mmap) storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+        parser.add_argument('--queries', type=int, default=3, help='Database queries run by the fake view')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        queries = options['queries']
+        request = RequestFactory().get('/medicines/12/')
+        request.resolver_match = resolve('/medicines/12/')
+        response = HttpResponse()
+
+        def view(request):
+            with connection.cursor() as cursor:
+                for _ in range(queries):
+                    cursor.execute('SELECT 1')
+            return response
+
+        baseline = per_call_us(lambda: view(request), iterations)
+        self.stdout.write(f'view alone ({queries} queries): {baseline:.2f} us')
+
+        with tempfile.TemporaryDirectory() as directory:
+            for label, metrics_dir in (('in-process', ''), ('mmap files', directory)):
+                with override_settings(METRICS_DIR=metrics_dir):
+                    metrics._forget_store()
+                    middleware = MetricsMiddleware(view)
+                    timed = per_call_us(lambda: middleware(request), iterations)
+                    observe = per_call_us(
+                        lambda: metrics.REQUEST_LATENCY.labels('medicine_detail', 'GET').observe(0.004), iterations)
+                    overhead = timed - baseline
+                    verdict = self.style.SUCCESS('ok') if overhead < BUDGET_US else self.style.ERROR('over budget')
+                    self.stdout.write(f'{label:<11} middleware overhead {overhead:.2f} us/request '
+                                      f'(histogram observe {observe:.2f} us) {verdict}')
+                    started = time.perf_counter()
+                    body = metrics.exposition()
+                    self.stdout.write(f'{label:<11} /metrics render {(time.perf_counter() - started) * 1000:.2f} ms, '
+                                      f'{len(body.splitlines())} lines')
+            metrics._forget_store()
@@ -0,0 +1,97 @@
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from pharmacy import pricing
+from pharmacy.models import Cart, Category, Medicine, Promotion
+
+
+def median_ms(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def rules_per_request(user, now):
+    # What pricing looked like without the compiled table: every request
+    # loads the active rules and tries each one against each cart line.
+    total = Decimal('0')
+    promotions = list(pricing.active_promotions(now))
+    for item in Cart.objects.filter(user=user).select_related('medicine'):
+        medicine = item.medicine
+        price = medicine.price
+        for promotion in promotions:
+            if (promotion.medicine_id == medicine.pk or promotion.category_id == medicine.category_id
+                    or (promotion.manufacturer and promotion.manufacturer.lower() == medicine.manufacturer.lower())):
+                price = min(price, pricing.discounted(medicine.price, promotion))
+        total += price * item.quantity
+    return total
+
+
+class Command(BaseCommand):
+    help = 'Measures cart totals for large carts under many active promotions, per rule, summed in Python and in SQL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--medicines', type=int, default=2000)
+        parser.add_argument('--rules', type=int, default=500)
+        parser.add_argument('--cart-lines', type=int, default=200)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        categories = [Category.objects.create(name=f'bench_pricing {number}') for number in range(10)]
+        user = User.objects.create_user('bench_pricing')
+        try:
+            medicines = Medicine.objects.bulk_create([
+                Medicine(name=f'bench_pricing {number}', description='', category=categories[number % 10],
+                         manufacturer=f'Maker {number % 25}', price=Decimal(100 + number % 900) / 10, stock=100)
+                for number in range(options['medicines'])
+            ], batch_size=1000)
+            now = timezone.now()
+            rules = []
+            for number in range(options['rules']):
+                target = {0: {'category': categories[number % 10]}, 1: {'manufacturer': f'maker {number % 25}'}}.get(
+                    number % 10, {'medicine': medicines[number * 7 % len(medicines)]})
+                rules.append(Promotion(name=f'bench_pricing {number}', kind='percent' if number % 2 else 'fixed',
+                                       value=Decimal(5 + number % 20), starts_at=now, **target))
+            Promotion.objects.bulk_create(rules, batch_size=1000)
+            Cart.objects.bulk_create([Cart(user=user, medicine=medicine, quantity=1 + number % 3)
+                                      for number, medicine in enumerate(medicines[:options['cart_lines']])])
+
+            started = time.perf_counter()
+            compiled = pricing.compile_prices(now)
+            self.stdout.write(f"compiled {compiled['promotions']} rules over {len(medicines)} medicines into "
+                              f"{compiled['discounted']} prices in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+            items = lambda: pricing.cart_items(user, now)
+            methods = [
+                ('rules per request', lambda: rules_per_request(user, now)),
+                ('compiled, Python sum', lambda: sum(item.total_price for item in items())),
+                ('compiled, SQL Sum', lambda: pricing.cart_total(items())),
+            ]
+            totals = set()
+            self.stdout.write(f"{options['cart_lines']}-line cart, {options['rules']} active rules "
+                              f"(median of {options['repeat']}):")
+            for label, func in methods:
+                with CaptureQueriesContext(connection) as captured:
+                    totals.add(func().quantize(pricing.CENT))
+                self.stdout.write(f'  {label:<22} {median_ms(func, options["repeat"]):8.2f} ms  '
+                                  f'{len(captured)} queries')
+            if len(totals) == 1:
+                self.stdout.write(self.style.SUCCESS(f'All methods agree: KES {totals.pop()}'))
+            else:
+                self.stdout.write(self.style.ERROR(f'Totals differ: {sorted(totals)}'))
+        finally:
+            # One transaction, so the recompiles the deletes trigger run after
+            # every bench rule is gone. Medicines take their prices with them.
+            with transaction.atomic():
+                Promotion.objects.filter(name__startswith='bench_pricing').delete()
+                Category.objects.filter(pk__in=[category.pk for category in categories]).delete()
+                user.delete()
@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, connections, transaction
+from pharmacy import inventory
+from pharmacy.models import Category, Medicine
+
+
+class Command(BaseCommand):
+    help = 'Measures checkout stock decrements per second on one medicine under many concurrent buyers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=32)
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument('--stripes', type=int, default=8)
+
+    def buyer(self, medicine, deadline, results, lock):
+        outcomes = Counter()
+        while time.monotonic() < deadline:
+            try:
+                with transaction.atomic():
+                    inventory.take(medicine, 1)
+                outcomes['sold'] += 1
+            except inventory.OutOfStock:
+                outcomes['out_of_stock'] += 1
+            except DatabaseError:
+                outcomes['db_error'] += 1
+        connections.close_all()
+        with lock:
+            results.update(outcomes)
+
+    def run(self, medicine, options):
+        results = Counter()
+        lock = threading.Lock()
+        deadline = time.monotonic() + options['seconds']
+        threads = [threading.Thread(target=self.buyer, args=(medicine, deadline, results, lock))
+                   for _ in range(options['buyers'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, time.perf_counter() - started
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            self.stdout.write(self.style.WARNING(
+                'SQLite allows one writer at a time for the whole database, so stripes cannot help here; '
+                'run this against PostgreSQL or MySQL for meaningful numbers.'))
+        category = Category.objects.create(name='bench_stock')
+        units = 10 ** 9
+        try:
+            for label in ('single row', f'{options["stripes"]} stripes'):
+                medicine = Medicine.objects.create(name=f'bench_stock {label}', description='', category=category,
+                                                   price=1, stock=units)
+                if label != 'single row':
+                    inventory.enable_striping(medicine.pk, options['stripes'])
+                    medicine.refresh_from_db()
+                results, elapsed = self.run(medicine, options)
+                inventory.forget_total(medicine.pk)
+                medicine.refresh_from_db()
+                self.stdout.write(
+                    f"{label:<12} {options['buyers']} buyers: {results['sold'] / elapsed:>9.1f} sales/s  "
+                    + ' '.join(f'{key}={value}' for key, value in sorted(results.items()))
+                    + ('  stock consistent' if units - medicine.stock == results['sold'] else '  STOCK MISMATCH')
+                )
+        finally:
+            category.delete()
@@ -0,0 +1,105 @@
+import time
+import tracemalloc
+from decimal import Decimal
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.template import TemplateDoesNotExist, engines
+from django.test import RequestFactory
+from pharmacy.models import Category, Medicine
+
+TEMPLATES = [
+    'pharmacy/medicine_grid.html',
+    'pharmacy/medicine_list.html',
+    'pharmacy/search_results.html',
+    'pharmacy/admin/medicine_rows.html',
+    'pharmacy/admin/medicines.html',
+]
+DEFAULT_SIZES = '1000,5000,10000,50000'
+
+
+def synthetic_categories(count=12):
+    categories = []
+    for index in range(1, count + 1):
+        category = Category(pk=index, name=f'Category {index}')
+        category.medicine_count = index * 10
+        categories.append(category)
+    return categories
+
+
+def synthetic_medicines(count, categories):
+    medicines = [
+        Medicine(
+            pk=index,
+            name=f'Medicine {index} 500mg',
+            description='Synthetic medicine used for template benchmarks.',
+            category=categories[index % len(categories)],
+            price=Decimal('150.00') + index % 100,
+            stock=index % 25,
+            requires_prescription=index % 7 == 0,
+            featured=index % 11 == 0,
+        )
+        for index in range(1, count + 1)
+    ]
+    # Views annotate the promoted price; every tenth medicine is on offer.
+    for medicine in medicines:
+        medicine.effective_price = medicine.price * Decimal('0.9') if medicine.pk % 10 == 0 else medicine.price
+    return medicines
+
+
+def synthetic_context(template_name, size):
+    categories = synthetic_categories()
+    medicines = synthetic_medicines(size, categories)
+    if template_name == 'pharmacy/medicine_list.html':
+        return {'medicines': medicines, 'categories': categories, 'current_category': None}
+    if template_name == 'pharmacy/search_results.html':
+        return {'medicines': medicines, 'query': 'medicine'}
+    return {'medicines': medicines}
+
+
+class Command(BaseCommand):
+    help = 'Renders the catalogue templates with synthetic context and reports render time and peak allocated memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                            help=f'Comma-separated item counts (default: {DEFAULT_SIZES})')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Timed renders per case; the best one is reported')
+        parser.add_argument('--engine', action='append', dest='engines',
+                            help='Template engine alias to benchmark (default: every configured engine)')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        aliases = options['engines'] or [engine.name for engine in engines.all()]
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+
+        self.stdout.write(f"{'engine':<8} {'template':<34} {'items':>7} {'best ms':>9} "
+                          f"{'us/item':>8} {'peak KiB':>10} {'KiB out':>9}")
+        for alias in aliases:
+            engine = engines[alias]
+            for template_name in TEMPLATES:
+                try:
+                    template = engine.get_template(template_name)
+                except TemplateDoesNotExist:
+                    continue
+                for size in sizes:
+                    context = synthetic_context(template_name, size)
+                    html = template.render(context, request)
+
+                    best = float('inf')
+                    for _ in range(options['repeat']):
+                        started = time.perf_counter()
+                        template.render(context, request)
+                        best = min(best, time.perf_counter() - started)
+
+                    tracemalloc.start()
+                    template.render(context, request)
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+
+                    self.stdout.write(
+                        f'{alias:<8} {template_name:<34} {size:>7} {best * 1000:>9.1f} '
+                        f'{best * 1e6 / size:>8.1f} {peak / 1024:>10.0f} '
+                        f'{len(html) / 1024:>9.0f}'
+                    )
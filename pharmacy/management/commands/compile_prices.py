@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from pharmacy import catalogue, pricing
+
+
+class Command(BaseCommand):
+    help = 'Recompiles the effective price of every promoted medicine and marks the catalogue snapshot stale'
+
+    def handle(self, *args, **options):
+        result = pricing.compile_prices()
+        catalogue.mark_stale()
+        valid_until = result['valid_until'].isoformat() if result['valid_until'] else 'the next promotion change'
+        self.stdout.write(self.style.SUCCESS(
+            f"{result['promotions']} active promotions, {result['discounted']} discounted medicines, "
+            f"valid until {valid_until}"))
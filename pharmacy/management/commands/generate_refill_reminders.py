@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy import refills
+
+
+class Command(BaseCommand):
+    help = 'Suggests refill reminders from how often customers reorder each medicine (incremental, schedule nightly)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Order items read per batch (default: 5000)')
+        parser.add_argument('--rescan', action='store_true',
+                            help='Start again from the first order item instead of the saved watermark')
+
+    def handle(self, *args, **options):
+        if refills.np is None:
+            raise CommandError('generate_refill_reminders needs numpy: pip install numpy')
+        items = created = updated = 0
+        for number, batch in enumerate(refills.generate_refill_reminders(options['batch_size'], options['rescan']), 1):
+            items += batch['items']
+            created += batch['created']
+            updated += batch['updated']
+            self.stdout.write(f"Batch {number}: {batch['items']} order items up to #{batch['position']}, "
+                              f"{batch['created']} reminders created, {batch['updated']} updated")
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {items} order items: {created} reminders suggested, {updated} rescheduled'))
@@ -0,0 +1,76 @@
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import Client
+from pharmacy.admission import admission_stats
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = 'Drives an endpoint past saturation and reports latency percentiles and shed requests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/search/?q=tablet')
+        parser.add_argument('--levels', default='1,4,16,64',
+                            help='Comma-separated numbers of concurrent clients (default: 1,4,16,64)')
+        parser.add_argument('--requests', type=int, default=20, help='Requests per client and level')
+        parser.add_argument('--base-url', default='',
+                            help='Hit a running server (e.g. http://localhost:5000) instead of an in-process client')
+
+    def worker(self, client_number, path, count, base_url):
+        results = []
+        client = None if base_url else Client(REMOTE_ADDR=f'10.{client_number // 65536 % 256}.'
+                                                          f'{client_number // 256 % 256}.{client_number % 256}')
+        for _ in range(count):
+            started = time.perf_counter()
+            if base_url:
+                try:
+                    with urllib.request.urlopen(base_url + path) as response:
+                        response.read()
+                        status = response.status
+                except urllib.error.HTTPError as error:
+                    status = error.code
+            else:
+                status = client.get(path).status_code
+            results.append((status, time.perf_counter() - started))
+        connections.close_all()
+        return results
+
+    def handle(self, *args, **options):
+        base_url = options['base_url'].rstrip('/')
+        self.stdout.write(f"{'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}  statuses")
+        client_number = 0
+        for level in [int(level) for level in options['levels'].split(',')]:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=level) as pool:
+                futures = []
+                for _ in range(level):
+                    client_number += 1
+                    futures.append(pool.submit(self.worker, client_number, options['path'],
+                                               options['requests'], base_url))
+                results = [result for future in futures for result in future.result()]
+            elapsed = time.perf_counter() - started
+
+            latencies = [latency * 1000 for _, latency in results]
+            statuses = Counter(status for status, _ in results)
+            self.stdout.write(
+                f'{level:>7} {len(results) / elapsed:>8.1f} {percentile(latencies, 0.5):>8.1f} '
+                f'{percentile(latencies, 0.99):>8.1f} {max(latencies):>8.1f}  '
+                + ' '.join(f'{status}={count}' for status, count in sorted(statuses.items()))
+            )
+
+        if not base_url:
+            for name, stats in admission_stats().items():
+                self.stdout.write(f'{name}: ' + ', '.join(
+                    f'{key}={value}' for key, value in stats.items() if key != 'limits'))
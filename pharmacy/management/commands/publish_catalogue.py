@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy import catalogue
+
+
+class Command(BaseCommand):
+    help = 'Writes a new version of the memory-mapped catalogue snapshot that workers read instead of the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', help='Where to write the snapshot (default: CATALOGUE_DIR)')
+        parser.add_argument('--if-stale', action='store_true',
+                            help='Only publish if something changed (for cron when not running main.py)')
+
+    def handle(self, *args, **options):
+        if catalogue.np is None:
+            raise CommandError('The catalogue snapshot needs numpy: pip install numpy')
+        directory = options['directory'] or settings.CATALOGUE_DIR
+        if not directory:
+            raise CommandError('Set CATALOGUE_DIR or pass --directory')
+        if options['if_stale']:
+            snapshot = catalogue.publish_if_stale(directory)
+            if snapshot is None:
+                self.stdout.write('Catalogue snapshot is up to date')
+                return
+        else:
+            snapshot = catalogue.publish(directory)
+        self.stdout.write(self.style.SUCCESS(
+            f"Published catalogue v{snapshot['version']}: {snapshot['medicines']} medicines, "
+            f"{snapshot['categories']} categories, {snapshot['bytes'] / 1024:.1f} KiB"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from pharmacy.inventory import disable_striping, enable_striping, rebalance
+from pharmacy.models import Medicine
+
+
+class Command(BaseCommand):
+    help = 'Evens out striped stock counters (run every few minutes) and switches medicines in and out of striped mode'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--enable', type=int, nargs='+', default=[], metavar='ID',
+                            help='Split the stock of these medicines across stripes')
+        parser.add_argument('--disable', type=int, nargs='+', default=[], metavar='ID',
+                            help='Fold the stripes of these medicines back into the stock column')
+        parser.add_argument('--stripes', type=int, help='Number of stripes (default: STOCK_STRIPES setting)')
+
+    def handle(self, *args, **options):
+        for pk in options['enable']:
+            total = enable_striping(pk, options['stripes'])
+            self.stdout.write(f'Medicine {pk}: striped, {total} units')
+        for pk in options['disable']:
+            total = disable_striping(pk)
+            self.stdout.write(f'Medicine {pk}: unstriped, {total} units')
+
+        count = 0
+        for pk in Medicine.objects.filter(striped=True).values_list('pk', flat=True):
+            rebalance(pk, options['stripes'])
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Rebalanced {count} striped medicines'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from pharmacy.analytics import rebuild_customer_stats
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the per-customer analytics summary table from orders and reminders'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding customer stats...')
+        total = rebuild_customer_stats()
+        self.stdout.write(self.style.SUCCESS(f'Refreshed stats for {total} customers'))
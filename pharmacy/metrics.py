@@ -0,0 +1,322 @@
+import fcntl
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Seconds. Tuned for a page that should render well inside 100ms.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+# Counters of workers that have exited, folded together by mark_dead.
+ARCHIVE_FILE = 'metrics_archive.db'
+
+_header = struct.Struct('q')
+_length = struct.Struct('i')
+_double = struct.Struct('d')
+
+_registry = []
+_store = None
+_store_lock = threading.Lock()
+
+
+class _LocalStore:
+    # Used when METRICS_DIR is not set: samples only cover this process.
+    def __init__(self):
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, key, amount):
+        with self._lock:
+            self._values[key] += amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class _FileStore:
+    # One memory-mapped file per process, laid out as a used-bytes header
+    # followed by (key length, key, padding, double) entries. Only the owning
+    # process writes to it; /metrics reads and sums every file in the directory.
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._capacity = max(os.fstat(self._fd).st_size, self.INITIAL_SIZE)
+        os.ftruncate(self._fd, self._capacity)
+        self._map = mmap.mmap(self._fd, self._capacity)
+        self._lock = threading.Lock()
+        self._positions = {}
+        # A recycled pid reuses the file of the worker that died with it, so
+        # its counts are carried on rather than overwritten.
+        self._used = _header.unpack_from(self._map, 0)[0] or _header.size
+        for key, _, position in _entries(self._map, self._used):
+            self._positions[key] = position
+
+    def _allocate(self, key):
+        encoded = key.encode()
+        padded = _length.size + len(encoded)
+        padded += -padded % 8
+        needed = self._used + padded + _double.size
+        if needed > self._capacity:
+            while needed > self._capacity:
+                self._capacity *= 2
+            os.ftruncate(self._fd, self._capacity)
+            self._map.close()
+            self._map = mmap.mmap(self._fd, self._capacity)
+        _length.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + _length.size:self._used + _length.size + len(encoded)] = encoded
+        position = self._used + padded
+        _double.pack_into(self._map, position, 0.0)
+        self._used = needed
+        _header.pack_into(self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def inc(self, key, amount):
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._allocate(key)
+            _double.pack_into(self._map, position, _double.unpack_from(self._map, position)[0] + amount)
+
+    def items(self):
+        with self._lock:
+            return [(key, value) for key, value, _ in _entries(self._map, self._used)]
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+def _entries(buffer, used):
+    position = _header.size
+    while position < used:
+        length = _length.unpack_from(buffer, position)[0]
+        key = bytes(buffer[position + _length.size:position + _length.size + length]).decode()
+        position += _length.size + length
+        position += -position % 8
+        yield key, _double.unpack_from(buffer, position)[0], position
+        position += _double.size
+
+
+def _directory():
+    return getattr(settings, 'METRICS_DIR', '')
+
+
+def _get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                directory = _directory()
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                    _store = _FileStore(os.path.join(directory, f'metrics_{os.getpid()}.db'))
+                else:
+                    _store = _LocalStore()
+    return _store
+
+
+def _forget_store():
+    # A forked worker must never write into its parent's file.
+    global _store
+    _store = None
+
+
+os.register_at_fork(after_in_child=_forget_store)
+
+
+@contextmanager
+def _locked(directory, exclusive=False):
+    # Scrapes read the directory under a shared lock, so they never see a
+    # dead worker's counts both in its own file and in the archive.
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'ab') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as handle:
+            data = handle.read()
+    except OSError:
+        return []
+    if len(data) < _header.size:
+        return []
+    used = min(_header.unpack_from(data, 0)[0], len(data))
+    return [(key, value) for key, value, _ in _entries(data, used)]
+
+
+def mark_dead(pid):
+    # Called by the launcher for every worker it reaps: adds the worker's
+    # counters to the archive file and removes its own, so the directory (and
+    # the cost of a scrape) stays proportional to the live workers.
+    directory = _directory()
+    path = os.path.join(directory, f'metrics_{pid}.db') if directory else ''
+    if not path or not os.path.exists(path):
+        return
+    with _locked(directory, exclusive=True):
+        archive = _FileStore(os.path.join(directory, ARCHIVE_FILE))
+        try:
+            for key, value in _read(path):
+                archive.inc(key, value)
+        finally:
+            archive.close()
+        os.remove(path)
+
+
+def clear_directory():
+    # Called by the launcher on a cold start so counters begin from zero.
+    directory = _directory()
+    for path in glob.glob(os.path.join(directory, 'metrics_*.db')) if directory else []:
+        os.remove(path)
+
+
+class _Child:
+    def __init__(self, metric, labels):
+        self._key = json.dumps([metric.name, labels])
+
+    def inc(self, amount=1):
+        _get_store().inc(self._key, amount)
+
+
+class _HistogramChild:
+    def __init__(self, metric, labels):
+        self._bounds = metric.buckets
+        # Buckets are stored non-cumulatively (one write per observation) and
+        # summed up at exposition time.
+        self._bucket_keys = [json.dumps([metric.name, labels, 'bucket', index])
+                             for index in range(len(metric.buckets) + 1)]
+        self._sum_key = json.dumps([metric.name, labels, 'sum'])
+
+    def observe(self, value):
+        store = _get_store()
+        store.inc(self._bucket_keys[bisect_left(self._bounds, value)], 1)
+        store.inc(self._sum_key, value)
+
+
+class Counter:
+    kind = 'counter'
+    child_class = _Child
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self.child_class(self, [str(value) for value in values])
+        return child
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+    child_class = _HistogramChild
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+REQUEST_LATENCY = Histogram('skypharma_http_request_duration_seconds',
+                            'Time spent producing a response, by URL name.', ['view', 'method'])
+REQUESTS = Counter('skypharma_http_requests_total', 'Responses sent, by URL name and status code.',
+                   ['view', 'method', 'status'])
+DB_LATENCY = Histogram('skypharma_db_duration_seconds', 'Database time per request, by URL name.', ['view'])
+DB_QUERIES = Counter('skypharma_db_queries_total', 'Database queries run, by URL name.', ['view'])
+CACHE_LATENCY = Histogram('skypharma_object_cache_duration_seconds',
+                          'Object cache lookup time (excluding database reloads), by model.', ['model'],
+                          buckets=FAST_BUCKETS)
+CACHE_LOOKUPS = Counter('skypharma_object_cache_lookups_total', 'Object cache lookups, by model and result.',
+                        ['model', 'result'])
+CHECKOUTS = Counter('skypharma_checkouts_total',
+                    'Checkout attempts, by result (placed, empty_cart, out_of_stock, invalid, rejected).',
+                    ['result'])
+CART_ADDITIONS = Counter('skypharma_cart_additions_total', 'Add-to-cart attempts, by result.', ['result'])
+STOCK_REJECTIONS = Counter('skypharma_stock_rejections_total',
+                           'Requests refused because of insufficient stock, by URL name.', ['view'])
+ADMISSIONS = Counter('skypharma_admission_decisions_total',
+                     'Admission control decisions, by limit (search, checkout) and outcome.', ['name', 'outcome'])
+
+
+def collect():
+    totals = defaultdict(float)
+    directory = _directory()
+    if directory:
+        with _locked(directory):
+            for path in glob.glob(os.path.join(directory, 'metrics_*.db')):
+                for key, value in _read(path):
+                    totals[key] += value
+    else:
+        for key, value in _get_store().items():
+            totals[key] += value
+    return totals
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def exposition():
+    samples = defaultdict(dict)
+    for key, value in collect().items():
+        name, labels, *part = json.loads(key)
+        samples[name].setdefault(tuple(labels), {})[tuple(part)] = value
+
+    lines = []
+    for metric in sorted(_registry, key=lambda metric: metric.name):
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for labels, parts in sorted(samples.get(metric.name, {}).items()):
+            if metric.kind == 'counter':
+                lines.append(f'{metric.name}{_format_labels(metric.labelnames, labels)} '
+                             f'{_format_value(parts.get((), 0))}')
+                continue
+            cumulative = 0
+            for index, bound in enumerate(metric.buckets + (float('inf'),)):
+                cumulative += parts.get(('bucket', index), 0)
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                lines.append(f'{metric.name}_bucket{_format_labels(metric.labelnames, labels, le)} '
+                             f'{_format_value(cumulative)}')
+            lines.append(f'{metric.name}_sum{_format_labels(metric.labelnames, labels)} '
+                         f'{_format_value(parts.get(("sum",), 0))}')
+            lines.append(f'{metric.name}_count{_format_labels(metric.labelnames, labels)} '
+                         f'{_format_value(cumulative)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,408 @@
+import json
+import mimetypes
+import os
+import re
+import struct
+import time
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed, SuspiciousFileOperation
+from django.db import connection
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.crypto import get_random_string
+from django.utils.http import http_date
+
+from . import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+STATIC_CACHE_CONTROL = 'public, max-age=300'
+MEDIA_CACHE_CONTROL = 'public, max-age=3600'
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+DEFAULT_COMPRESSION_LEVELS = {
+    'text/html': 6,
+    'text/css': 6,
+    'text/plain': 6,
+    'text/csv': 6,
+    'text/javascript': 6,
+    'application/javascript': 6,
+    'application/json': 6,
+    'application/xml': 6,
+    'image/svg+xml': 6,
+}
+DEFAULT_COMPRESSION_MIN_SIZE = 1024
+# Same default as Django's GZipMiddleware.max_random_bytes.
+DEFAULT_COMPRESSION_RANDOM_BYTES = 100
+# Streaming responses are sync-flushed after this much input so clients start
+# receiving (and parsing) a long listing before the view has finished.
+STREAM_FLUSH_SIZE = 64 * 1024
+# Anything else is counted as OTHER so clients cannot invent new series.
+METRIC_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+
+def accepted_encodings(header):
+    accepted = set()
+    for part in header.split(','):
+        token, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        if token:
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+def parse_range(header, size):
+    match = RANGE_RE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    start, end = match.groups()
+    if start:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    else:
+        start = max(size - int(end), 0)
+        end = size - 1
+    if start > end or start >= size:
+        raise ValueError('Unsatisfiable range')
+    return start, end
+
+
+def read_range(handle, start, length):
+    with handle:
+        handle.seek(start)
+        while length > 0:
+            chunk = handle.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+# Serves collected static files and uploaded media without a separate web
+# server. Fingerprinted names from the collectstatic manifest are cached
+# forever, precompressed .br/.gz siblings are negotiated via Accept-Encoding and
+# single byte ranges are honoured. Full responses use FileResponse so the WSGI
+# server's wsgi.file_wrapper (sendfile) can send them zero-copy.
+class StaticFilesMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'SERVE_STATIC_FILES', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.mounts = [(settings.STATIC_URL, str(settings.STATIC_ROOT), True)]
+        if settings.MEDIA_URL and settings.MEDIA_ROOT:
+            self.mounts.append((settings.MEDIA_URL, str(settings.MEDIA_ROOT), False))
+        self.manifest_path = os.path.join(str(settings.STATIC_ROOT), 'staticfiles.json')
+        self.manifest_mtime = None
+        self.hashed_names = set()
+
+    def __call__(self, request):
+        if request.method in ('GET', 'HEAD'):
+            for prefix, root, is_static in self.mounts:
+                if request.path_info.startswith(prefix):
+                    response = self.serve(request, root, request.path_info[len(prefix):], is_static)
+                    if response is not None:
+                        return response
+        return self.get_response(request)
+
+    def load_manifest(self):
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime
+        except OSError:
+            return
+        if mtime != self.manifest_mtime:
+            with open(self.manifest_path) as manifest:
+                self.hashed_names = set(json.load(manifest).get('paths', {}).values())
+            self.manifest_mtime = mtime
+
+    def cache_control(self, name, is_static):
+        if not is_static:
+            return MEDIA_CACHE_CONTROL
+        self.load_manifest()
+        if name in self.hashed_names:
+            return IMMUTABLE_CACHE_CONTROL
+        return STATIC_CACHE_CONTROL
+
+    def serve(self, request, root, name, is_static):
+        try:
+            path = safe_join(root, name)
+        except (SuspiciousFileOperation, ValueError):
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        content_type, _ = mimetypes.guess_type(path)
+        content_type = content_type or 'application/octet-stream'
+        range_header = request.headers.get('Range', '')
+
+        encoding = None
+        if is_static and not range_header:
+            accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+            for candidate, suffix in ENCODINGS:
+                if candidate in accepted and os.path.isfile(path + suffix):
+                    encoding, path = candidate, path + suffix
+                    break
+
+        stat = os.stat(path)
+        etag = f'"{int(stat.st_mtime):x}-{stat.st_size:x}{"-" + encoding if encoding else ""}"'
+        headers = {
+            'Cache-Control': self.cache_control(name, is_static),
+            'ETag': etag,
+            'Last-Modified': http_date(stat.st_mtime),
+            'Accept-Ranges': 'bytes',
+        }
+        if is_static:
+            headers['Vary'] = 'Accept-Encoding'
+
+        if etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponseNotModified()
+            for header, value in headers.items():
+                response[header] = value
+            return response
+
+        if range_header and request.headers.get('If-Range', etag) == etag:
+            try:
+                byte_range = parse_range(range_header, stat.st_size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{stat.st_size}'
+                return response
+            if byte_range:
+                start, end = byte_range
+                length = end - start + 1
+                if request.method == 'HEAD':
+                    response = HttpResponse(status=206, content_type=content_type)
+                else:
+                    response = StreamingHttpResponse(
+                        read_range(open(path, 'rb'), start, length),
+                        status=206, content_type=content_type,
+                    )
+                response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+                response['Content-Length'] = str(length)
+                for header, value in headers.items():
+                    response[header] = value
+                return response
+
+        if request.method == 'HEAD':
+            response = HttpResponse(content_type=content_type)
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+            del response['Content-Disposition']
+        response['Content-Length'] = str(stat.st_size)
+        if encoding:
+            response['Content-Encoding'] = encoding
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+
+def gzip_header(random_bytes=0):
+    # "Heal The Breach", as in django.utils.text.compress_string: a random
+    # 1..random_bytes long file name in the header makes the compressed
+    # length useless for guessing secrets (BREACH) in pages that also
+    # reflect user input.
+    if not random_bytes:
+        return b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+    filename = get_random_string(1 + int.from_bytes(os.urandom(2), 'big') % random_bytes).encode()
+    return b'\x1f\x8b\x08\x08\x00\x00\x00\x00\x00\xff' + filename + b'\x00'
+
+
+def gzip_compressor(level, random_bytes=0):
+    # Raw deflate between a gzip header and trailer written here, so the
+    # header can carry the random file name.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    header = [gzip_header(random_bytes)]
+    crc = size = 0
+
+    def compress(data):
+        nonlocal crc, size
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        return (header.pop() if header else b'') + compressor.compress(data)
+
+    def flush():
+        return (header.pop() if header else b'') + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish():
+        return ((header.pop() if header else b'') + compressor.flush()
+                + struct.pack('<II', crc, size & 0xffffffff))
+
+    return compress, flush, finish
+
+
+def brotli_compressor(level):
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.flush, compressor.finish
+
+
+def brotli_level(level):
+    # zlib levels run 1-9; brotli qualities 0-11, where 4-5 match gzip -6 for speed.
+    return max(0, min(11, level - 2))
+
+
+def compress_bytes(data, encoding, level, random_bytes=0):
+    compress, _, finish = COMPRESSORS[encoding](level, random_bytes)
+    return compress(data) + finish()
+
+
+def compress_chunks(chunks, encoding, level, random_bytes=0):
+    compress, flush, finish = COMPRESSORS[encoding](level, random_bytes)
+    pending = 0
+    for chunk in chunks:
+        data = compress(chunk)
+        pending += len(chunk)
+        if pending >= STREAM_FLUSH_SIZE:
+            data += flush()
+            pending = 0
+        if data:
+            yield data
+    yield finish()
+
+
+async def compress_chunks_async(chunks, encoding, level, random_bytes=0):
+    compress, flush, finish = COMPRESSORS[encoding](level, random_bytes)
+    pending = 0
+    async for chunk in chunks:
+        data = compress(chunk)
+        pending += len(chunk)
+        if pending >= STREAM_FLUSH_SIZE:
+            data += flush()
+            pending = 0
+        if data:
+            yield data
+    yield finish()
+
+
+COMPRESSORS = {'gzip': gzip_compressor}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda level, random_bytes=0: brotli_compressor(brotli_level(level))
+
+
+# Compresses text responses with brotli (when installed) or gzip. Buffered
+# bodies under COMPRESSION_MIN_SIZE are left alone; StreamingHttpResponse bodies
+# are compressed chunk by chunk. COMPRESSION_LEVELS maps content types to zlib
+# levels (1-9) and any type missing from it is never compressed.
+#
+# gzip output is padded with up to COMPRESSION_RANDOM_BYTES random header bytes
+# against BREACH. Brotli has no header field to pad, so it is only offered
+# when that is set to 0. File responses (static files, which are stored
+# precompressed) are passed through untouched.
+class CompressionMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.levels = getattr(settings, 'COMPRESSION_LEVELS', DEFAULT_COMPRESSION_LEVELS)
+        self.min_size = getattr(settings, 'COMPRESSION_MIN_SIZE', DEFAULT_COMPRESSION_MIN_SIZE)
+        self.random_bytes = getattr(settings, 'COMPRESSION_RANDOM_BYTES', DEFAULT_COMPRESSION_RANDOM_BYTES)
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        return self.process_response(request, response)
+
+    def choose_encoding(self, request):
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+        for encoding in ('gzip',) if self.random_bytes else ('br', 'gzip'):
+            if encoding in accepted and encoding in COMPRESSORS:
+                return encoding
+        return None
+
+    def process_response(self, request, response):
+        if (response.status_code != 200 or response.has_header('Content-Encoding')
+                or isinstance(response, FileResponse)):
+            return response
+        content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+        level = self.levels.get(content_type)
+        if not level:
+            return response
+        if not response.streaming and len(response.content) < self.min_size:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = self.choose_encoding(request)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = compress_chunks_async(
+                    response.streaming_content, encoding, level, self.random_bytes)
+            else:
+                response.streaming_content = compress_chunks(
+                    response.streaming_content, encoding, level, self.random_bytes)
+            del response.headers['Content-Length']
+        else:
+            compressed = compress_bytes(response.content, encoding, level, self.random_bytes)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+class QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.elapsed += time.perf_counter() - started
+            self.count += 1
+
+
+# Records latency, status and database time for every request, labelled by the
+# resolved URL name (so /medicines/12/ and /medicines/13/ share one series).
+# Requests that never reach the URL resolver, such as static files and 404s,
+# are grouped under "unresolved". Set METRICS_ENABLED = False to remove it.
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        started = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unresolved'
+        method = request.method if request.method in METRIC_METHODS else 'OTHER'
+        metrics.REQUEST_LATENCY.labels(view, method).observe(elapsed)
+        metrics.REQUESTS.labels(view, method, response.status_code).inc()
+        if timer.count:
+            metrics.DB_LATENCY.labels(view).observe(timer.elapsed)
+            metrics.DB_QUERIES.labels(view).inc(timer.count)
+        return response
+
+
+# Writes back the anonymous visitor's cookie cart (pharmacy.cookiecart) when a
+# view changed it. Requests that never touch the cart pass straight through.
+class CookieCartMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        cart = getattr(request, 'cookie_cart', None)
+        if cart is not None:
+            cart.save(response)
+        return response
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_customer_stats(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    Order = apps.get_model('pharmacy', 'Order')
+    RefillReminder = apps.get_model('pharmacy', 'RefillReminder')
+    CustomerStats = apps.get_model('pharmacy', 'CustomerStats')
+
+    orders = {
+        row['user']: row
+        for row in Order.objects.order_by().values('user').annotate(
+            order_count=models.Count('id'),
+            lifetime_value=models.Sum('total_amount', filter=~models.Q(status='cancelled')),
+            last_order_at=models.Max('created_at'),
+        )
+    }
+    reminders = dict(
+        RefillReminder.objects.filter(is_active=True).order_by()
+        .values_list('user').annotate(total=models.Count('id'))
+    )
+    CustomerStats.objects.bulk_create([
+        CustomerStats(
+            user_id=user_id,
+            username_key=username.lower(),
+            email_key=email.lower(),
+            order_count=orders.get(user_id, {}).get('order_count', 0),
+            lifetime_value=orders.get(user_id, {}).get('lifetime_value') or 0,
+            last_order_at=orders.get(user_id, {}).get('last_order_at'),
+            active_reminders=reminders.get(user_id, 0),
+        )
+        for user_id, username, email in User.objects.values_list('id', 'username', 'email').iterator()
+    ], batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('pharmacy', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('username_key', models.CharField(db_index=True, max_length=150)),
+                ('email_key', models.CharField(blank=True, db_index=True, max_length=254)),
+                ('order_count', models.PositiveIntegerField(default=0)),
+                ('lifetime_value', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('last_order_at', models.DateTimeField(blank=True, null=True)),
+                ('active_reminders', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Customer stats',
+                'indexes': [models.Index(fields=['order_count', 'user'], name='stats_order_count_idx'), models.Index(fields=['lifetime_value', 'user'], name='stats_lifetime_value_idx'), models.Index(fields=['last_order_at', 'user'], name='stats_last_order_idx'), models.Index(fields=['active_reminders', 'user'], name='stats_reminders_idx')],
+            },
+        ),
+        migrations.RunPython(populate_customer_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:59
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_status_events(apps, schema_editor):
+    # Existing orders only have their current status, so their history starts
+    # with the placement plus, when they have moved on, the latest change.
+    OrderStatusEvent = apps.get_model('pharmacy', 'OrderStatusEvent')
+    events = []
+    for model_name in ('Order', 'ArchivedOrder'):
+        orders = apps.get_model('pharmacy', model_name).objects.values_list('id', 'status', 'created_at', 'updated_at')
+        for order_id, status, created_at, updated_at in orders.iterator():
+            events.append(OrderStatusEvent(order_id=order_id, status='pending', created_at=created_at))
+            if status != 'pending':
+                events.append(OrderStatusEvent(order_id=order_id, status=status, created_at=updated_at))
+            if len(events) >= 5000:
+                OrderStatusEvent.objects.bulk_create(events)
+                events = []
+    OrderStatusEvent.objects.bulk_create(events)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0003_order_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.CreateModel(
+            name='OrderStatusEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('confirmed', 'Confirmed'), ('shipped', 'Shipped'), ('delivered', 'Delivered'), ('cancelled', 'Cancelled')], max_length=20)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('actor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('order', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='status_events', to='pharmacy.order')),
+            ],
+            options={
+                'ordering': ['created_at', 'id'],
+                'indexes': [models.Index(fields=['order', 'created_at'], name='order_event_order_created_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_status_events, migrations.RunPython.noop),
+    ]
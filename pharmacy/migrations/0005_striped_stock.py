@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:04
+
+import django.db.models.deletion
+import pharmacy.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0004_order_status_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medicine',
+            name='striped',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='medicine',
+            name='stock',
+            field=pharmacy.models.StockField(default=0),
+        ),
+        migrations.CreateModel(
+            name='StockStripe',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe', models.PositiveSmallIntegerField()),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('medicine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_stripes', to='pharmacy.medicine')),
+            ],
+            options={
+                'ordering': ['medicine', 'stripe'],
+                'constraints': [models.UniqueConstraint(fields=('medicine', 'stripe'), name='stock_stripe_unique')],
+            },
+        ),
+    ]
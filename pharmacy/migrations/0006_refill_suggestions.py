@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0005_striped_stock'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('position', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='refillreminder',
+            name='interval_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='refillreminder',
+            name='is_automatic',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='refillreminder',
+            name='medicine',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='refill_reminders', to='pharmacy.medicine'),
+        ),
+        migrations.AddIndex(
+            model_name='refillreminder',
+            index=models.Index(fields=['user', 'medicine'], name='reminder_user_medicine_idx'),
+        ),
+    ]
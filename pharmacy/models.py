@@ -1,4 +1,9 @@
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.functions import Lower
+from django.db.models.query_utils import DeferredAttribute
 from django.contrib.auth.models import User
 from django.utils import timezone
 
@@ -17,31 +22,147 @@ class Category(models.Model):
         return self.name
 
 
+class StockAttribute(DeferredAttribute):
+    # Striped medicines keep their units in StockStripe rows and the column is
+    # only a snapshot, so reading medicine.stock returns the (briefly cached)
+    # sum of the stripes instead.
+    def __get__(self, instance, cls=None):
+        value = super().__get__(instance, cls)
+        if instance is not None and instance.__dict__.get('striped'):
+            from .inventory import striped_total
+            return striped_total(instance.pk)
+        return value
+
+    # Defining __set__ makes this a data descriptor, so __get__ runs even
+    # though the raw column value lives in the instance __dict__.
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class StockField(models.PositiveIntegerField):
+    descriptor_class = StockAttribute
+
+    # Forms post back the total they showed, so StockFormMixin can tell what
+    # the user changed from what was sold in the meantime.
+    def formfield(self, **kwargs):
+        kwargs.setdefault('show_hidden_initial', True)
+        return super().formfield(**kwargs)
+
+
 class Medicine(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='medicines')
     price = models.DecimalField(max_digits=10, decimal_places=2)
-    stock = models.PositiveIntegerField(default=0)
+    stock = StockField(default=0)
     image = models.ImageField(upload_to='medicines/', blank=True, null=True)
     requires_prescription = models.BooleanField(default=False)
     dosage = models.CharField(max_length=100, blank=True)
     manufacturer = models.CharField(max_length=200, blank=True)
     featured = models.BooleanField(default=False)
+    # Spread stock over StockStripe rows so concurrent sales of a bestseller
+    # do not queue on this row (see pharmacy.inventory).
+    striped = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['name']
+        indexes = [
+            # Admin search is a lowercase prefix range on this expression.
+            models.Index(Lower('name'), name='medicine_name_lower_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The stock column as read, so saves can tell whether stock was assigned.
+        instance._loaded_stock = instance.__dict__.get('stock')
+        instance._loaded_pricing = instance.pricing_values()
+        return instance
+
+    def pricing_values(self):
+        # What promotions match on; deferred fields read as None.
+        return tuple(self.__dict__.get(name) for name in ('price', 'category_id', 'manufacturer'))
+
     @property
     def in_stock(self):
         return self.stock > 0
 
 
+class StockStripe(models.Model):
+    medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE, related_name='stock_stripes')
+    stripe = models.PositiveSmallIntegerField()
+    quantity = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['medicine', 'stripe']
+        constraints = [
+            models.UniqueConstraint(fields=['medicine', 'stripe'], name='stock_stripe_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.medicine_id} stripe {self.stripe}: {self.quantity}"
+
+
+# A discount rule. It targets one medicine, a whole category or everything
+# from a manufacturer, for an optional time window. pharmacy.pricing compiles
+# the active rules into EffectivePrice rows; the best discount wins.
+class Promotion(models.Model):
+    KIND_CHOICES = [
+        ('percent', 'Percentage off'),
+        ('fixed', 'Fixed amount off'),
+    ]
+
+    name = models.CharField(max_length=200)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default='percent')
+    value = models.DecimalField(max_digits=10, decimal_places=2)
+    medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE, null=True, blank=True, related_name='promotions')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True, related_name='promotions')
+    manufacturer = models.CharField(max_length=200, blank=True)
+    starts_at = models.DateTimeField(default=timezone.now)
+    ends_at = models.DateTimeField(null=True, blank=True)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-starts_at']
+        indexes = [
+            models.Index(fields=['is_active', 'starts_at', 'ends_at'], name='promotion_window_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+    def clean(self):
+        targets = [bool(self.medicine_id), bool(self.category_id), bool(self.manufacturer)]
+        if sum(targets) != 1:
+            raise ValidationError('Choose exactly one of medicine, category or manufacturer.')
+        if self.value is not None and self.value <= 0:
+            raise ValidationError({'value': 'The discount must be positive.'})
+        if self.value is not None and self.kind == 'percent' and self.value > 100:
+            raise ValidationError({'value': 'A percentage must be between 0 and 100.'})
+        if self.ends_at and self.starts_at and self.ends_at <= self.starts_at:
+            raise ValidationError({'ends_at': 'The promotion must end after it starts.'})
+
+
+# Discounted price of a medicine for the window [valid_from, valid_until),
+# written by pharmacy.pricing.compile_prices. Medicines without a row (or
+# whose row has expired) sell at Medicine.price.
+class EffectivePrice(models.Model):
+    medicine = models.OneToOneField(Medicine, on_delete=models.CASCADE, primary_key=True, related_name='offer')
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    promotion = models.ForeignKey(Promotion, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    valid_from = models.DateTimeField()
+    valid_until = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.medicine_id}: {self.price}"
+
+
 class Cart(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='cart_items')
     medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE)
@@ -51,13 +172,23 @@ class Cart(models.Model):
 
     class Meta:
         unique_together = ('user', 'medicine')
+        indexes = [
+            models.Index(fields=['updated_at'], name='cart_updated_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.medicine.name} x {self.quantity}"
 
+    @property
+    def unit_price(self):
+        # Annotated by pharmacy.pricing.with_effective_price; list price otherwise.
+        if hasattr(self, 'effective_price'):
+            return self.effective_price.quantize(Decimal('0.01'))
+        return self.medicine.price
+
     @property
     def total_price(self):
-        return self.medicine.price * self.quantity
+        return self.unit_price * self.quantity
 
 
 class Order(models.Model):
@@ -68,6 +199,14 @@ class Order(models.Model):
         ('delivered', 'Delivered'),
         ('cancelled', 'Cancelled'),
     ]
+    # Legal status changes, enforced by pharmacy.workflow.
+    TRANSITIONS = {
+        'pending': ['confirmed', 'cancelled'],
+        'confirmed': ['shipped', 'cancelled'],
+        'shipped': ['delivered'],
+        'delivered': [],
+        'cancelled': [],
+    }
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='orders')
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
@@ -77,9 +216,16 @@ class Order(models.Model):
     notes = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Bumped by every status change; writers update WHERE version = n.
+    version = models.PositiveIntegerField(default=1)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='order_user_created_idx'),
+            models.Index(fields=['status', 'created_at'], name='order_status_created_idx'),
+            models.Index(fields=['-created_at'], name='order_created_idx'),
+        ]
 
     def __str__(self):
         return f"Order #{self.id} - {self.user.username}"
@@ -95,6 +241,11 @@ class Order(models.Model):
         }
         return status_map.get(self.status, 0)
 
+    @property
+    def next_statuses(self):
+        labels = dict(self.STATUS_CHOICES)
+        return [(status, labels[status]) for status in self.TRANSITIONS.get(self.status, [])]
+
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
@@ -110,6 +261,71 @@ class OrderItem(models.Model):
         return self.price * self.quantity
 
 
+class ArchivedOrder(models.Model):
+    STATUS_CHOICES = Order.STATUS_CHOICES
+
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_orders')
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    shipping_address = models.TextField()
+    phone = models.CharField(max_length=20)
+    notes = models.TextField(blank=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='archived_user_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Archived order #{self.id} - {self.user.username}"
+
+    status_percentage = Order.status_percentage
+
+    @property
+    def is_archived(self):
+        return True
+
+
+# Append-only status history. The order id is kept without a database
+# constraint so the history survives when an order moves to ArchivedOrder
+# (which keeps the same id).
+class OrderStatusEvent(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.DO_NOTHING, db_constraint=False,
+                              related_name='status_events')
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    actor = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [
+            models.Index(fields=['order', 'created_at'], name='order_event_order_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Order #{self.order_id} -> {self.status}"
+
+
+class ArchivedOrderItem(models.Model):
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, related_name='items')
+    medicine = models.ForeignKey(Medicine, on_delete=models.SET_NULL, null=True, blank=True)
+    medicine_name = models.CharField(max_length=200)
+    quantity = models.PositiveIntegerField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+
+    def __str__(self):
+        return f"{self.medicine_name} x {self.quantity}"
+
+    @property
+    def total_price(self):
+        return self.price * self.quantity
+
+
 class RefillReminder(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='refill_reminders')
     medicine_name = models.CharField(max_length=200)
@@ -118,9 +334,17 @@ class RefillReminder(models.Model):
     notes = models.TextField(blank=True)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Set on reminders suggested from purchase history (pharmacy.refills).
+    medicine = models.ForeignKey(Medicine, on_delete=models.SET_NULL, null=True, blank=True,
+                                 related_name='refill_reminders')
+    is_automatic = models.BooleanField(default=False)
+    interval_days = models.PositiveIntegerField(null=True, blank=True)
 
     class Meta:
         ordering = ['reminder_date']
+        indexes = [
+            models.Index(fields=['user', 'medicine'], name='reminder_user_medicine_idx'),
+        ]
 
     def __str__(self):
         return f"{self.medicine_name} - {self.reminder_date}"
@@ -133,3 +357,37 @@ class RefillReminder(models.Model):
     def days_until(self):
         delta = self.reminder_date - timezone.now().date()
         return delta.days
+
+
+# Progress marker for incremental batch jobs, e.g. the highest OrderItem id
+# the refill reminder job has already processed.
+class JobWatermark(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.position}"
+
+
+class CustomerStats(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    username_key = models.CharField(max_length=150, db_index=True)
+    email_key = models.CharField(max_length=254, db_index=True, blank=True)
+    order_count = models.PositiveIntegerField(default=0)
+    lifetime_value = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    last_order_at = models.DateTimeField(null=True, blank=True)
+    active_reminders = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "Customer stats"
+        indexes = [
+            models.Index(fields=['order_count', 'user'], name='stats_order_count_idx'),
+            models.Index(fields=['lifetime_value', 'user'], name='stats_lifetime_value_idx'),
+            models.Index(fields=['last_order_at', 'user'], name='stats_last_order_idx'),
+            models.Index(fields=['active_reminders', 'user'], name='stats_reminders_idx'),
+        ]
+
+    def __str__(self):
+        return f"Stats for {self.username_key}"
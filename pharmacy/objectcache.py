@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import Http404
+
+from . import metrics
+
+# Bump when the pickled shape of cached models changes (e.g. a new field).
+SCHEMA_VERSION = 1
+LOCK_TIMEOUT = 5
+LOCK_WAIT = 0.5
+LOCK_POLL = 0.01
+
+_stats = {'hits': 0, 'misses': 0, 'loads': 0, 'lock_waits': 0}
+_stats_lock = threading.Lock()
+
+
+def _cache():
+    return caches[getattr(settings, 'OBJECT_CACHE', 'default')]
+
+
+def _timeout():
+    return getattr(settings, 'OBJECT_CACHE_TIMEOUT', 300)
+
+
+def _record(**counts):
+    with _stats_lock:
+        for name, value in counts.items():
+            _stats[name] += value
+
+
+def _label(model):
+    return model._meta.label_lower
+
+
+def _generation_key(model):
+    return f'objcache:{_label(model)}:generation'
+
+
+def _generation(model):
+    return _cache().get(_generation_key(model), 0)
+
+
+def _key(model, pk, generation):
+    return f'objcache:{SCHEMA_VERSION}:{_label(model)}:{generation}:{pk}'
+
+
+def _queryset(model):
+    # Medicine pages always show the category, so it is cached alongside.
+    if _label(model) == 'pharmacy.medicine':
+        return model.objects.select_related('category')
+    return model.objects.all()
+
+
+def get(model, pk):
+    cache = _cache()
+    label = _label(model)
+    started = time.perf_counter()
+    key = _key(model, pk, _generation(model))
+    obj = cache.get(key)
+    metrics.CACHE_LATENCY.labels(label).observe(time.perf_counter() - started)
+    if obj is not None:
+        _record(hits=1)
+        metrics.CACHE_LOOKUPS.labels(label, 'hit').inc()
+        return obj
+    _record(misses=1)
+    metrics.CACHE_LOOKUPS.labels(label, 'miss').inc()
+
+    # Single flight: only the worker holding the lock reloads an expired key,
+    # the rest briefly wait for it before falling back to the database.
+    lock_key = f'{key}:lock'
+    if not cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+        _record(lock_waits=1)
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL)
+            obj = cache.get(key)
+            if obj is not None:
+                return obj
+        return _queryset(model).filter(pk=pk).first()
+    try:
+        obj = _queryset(model).filter(pk=pk).first()
+        _record(loads=1)
+        if obj is not None:
+            cache.set(key, obj, timeout=_timeout())
+        return obj
+    finally:
+        cache.delete(lock_key)
+
+
+def get_or_404(model, pk):
+    obj = get(model, pk)
+    if obj is None:
+        raise Http404(f'No {model._meta.object_name} matches the given query.')
+    return obj
+
+
+def get_many(model, pks):
+    cache = _cache()
+    label = _label(model)
+    started = time.perf_counter()
+    generation = _generation(model)
+    keys = {pk: _key(model, pk, generation) for pk in pks}
+    found = cache.get_many(list(keys.values()))
+    metrics.CACHE_LATENCY.labels(label).observe(time.perf_counter() - started)
+    objects = {pk: found[key] for pk, key in keys.items() if key in found}
+    missing = [pk for pk in keys if pk not in objects]
+    _record(hits=len(objects), misses=len(missing))
+    if objects:
+        metrics.CACHE_LOOKUPS.labels(label, 'hit').inc(len(objects))
+    if missing:
+        metrics.CACHE_LOOKUPS.labels(label, 'miss').inc(len(missing))
+    if missing:
+        loaded = _queryset(model).in_bulk(missing)
+        _record(loads=len(loaded))
+        cache.set_many({keys[pk]: obj for pk, obj in loaded.items()}, timeout=_timeout())
+        objects.update(loaded)
+    return objects
+
+
+def invalidate(model, pk):
+    _cache().delete(_key(model, pk, _generation(model)))
+
+
+def invalidate_all(model):
+    # Queryset.update() skips save signals, so bulk writers drop every cached
+    # row of the model at once by moving to a new generation.
+    cache = _cache()
+    key = _generation_key(model)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+
+
+def stats():
+    # This worker only; skypharma_object_cache_lookups_total on /metrics adds
+    # up every worker.
+    with _stats_lock:
+        snapshot = dict(_stats)
+    snapshot['pid'] = os.getpid()
+    lookups = snapshot['hits'] + snapshot['misses']
+    snapshot['hit_ratio'] = round(snapshot['hits'] / lookups, 4) if lookups else None
+    return snapshot
@@ -0,0 +1,105 @@
+from collections import defaultdict
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, FilteredRelation, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Cart, EffectivePrice, Medicine, Promotion
+
+CENT = Decimal('0.01')
+PRICE_FIELD = DecimalField(max_digits=10, decimal_places=2)
+TOTAL_FIELD = DecimalField(max_digits=14, decimal_places=2)
+
+
+def active_promotions(now):
+    return Promotion.objects.filter(Q(ends_at__isnull=True) | Q(ends_at__gt=now),
+                                    is_active=True, starts_at__lte=now)
+
+
+def next_boundary(now):
+    # The compiled table is valid until the next promotion starts or ends.
+    boundaries = [
+        Promotion.objects.filter(is_active=True, starts_at__gt=now).order_by('starts_at')
+        .values_list('starts_at', flat=True).first(),
+        active_promotions(now).filter(ends_at__isnull=False).order_by('ends_at')
+        .values_list('ends_at', flat=True).first(),
+    ]
+    boundaries = [boundary for boundary in boundaries if boundary is not None]
+    return min(boundaries) if boundaries else None
+
+
+def discounted(price, promotion):
+    if promotion.kind == 'percent':
+        price = price * (1 - promotion.value / 100)
+    else:
+        price = price - promotion.value
+    return max(price, Decimal('0')).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def compile_prices(now=None):
+    # Evaluates every active rule once against the medicines it targets and
+    # replaces the EffectivePrice table in one transaction, so readers see
+    # either the old window or the new one.
+    now = now or timezone.now()
+    promotions = list(active_promotions(now))
+    valid_until = next_boundary(now)
+    best = {}
+    if promotions:
+        by_category = defaultdict(list)
+        by_manufacturer = defaultdict(list)
+        by_id = {}
+        for row in Medicine.objects.values_list('pk', 'price', 'category_id', 'manufacturer'):
+            by_id[row[0]] = row
+            by_category[row[2]].append(row)
+            if row[3]:
+                by_manufacturer[row[3].lower()].append(row)
+        for promotion in promotions:
+            if promotion.medicine_id:
+                targets = [by_id[promotion.medicine_id]] if promotion.medicine_id in by_id else []
+            elif promotion.category_id:
+                targets = by_category.get(promotion.category_id, [])
+            else:
+                targets = by_manufacturer.get(promotion.manufacturer.lower(), [])
+            for pk, price, _, _ in targets:
+                candidate = discounted(price, promotion)
+                if candidate < price and (pk not in best or candidate < best[pk][0]):
+                    best[pk] = (candidate, promotion.pk)
+    with transaction.atomic():
+        EffectivePrice.objects.all().delete()
+        EffectivePrice.objects.bulk_create([
+            EffectivePrice(medicine_id=pk, price=price, promotion_id=promotion_id,
+                           valid_from=now, valid_until=valid_until)
+            for pk, (price, promotion_id) in best.items()
+        ], batch_size=1000)
+    return {'promotions': len(promotions), 'discounted': len(best), 'valid_until': valid_until}
+
+
+def with_effective_price(queryset, path='', now=None):
+    # Annotates effective_price: the compiled offer if it covers `now`, else
+    # the list price. `path` leads from the queryset's model to Medicine.
+    now = now or timezone.now()
+    current = Q(**{f'{path}offer__valid_from__lte': now}) & (
+        Q(**{f'{path}offer__valid_until__isnull': True}) | Q(**{f'{path}offer__valid_until__gt': now}))
+    return queryset.annotate(
+        current_offer=FilteredRelation(f'{path}offer', condition=current),
+        effective_price=Coalesce(F('current_offer__price'), F(f'{path}price'), output_field=PRICE_FIELD),
+    )
+
+
+def cart_items(user, now=None):
+    return with_effective_price(Cart.objects.filter(user=user).select_related('medicine'), 'medicine__', now)
+
+
+def cart_total(items):
+    # One aggregate over the annotated cart rows, computed by the database.
+    total = items.aggregate(total=Sum(ExpressionWrapper(F('quantity') * F('effective_price'),
+                                                        output_field=TOTAL_FIELD)))['total']
+    return (total or Decimal('0')).quantize(CENT)
+
+
+def effective_prices(medicine_ids, now=None):
+    return dict(with_effective_price(Medicine.objects.filter(pk__in=medicine_ids), now=now)
+                .values_list('pk', 'effective_price'))
+
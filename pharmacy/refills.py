@@ -0,0 +1,161 @@
+import re
+from datetime import date, timedelta
+
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .analytics import refresh_customer_stats
+from .models import ArchivedOrderItem, JobWatermark, Medicine, OrderItem, RefillReminder
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+WATERMARK = 'refill_reminders'
+LEAD_DAYS = 3
+MIN_INTERVAL_DAYS = 1
+MAX_INTERVAL_DAYS = 365
+MIN_PURCHASES = 2
+MIN_PURCHASES_AS_NEEDED = 3
+AS_NEEDED = re.compile(r'\b(as needed|when needed|if needed|prn)\b', re.IGNORECASE)
+
+
+def as_needed(dosage):
+    return bool(AS_NEEDED.search(dosage or ''))
+
+
+def _history(user_ids, medicine_ids):
+    # One grouped query per table: units bought per customer, medicine and
+    # day. Cancelled orders never reached the customer, so they don't count.
+    rows = []
+    for model in (OrderItem, ArchivedOrderItem):
+        rows += (model.objects.filter(order__user__in=user_ids, medicine__in=medicine_ids)
+                 .exclude(order__status='cancelled').order_by()
+                 .values_list('order__user', 'medicine', TruncDate('order__created_at'))
+                 .annotate(units=Sum('quantity')))
+    return rows
+
+
+def estimate_intervals(users, medicines, days, units, as_needed_ids=()):
+    # All arrays are per purchase (one row per customer, medicine and day;
+    # rows of the same day are summed). Returns one row per customer and
+    # medicine with enough purchases: user, medicine, last purchase day (as an
+    # ordinal), interval in days.
+    #
+    # Units bought on one day last until the next purchase, so each gap is
+    # divided by the units that had to cover it. The median of those per-unit
+    # gaps, weighted by units, ignores the odd early or late refill; times the
+    # units of the last purchase it says when that purchase runs out.
+    if not len(days):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty
+    order = np.lexsort((days, medicines, users))
+    users, medicines, days, units = users[order], medicines[order], days[order], units[order]
+    new_row = np.ones(len(days), dtype=bool)
+    new_row[1:] = (users[1:] != users[:-1]) | (medicines[1:] != medicines[:-1]) | (days[1:] != days[:-1])
+    starts = np.flatnonzero(new_row)
+    users, medicines, days = users[starts], medicines[starts], days[starts]
+    units = np.add.reduceat(units, starts)
+
+    new_pair = np.ones(len(days), dtype=bool)
+    new_pair[1:] = (users[1:] != users[:-1]) | (medicines[1:] != medicines[:-1])
+    pair = np.cumsum(new_pair) - 1
+    purchases = np.bincount(pair)
+    last = np.append(np.flatnonzero(new_pair)[1:], len(days)) - 1
+
+    # Gaps between consecutive purchases of the same pair.
+    same = ~new_pair[1:]
+    gap_pair = pair[:-1][same]
+    weights = units[:-1][same].astype(float)
+    per_unit = (days[1:] - days[:-1])[same] / weights
+
+    order = np.lexsort((per_unit, gap_pair))
+    gap_pair, weights, per_unit = gap_pair[order], weights[order], per_unit[order]
+    cumulative = np.cumsum(weights)
+    totals = np.bincount(gap_pair, weights=weights, minlength=len(purchases))
+    before = np.concatenate(([0.0], np.cumsum(totals)[:-1]))
+    reached = np.flatnonzero(cumulative - before[gap_pair] >= totals[gap_pair] / 2)
+    paired, first = np.unique(gap_pair[reached], return_index=True)
+    median = np.zeros(len(purchases))
+    median[paired] = per_unit[reached[first]]
+
+    intervals = np.clip(np.rint(median * units[last]), MIN_INTERVAL_DAYS, MAX_INTERVAL_DAYS).astype(int)
+    # Taken "as needed" means irregular gaps, so ask for one more purchase.
+    required = np.where(np.isin(medicines[last], as_needed_ids), MIN_PURCHASES_AS_NEEDED, MIN_PURCHASES)
+    keep = purchases >= required
+    return users[last][keep], medicines[last][keep], days[last][keep], intervals[keep]
+
+
+def suggest_reminders(user_ids, medicine_ids, today=None):
+    today = today or timezone.localdate()
+    rows = _history(user_ids, medicine_ids)
+    if not rows:
+        return 0, 0
+    medicines = {pk: (name, dosage) for pk, name, dosage in
+                 Medicine.objects.filter(pk__in=medicine_ids).values_list('pk', 'name', 'dosage')}
+    irregular = [pk for pk, (_, dosage) in medicines.items() if as_needed(dosage)]
+
+    users, medicine_col, days, units = zip(*[(user, medicine, day.toordinal(), quantity)
+                                             for user, medicine, day, quantity in rows])
+    users, medicine_col, last_days, intervals = estimate_intervals(
+        np.array(users), np.array(medicine_col), np.array(days), np.array(units), irregular)
+
+    # Customers who keep their own reminder for a medicine don't get a second one.
+    manual = {(user, name.lower()) for user, name in RefillReminder.objects.filter(
+        user__in=user_ids, is_automatic=False, is_active=True).values_list('user', 'medicine_name')}
+    existing = {(reminder.user_id, reminder.medicine_id): reminder for reminder in RefillReminder.objects.filter(
+        user__in=user_ids, medicine__in=medicine_ids, is_automatic=True)}
+
+    created, updated = [], []
+    for user_id, medicine_id, last_day, interval in zip(
+            users.tolist(), medicine_col.tolist(), last_days.tolist(), intervals.tolist()):
+        name, dosage = medicines[medicine_id]
+        if (user_id, name.lower()) in manual:
+            continue
+        reminder_date = date.fromordinal(last_day + interval) - timedelta(days=LEAD_DAYS)
+        # Long past due: the customer has most likely stopped taking it.
+        if reminder_date < today - timedelta(days=interval):
+            continue
+        reminder = existing.get((user_id, medicine_id))
+        if reminder is None:
+            created.append(RefillReminder(
+                user_id=user_id, medicine_id=medicine_id, medicine_name=name, dosage=dosage,
+                reminder_date=reminder_date, interval_days=interval, is_automatic=True,
+                notes=f'Suggested from your orders: you reorder about every {interval} days.'))
+        elif (reminder.reminder_date, reminder.interval_days) != (reminder_date, interval):
+            reminder.reminder_date = reminder_date
+            reminder.interval_days = interval
+            reminder.notes = f'Suggested from your orders: you reorder about every {interval} days.'
+            updated.append(reminder)
+    RefillReminder.objects.bulk_create(created, batch_size=1000)
+    RefillReminder.objects.bulk_update(updated, ['reminder_date', 'interval_days', 'notes'], batch_size=1000)
+    # bulk_create skips the signals that keep the customer summary current.
+    refresh_customer_stats({reminder.user_id for reminder in created})
+    return len(created), len(updated)
+
+
+def generate_refill_reminders(batch_size=5000, rescan=False):
+    # Walks order items in id order from the last processed id, so a nightly
+    # run only looks at what was ordered since the previous one. Each batch
+    # recomputes the customers and medicines it touches from their full
+    # history and moves the watermark in the same transaction.
+    watermark, _ = JobWatermark.objects.get_or_create(name=WATERMARK)
+    if rescan:
+        watermark.position = 0
+        watermark.save(update_fields=['position', 'updated_at'])
+    while True:
+        with transaction.atomic():
+            watermark = JobWatermark.objects.select_for_update().get(pk=watermark.pk)
+            items = list(OrderItem.objects.filter(pk__gt=watermark.position).order_by('pk')
+                         .values_list('pk', 'order__user', 'medicine')[:batch_size])
+            if not items:
+                return
+            user_ids = sorted({user for _, user, _ in items})
+            medicine_ids = sorted({medicine for _, _, medicine in items})
+            created, updated = suggest_reminders(user_ids, medicine_ids)
+            watermark.position = items[-1][0]
+            watermark.save(update_fields=['position', 'updated_at'])
+        yield {'items': len(items), 'created': created, 'updated': updated, 'position': watermark.position}
@@ -0,0 +1,135 @@
+import threading
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import catalogue, cookiecart, inventory, objectcache, pricing
+from .analytics import refresh_customer_stats
+from .models import Category, Medicine, Order, Promotion, RefillReminder
+
+
+_state = threading.local()
+
+
+@contextmanager
+def stats_refresh_paused():
+    _state.paused = True
+    try:
+        yield
+    finally:
+        _state.paused = False
+
+
+def _refresh_later(user_id):
+    if getattr(_state, 'paused', False):
+        return
+    transaction.on_commit(lambda: refresh_customer_stats([user_id]))
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _refresh_later(instance.pk)
+
+
+@receiver(user_logged_in)
+def merge_cookie_cart(sender, request, user, **kwargs):
+    if request is None:
+        return
+    cart = cookiecart.get(request)
+    if cart.items:
+        cookiecart.merge(user, cart.items)
+        cart.clear()
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+@receiver(post_save, sender=RefillReminder)
+@receiver(post_delete, sender=RefillReminder)
+def customer_activity_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _refresh_later(instance.user_id)
+
+
+@receiver(post_save, sender=Medicine)
+def striped_stock_saved(sender, instance, created=False, raw=False, **kwargs):
+    # Forms (StockFormMixin) leave the change the user made; other saves only
+    # touch the stripes when code assigned medicine.stock since loading it.
+    if not instance.striped or created or raw:
+        return
+    delta = instance.__dict__.pop('_stock_delta', None)
+    if delta is not None:
+        if delta:
+            inventory.adjust(instance.pk, delta)
+    elif instance.__dict__['stock'] != getattr(instance, '_loaded_stock', None):
+        inventory.set_total(instance.pk, instance.__dict__['stock'])
+    instance._loaded_stock = instance.__dict__['stock']
+
+
+def _compile_pending_prices():
+    # The first hook to run after a commit compiles once for everything the
+    # transaction changed; the others find nothing pending.
+    pending = getattr(_state, 'price_changes', None)
+    if pending:
+        pending.clear()
+        pricing.compile_prices()
+
+
+def _compile_prices_later(instance):
+    # Every save queues the (cheap) hook: if the transaction rolls back its
+    # hooks are dropped, and the next one still compiles what is pending.
+    if not hasattr(_state, 'price_changes'):
+        _state.price_changes = set()
+    _state.price_changes.add((instance._meta.label, instance.pk))
+    transaction.on_commit(_compile_pending_prices)
+
+
+@receiver(post_save, sender=Promotion)
+@receiver(post_delete, sender=Promotion)
+def promotion_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _compile_prices_later(instance)
+        transaction.on_commit(catalogue.mark_stale)
+
+
+@receiver(post_save, sender=Medicine)
+def promoted_medicine_changed(sender, instance, created=False, raw=False, **kwargs):
+    # A new list price moves percentage discounts, and a new or moved medicine
+    # may fall under a category or manufacturer promotion. Stock, text and
+    # image edits leave the compiled prices alone.
+    if raw:
+        return
+    values = instance.pricing_values()
+    changed = created or values != getattr(instance, '_loaded_pricing', None)
+    instance._loaded_pricing = values
+    if changed and pricing.active_promotions(timezone.now()).exists():
+        _compile_prices_later(instance)
+
+
+@receiver(post_save, sender=Medicine)
+@receiver(post_delete, sender=Medicine)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def catalogue_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(catalogue.mark_stale)
+
+
+@receiver(post_save, sender=Medicine)
+@receiver(post_delete, sender=Medicine)
+def medicine_changed(sender, instance, **kwargs):
+    objectcache.invalidate(Medicine, instance.pk)
+    transaction.on_commit(lambda: objectcache.invalidate(Medicine, instance.pk))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    objectcache.invalidate(Category, instance.pk)
+    # Cached medicines carry their category along.
+    transaction.on_commit(lambda: objectcache.invalidate_all(Medicine))
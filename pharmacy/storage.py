@@ -0,0 +1,70 @@
+import gzip
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = {
+    '.css', '.js', '.mjs', '.map', '.json', '.svg', '.txt', '.xml', '.html',
+    '.ico', '.ttf', '.otf', '.eot', '.wasm',
+}
+MIN_COMPRESS_SIZE = 256
+# A variant is only kept if it saves at least 5% over the original file.
+MAX_COMPRESSED_RATIO = 0.95
+
+
+def compressed_variants(data):
+    variants = {'gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    return variants
+
+
+# Writes .gz (and .br when the brotli package is installed) siblings next to
+# every fingerprinted file so StaticFilesMiddleware can serve them directly.
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    def stored_name(self, name):
+        # Before build_static has written a manifest (fresh checkouts, the test
+        # runner) fall back to the unhashed names instead of failing every render.
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+    def post_process(self, paths, dry_run=False, **options):
+        names = set()
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if not isinstance(processed, Exception):
+                names.add(name)
+                if hashed_name:
+                    names.add(hashed_name)
+            yield name, hashed_name, processed
+
+        if dry_run:
+            return
+        for name in sorted(names):
+            self.compress(name)
+
+    def compress(self, name):
+        if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+            return []
+        path = self.path(name)
+        with open(path, 'rb') as source:
+            data = source.read()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return []
+
+        written = []
+        for suffix, compressed in compressed_variants(data).items():
+            variant = f'{path}.{suffix}'
+            if len(compressed) > len(data) * MAX_COMPRESSED_RATIO:
+                if os.path.exists(variant):
+                    os.remove(variant)
+                continue
+            with open(variant, 'wb') as target:
+                target.write(compressed)
+            written.append(variant)
+        return written
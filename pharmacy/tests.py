@@ -1,3 +1,442 @@
-from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache, caches
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connection, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import admission, archive, cookiecart, inventory, pricing, refills, workflow
+from .forms import BulkStockForm
+from .models import (ArchivedOrder, Cart, Category, EffectivePrice, Medicine, Order, OrderItem, OrderStatusEvent,
+                     Promotion, StockStripe)
+
+
+class AdminChangelistQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'admin123')
+        cls.category = Category.objects.create(name='Pain Relief')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def add_rows(self, count):
+        start = Medicine.objects.count()
+        # Order search goes through CustomerStats, which signals fill on commit.
+        with self.captureOnCommitCallbacks(execute=True):
+            for number in range(start, start + count):
+                self.add_row(number)
+        return Order.objects.order_by('-pk').first()
+
+    def add_row(self, number):
+        customer = User.objects.create_user(f'customer{number}', f'customer{number}@example.com', 'x')
+        medicine = Medicine.objects.create(name=f'Medicine {number}', description='-', category=self.category,
+                                           price=Decimal('10.00'), stock=number)
+        order = Order.objects.create(user=customer, total_amount=Decimal('10.00'),
+                                     shipping_address='Nairobi', phone='0700000000')
+        OrderItem.objects.create(order=order, medicine=medicine, quantity=1, price=Decimal('10.00'))
+        Cart.objects.create(user=customer, medicine=medicine, quantity=1)
+
+    def queries(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(captured)
+
+    # The query count of a changelist page must not grow with the rows on it.
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        urls = ['/admin/pharmacy/medicine/', '/admin/pharmacy/order/', '/admin/pharmacy/cart/',
+                '/admin/pharmacy/order/?q=customer1', '/admin/pharmacy/medicine/?q=medicine']
+        self.add_rows(3)
+        small = {url: self.queries(url) for url in urls}
+        self.add_rows(20)
+        for url in urls:
+            self.assertEqual(self.queries(url), small[url], url)
+            self.assertLessEqual(small[url], 10, url)
+
+    def test_order_change_page_queries_do_not_grow_with_items(self):
+        order = self.add_rows(1)
+        url = f'/admin/pharmacy/order/{order.pk}/change/'
+        self.queries(url)
+        before = self.queries(url)
+        medicines = [Medicine.objects.create(name=f'Extra {number}', description='-', category=self.category,
+                                             price=Decimal('1.00')) for number in range(10)]
+        OrderItem.objects.bulk_create([OrderItem(order=order, medicine=medicine, quantity=1, price=Decimal('1.00'))
+                                       for medicine in medicines])
+        self.assertEqual(self.queries(url), before)
+
+    def test_prefix_search(self):
+        self.add_rows(12)
+        response = self.client.get('/admin/pharmacy/medicine/', {'q': 'MEDICINE 1'})
+        names = [medicine.name for medicine in response.context['cl'].result_list]
+        self.assertEqual(names, ['Medicine 1', 'Medicine 10', 'Medicine 11'])
+        response = self.client.get('/admin/pharmacy/order/', {'q': 'customer1'})
+        self.assertEqual({order.user.username for order in response.context['cl'].result_list},
+                         {'customer1', 'customer10', 'customer11'})
+        order = Order.objects.first()
+        response = self.client.get('/admin/pharmacy/order/', {'q': str(order.pk)})
+        self.assertIn(order, response.context['cl'].result_list)
+
+
+class PricingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.now = timezone.now()
+        cls.category = Category.objects.create(name='Pain Relief')
+        cls.other = Category.objects.create(name='Vitamins')
+        cls.aspirin = Medicine.objects.create(name='Aspirin', description='-', category=cls.category,
+                                              price=Decimal('100.00'), manufacturer='Acme')
+        cls.ibuprofen = Medicine.objects.create(name='Ibuprofen', description='-', category=cls.category,
+                                                price=Decimal('20.00'))
+        cls.zinc = Medicine.objects.create(name='Zinc', description='-', category=cls.other,
+                                           price=Decimal('19.99'))
+
+    def promote(self, kind, value, starts=-1, ends=None, **target):
+        return Promotion.objects.create(
+            name=f'{kind} {value}', kind=kind, value=Decimal(value), starts_at=self.now + timedelta(hours=starts),
+            ends_at=self.now + timedelta(hours=ends) if ends is not None else None, **target)
+
+    def compiled(self):
+        return {row.medicine_id: (row.price, row.promotion_id) for row in EffectivePrice.objects.all()}
+
+    def test_best_discount_wins(self):
+        self.promote('percent', '10', category=self.category)
+        best = self.promote('fixed', '15', manufacturer='ACME')
+        self.promote('percent', '5', medicine=self.aspirin)
+        result = pricing.compile_prices(self.now)
+        self.assertEqual(result['promotions'], 3)
+        compiled = self.compiled()
+        self.assertEqual(compiled[self.aspirin.pk], (Decimal('85.00'), best.pk))
+        self.assertEqual(compiled[self.ibuprofen.pk][0], Decimal('18.00'))
+        self.assertNotIn(self.zinc.pk, compiled)
+
+    def test_percent_and_fixed(self):
+        self.promote('percent', '12.5', medicine=self.zinc)
+        self.promote('fixed', '50', medicine=self.ibuprofen)
+        pricing.compile_prices(self.now)
+        compiled = self.compiled()
+        self.assertEqual(compiled[self.zinc.pk][0], Decimal('17.49'))
+        # A fixed discount larger than the price makes it free, never negative.
+        self.assertEqual(compiled[self.ibuprofen.pk][0], Decimal('0.00'))
+
+    def test_windows(self):
+        self.promote('percent', '10', medicine=self.aspirin, ends=2)
+        self.promote('percent', '50', medicine=self.aspirin, starts=1)
+        self.promote('percent', '50', medicine=self.ibuprofen, starts=-3, ends=-2)
+        Promotion.objects.filter(pk=self.promote('percent', '50', medicine=self.zinc).pk).update(is_active=False)
+        result = pricing.compile_prices(self.now)
+        self.assertEqual(result['promotions'], 1)
+        self.assertEqual(result['valid_until'], self.now + timedelta(hours=1))
+        self.assertEqual(set(self.compiled()), {self.aspirin.pk})
+        prices = pricing.effective_prices([self.aspirin.pk, self.ibuprofen.pk], self.now)
+        self.assertEqual(prices, {self.aspirin.pk: Decimal('90.00'), self.ibuprofen.pk: Decimal('20.00')})
+        # Past valid_until the compiled row no longer applies.
+        later = pricing.effective_prices([self.aspirin.pk], self.now + timedelta(hours=1))
+        self.assertEqual(later[self.aspirin.pk], Decimal('100.00'))
+
+    def test_saves_compile_once_per_transaction(self):
+        self.promote('percent', '10', category=self.category)
+        with mock.patch.object(pricing, 'compile_prices') as compile_prices:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.aspirin.description = 'Tablets'
+                self.aspirin.save()
+            self.assertEqual(compile_prices.call_count, 0)
+            try:
+                with transaction.atomic():
+                    self.aspirin.price = Decimal('90.00')
+                    self.aspirin.save()
+                    raise DatabaseError
+            except DatabaseError:
+                pass
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ibuprofen.price = Decimal('25.00')
+                self.ibuprofen.save()
+                self.zinc.category = self.category
+                self.zinc.save()
+            self.assertEqual(compile_prices.call_count, 1)
+
+    def test_cart_total(self):
+        customer = User.objects.create_user('customer', 'customer@example.com', 'x')
+        Cart.objects.create(user=customer, medicine=self.aspirin, quantity=3)
+        Cart.objects.create(user=customer, medicine=self.zinc, quantity=2)
+        self.promote('fixed', '15', medicine=self.aspirin)
+        pricing.compile_prices(self.now)
+        items = pricing.cart_items(customer, self.now)
+        self.assertEqual({item.medicine_id: item.effective_price for item in items},
+                         {self.aspirin.pk: Decimal('85.00'), self.zinc.pk: Decimal('19.99')})
+        self.assertEqual(pricing.cart_total(items), Decimal('294.98'))
+        empty = User.objects.create_user('browser', 'browser@example.com', 'x')
+        self.assertEqual(pricing.cart_total(pricing.cart_items(empty, self.now)), Decimal('0.00'))
+
+
+class StockStripingTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Pain Relief')
+        self.medicine = Medicine.objects.create(name='Paracetamol', description='-', category=category,
+                                                price=Decimal('5.00'), stock=50)
+        with self.captureOnCommitCallbacks(execute=True):
+            inventory.enable_striping(self.medicine.pk, stripes=4)
+        self.addCleanup(cache.clear)
+
+    def stripes(self):
+        return list(StockStripe.objects.filter(medicine=self.medicine).order_by('stripe')
+                    .values_list('quantity', flat=True))
+
+    def test_take_and_refund(self):
+        medicine = Medicine.objects.get(pk=self.medicine.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            inventory.take(medicine, 30)
+        self.assertEqual(sum(self.stripes()), 20)
+        self.assertEqual(medicine.stock, 20)
+        with self.assertRaises(inventory.OutOfStock):
+            inventory.take(medicine, 21)
+        self.assertEqual(sum(self.stripes()), 20)
+        with self.captureOnCommitCallbacks(execute=True):
+            inventory.adjust(self.medicine.pk, 5)
+            inventory.adjust(self.medicine.pk, -2)
+        self.assertEqual(sum(self.stripes()), 23)
+        self.assertEqual(Medicine.objects.get(pk=self.medicine.pk).stock, 23)
+
+    def test_take_after_striping_was_enabled(self):
+        # Read before striping: the sale must come out of the stripes, not
+        # the stock column snapshot.
+        stale = Medicine.objects.get(pk=self.medicine.pk)
+        stale.striped = False
+        inventory.take(stale, 10)
+        self.assertEqual(sum(self.stripes()), 40)
+
+    def test_rebalance_conserves_stock(self):
+        StockStripe.objects.filter(medicine=self.medicine, stripe=0).update(quantity=0)
+        StockStripe.objects.filter(medicine=self.medicine, stripe=1).update(quantity=31)
+        total = sum(self.stripes())
+        self.assertEqual(inventory.rebalance(self.medicine.pk), total)
+        self.assertEqual(sum(self.stripes()), total)
+        self.assertLessEqual(max(self.stripes()) - min(self.stripes()), 1)
+        self.assertEqual(inventory.rebalance(self.medicine.pk, stripes=3), total)
+        self.assertEqual(len(self.stripes()), 3)
+        self.assertEqual(inventory.disable_striping(self.medicine.pk), total)
+        self.assertEqual(Medicine.objects.get(pk=self.medicine.pk).stock, total)
+        self.assertEqual(self.stripes(), [])
+
+    def test_name_only_save_keeps_stripes(self):
+        inventory.take(Medicine.objects.get(pk=self.medicine.pk), 7)
+        before = self.stripes()
+        medicine = Medicine.objects.get(pk=self.medicine.pk)
+        medicine.name = 'Paracetamol 500mg'
+        with self.captureOnCommitCallbacks(execute=True):
+            medicine.save()
+        self.assertEqual(self.stripes(), before)
+        self.assertEqual(sum(before), 43)
+
+
+@override_settings(ADMISSION_CONTROL={'search': {'rate': 1, 'burst': 3, 'user_rate': 1, 'user_burst': 2}},
+                   TRUSTED_PROXIES=['127.0.0.1'])
+class AdmissionTests(TestCase):
+    # A whole number of windows, so each test starts at a window boundary.
+    NOW = 6000.0
+
+    def setUp(self):
+        caches['admission'].clear()
+        self.addCleanup(caches['admission'].clear)
+        clock = mock.patch.object(admission.time, 'time', return_value=self.NOW)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def guest(self, address):
+        request = RequestFactory().get('/medicines/', REMOTE_ADDR='127.0.0.1', HTTP_X_FORWARDED_FOR=address)
+        request.user = AnonymousUser()
+        return request
+
+    def test_rate_limit_sliding_window(self):
+        limit = admission.RateLimit('test', rate=2, burst=4)
+        self.assertEqual([limit.take(self.NOW) for _ in range(4)], [0, 0, 0, 0])
+        self.assertGreater(limit.take(self.NOW), 0)
+        # Halfway through the next window half of the previous one still counts.
+        later = self.NOW + limit.window * 1.5
+        self.assertEqual([limit.take(later) for _ in range(2)], [0, 0])
+        self.assertGreater(limit.take(later), 0)
+        self.assertEqual([limit.take(self.NOW + limit.window * 3) for _ in range(4)], [0, 0, 0, 0])
+
+    def test_rejected_requests_are_not_counted(self):
+        limit = admission.RateLimit('test', rate=1, burst=1)
+        limit.take(self.NOW)
+        for _ in range(5):
+            self.assertGreater(limit.take(self.NOW), 0)
+        # One-second windows: the counter of this one holds the single admission.
+        self.assertEqual(caches['admission'].get(f'test:{int(self.NOW)}'), 1)
+
+    def test_guests_behind_proxy_have_their_own_limits(self):
+        admission.admit('search', self.guest('10.0.0.1'))
+        admission.admit('search', self.guest('10.0.0.1'))
+        with self.assertRaises(admission.AdmissionRejected) as rejected:
+            admission.admit('search', self.guest('10.0.0.1'))
+        self.assertEqual(rejected.exception.status, 429)
+        admission.admit('search', self.guest('10.0.0.2'))
+
+    def test_global_rejection_refunds_the_callers_allowance(self):
+        for address in ['10.0.0.1', '10.0.0.2', '10.0.0.3']:
+            admission.admit('search', self.guest(address))
+        with self.assertRaises(admission.AdmissionRejected) as rejected:
+            admission.admit('search', self.guest('10.0.0.4'))
+        self.assertEqual(rejected.exception.status, 503)
+        # 10.0.0.4 still has its whole burst of two.
+        limit = admission.RateLimit(f'{admission.KEY_PREFIX}:search:ip:10.0.0.4', rate=1, burst=2)
+        self.assertEqual([limit.take(), limit.take()], [0, 0])
+        stats = admission.admission_stats()['search']
+        self.assertEqual((stats['admitted'], stats['rejected_global']), (3, 1))
+
+
+class OrderWorkflowTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'admin123')
+        cls.customer = User.objects.create_user('customer', 'customer@example.com', 'x')
+
+    def setUp(self):
+        self.order = Order.objects.create(user=self.customer, total_amount=Decimal('10.00'),
+                                          shipping_address='Nairobi', phone='0700000000')
+
+    def test_legal_transition_bumps_version_and_records_history(self):
+        workflow.transition(self.order, 'confirmed', actor=self.admin)
+        self.assertEqual((self.order.status, self.order.version), ('confirmed', 2))
+        stored = Order.objects.get(pk=self.order.pk)
+        self.assertEqual((stored.status, stored.version), ('confirmed', 2))
+        event = OrderStatusEvent.objects.get(order=self.order)
+        self.assertEqual((event.status, event.actor), ('confirmed', self.admin))
+
+    def test_illegal_transition_raises(self):
+        with self.assertRaises(workflow.IllegalTransition):
+            workflow.transition(self.order, 'delivered')
+        stored = Order.objects.get(pk=self.order.pk)
+        self.assertEqual((stored.status, stored.version), ('pending', 1))
+        self.assertFalse(OrderStatusEvent.objects.filter(order=self.order).exists())
+
+    def test_stale_version_raises(self):
+        # Someone else confirmed the order after this copy was read.
+        stale = Order.objects.get(pk=self.order.pk)
+        workflow.transition(self.order, 'confirmed')
+        with self.assertRaises(workflow.StaleOrder):
+            workflow.transition(stale, 'cancelled')
+        with self.assertRaises(workflow.StaleOrder):
+            workflow.transition(Order.objects.get(pk=self.order.pk), 'shipped', expected_version=1)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, 'confirmed')
+        self.assertEqual(OrderStatusEvent.objects.filter(order=self.order).count(), 1)
+
+
+class CookieCartTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user('customer', 'customer@example.com', 'secret-pass-1')
+        category = Category.objects.create(name='Pain Relief')
+        cls.medicines = [Medicine.objects.create(name=f'Medicine {number}', description='-', category=category,
+                                                 price=Decimal('10.00'), stock=5) for number in range(3)]
+
+    def test_tampered_or_oversized_cookie_reads_as_empty(self):
+        value = cookiecart.encode({self.medicines[0].pk: 2})
+        self.assertEqual(cookiecart.decode(value), {self.medicines[0].pk: 2})
+        self.assertEqual(cookiecart.decode(value.replace('x2', 'x9')), {})
+        self.assertEqual(cookiecart.decode('x' * 5000), {})
+        self.assertEqual(cookiecart.decode(cookiecart._signer().sign('1x2.evil')), {})
+        self.client.cookies['cart'] = value.replace('x2', 'x9')
+        self.assertEqual(self.client.get('/cart/').context['cart_count'], 0)
+
+    @override_settings(CART_COOKIE_MAX_ITEMS=2)
+    def test_quantities_and_items_are_capped(self):
+        payload = '.'.join(f'{pk}x500' for pk in range(1, 6))
+        items = cookiecart.decode(cookiecart._signer().sign(payload))
+        self.assertEqual(items, {1: cookiecart.MAX_QUANTITY, 2: cookiecart.MAX_QUANTITY})
+
+    def test_login_merges_clamped_to_stock_and_deletes_cookie(self):
+        first, second, gone = self.medicines
+        Cart.objects.create(user=self.customer, medicine=first, quantity=4)
+        self.client.cookies['cart'] = cookiecart.encode({first.pk: 3, second.pk: 2, gone.pk: 1})
+        gone.delete()
+        response = self.client.post('/accounts/login/', {'username': 'customer', 'password': 'secret-pass-1'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.cookies['cart'].value, '')
+        self.assertEqual(response.cookies['cart']['max-age'], 0)
+        self.assertEqual(dict(Cart.objects.filter(user=self.customer).values_list('medicine', 'quantity')),
+                         {first.pk: 5, second.pk: 2})
+
+
+@skipUnless(refills.np, 'needs numpy')
+class RefillIntervalTests(SimpleTestCase):
+    def estimate(self, rows, as_needed_ids=()):
+        np = refills.np
+        columns = [np.array(column, dtype=np.int64) for column in zip(*rows)] or [np.zeros(0, dtype=np.int64)] * 4
+        return [column.tolist() for column in refills.estimate_intervals(*columns, as_needed_ids=as_needed_ids)]
+
+    def test_interval_is_units_times_weighted_median_gap(self):
+        # Customer 1: 10 units on day 0, 6 + 4 on day 20, 20 on day 30. The
+        # gaps cost 20 / 10 = 2 and 10 / 10 = 1 days per unit, each weighted by
+        # 10 units; the weighted median is 1, so the last 20 units last 20 days.
+        rows = [(1, 10, 30, 20), (1, 10, 0, 10), (1, 10, 20, 6), (1, 10, 20, 4)]
+        self.assertEqual(self.estimate(rows), [[1], [10], [30], [20]])
+
+    def test_early_refill_does_not_move_the_interval(self):
+        rows = [(1, 10, 0, 30), (1, 10, 30, 30), (1, 10, 60, 30), (1, 10, 65, 30)]
+        self.assertEqual(self.estimate(rows), [[1], [10], [65], [30]])
+
+    def test_single_purchase_and_empty_history(self):
+        self.assertEqual(self.estimate([(2, 10, 7, 5)]), [[], [], [], []])
+        self.assertEqual(self.estimate([]), [[], [], [], []])
+        # "As needed" medicines need a third purchase.
+        rows = [(3, 11, 0, 1), (3, 11, 10, 1)]
+        self.assertEqual(self.estimate(rows, as_needed_ids=[11]), [[], [], [], []])
+        self.assertEqual(self.estimate(rows), [[3], [11], [10], [10]])
+
+
+class CustomerOrdersTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user('customer', 'customer@example.com', 'x')
+        other = User.objects.create_user('other', 'other@example.com', 'x')
+        start = timezone.now() - timedelta(days=400)
+        for number in range(7):
+            status = 'delivered' if number < 4 else 'pending'
+            for user in (cls.customer, other):
+                order = Order.objects.create(user=user, total_amount=Decimal('10.00'), status=status,
+                                             shipping_address='Nairobi', phone='0700000000')
+                Order.objects.filter(pk=order.pk).update(created_at=start + timedelta(days=number * 30))
+        # The four oldest orders of each customer move to the archive.
+        list(archive.archive_orders(timedelta(days=200), batch_size=3))
+        cls.expected = list(Order.objects.filter(user=cls.customer).values_list('pk', flat=True)) + list(
+            ArchivedOrder.objects.filter(user=cls.customer).values_list('pk', flat=True))
+
+    def test_pages_cross_from_live_to_archived_orders(self):
+        self.assertEqual((Order.objects.filter(user=self.customer).count(),
+                          ArchivedOrder.objects.filter(user=self.customer).count()), (3, 4))
+        for per_page in (2, 3, 4, 7):
+            paginator = Paginator(archive.CustomerOrders(self.customer), per_page)
+            self.assertEqual(paginator.count, 7)
+            seen = [order.pk for number in paginator.page_range for order in paginator.page(number)]
+            self.assertEqual(seen, self.expected, per_page)
+
+    def test_api_cursor_crosses_from_live_to_archived_orders(self):
+        self.client.force_login(self.customer)
+        url, seen = '/api/v1/orders/?limit=2&fields=id', []
+        while url:
+            page = self.client.get(url).json()
+            seen += [(row['id'], row['archived']) for row in page['data']]
+            url = page['next']
+        self.assertEqual([pk for pk, _ in seen], sorted(self.expected, reverse=True))
+        self.assertEqual([archived for _, archived in seen], [False] * 3 + [True] * 4)
+
+
+class BulkStockFormTests(SimpleTestCase):
+    def test_missing_lines_reports_one_error(self):
+        form = BulkStockForm({'mode': 'adjust', 'lines': ''})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(list(form.errors), ['lines'])
+        self.assertEqual(len(form.errors['lines']), 1)
+
+    def test_lines_are_parsed(self):
+        form = BulkStockForm({'mode': 'set', 'lines': '12 40'})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertTrue(form.cleaned_data['changes'])
+        self.assertFalse(BulkStockForm({'mode': 'set', 'lines': 'twelve'}).is_valid())
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('', views.home, name='home'),
@@ -29,7 +29,22 @@ urlpatterns = [
     path('dashboard/medicines/add/', views.admin_add_medicine, name='admin_add_medicine'),
     path('dashboard/medicines/edit/<int:pk>/', views.admin_edit_medicine, name='admin_edit_medicine'),
     path('dashboard/medicines/delete/<int:pk>/', views.admin_delete_medicine, name='admin_delete_medicine'),
+    path('dashboard/medicines/bulk/reprice/', views.admin_bulk_reprice, name='admin_bulk_reprice'),
+    path('dashboard/medicines/bulk/stock/', views.admin_bulk_stock, name='admin_bulk_stock'),
     path('dashboard/orders/', views.admin_orders, name='admin_orders'),
     path('dashboard/orders/<int:order_id>/update/', views.admin_update_order, name='admin_update_order'),
+    path('dashboard/orders/bulk/status/', views.admin_bulk_order_status, name='admin_bulk_order_status'),
     path('dashboard/users/', views.admin_users, name='admin_users'),
+    path('dashboard/admission/', views.admin_admission_stats, name='admin_admission_stats'),
+    path('dashboard/cache/', views.admin_cache_stats, name='admin_cache_stats'),
+
+    path('metrics', views.prometheus_metrics, name='metrics'),
+
+    path('api/v1/medicines/', api.medicine_list, name='api_medicine_list'),
+    path('api/v1/medicines/<int:pk>/', api.medicine_detail, name='api_medicine_detail'),
+    path('api/v1/categories/', api.category_list, name='api_category_list'),
+    path('api/v1/categories/<int:pk>/', api.category_detail, name='api_category_detail'),
+    path('api/v1/orders/', api.order_list, name='api_order_list'),
+    path('api/v1/orders/<int:pk>/', api.order_detail, name='api_order_detail'),
+    path('api/v1/reminders/', api.reminder_list, name='api_reminder_list'),
 ]
@@ -1,17 +1,35 @@
+import hmac
+
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User
 from django.contrib import messages
+from django.http import HttpResponse, JsonResponse
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.template import engines
 from django.db.models import Sum, Count, Q
 from django.utils import timezone
-from .models import Category, Medicine, Cart, Order, OrderItem, RefillReminder
-from .forms import UserRegistrationForm, MedicineForm, RefillReminderForm, CheckoutForm
+from django.utils.safestring import mark_safe
+from .models import Category, Medicine, Cart, Order, OrderItem, RefillReminder, ArchivedOrder, OrderStatusEvent
+from .forms import (UserRegistrationForm, MedicineForm, RefillReminderForm, CheckoutForm,
+                    BulkRepriceForm, BulkStockForm, BulkOrderStatusForm)
+from . import analytics, bulk, catalogue, cookiecart, inventory, metrics, objectcache, pricing, workflow
+from .archive import CustomerOrders
+from .clientip import client_ip
+from .admission import AdmissionRejected, admission_control, admission_stats, concurrency_slot, rejected_response
 
 
 def home(request):
-    categories = Category.objects.all()[:6]
-    featured_medicines = Medicine.objects.filter(featured=True)[:8]
+    snapshot = catalogue.current()
+    if snapshot is not None:
+        categories = snapshot.categories()[:6]
+        featured_medicines = snapshot.entries(snapshot.select(featured=True, limit=8))
+    else:
+        categories = Category.objects.all()[:6]
+        featured_medicines = pricing.with_effective_price(
+            Medicine.objects.filter(featured=True).select_related('category'))[:8]
     context = {
         'categories': categories,
         'featured_medicines': featured_medicines,
@@ -33,8 +51,18 @@ def register(request):
 
 
 def medicine_list(request, category_id=None):
-    medicines = Medicine.objects.all()
-    categories = Category.objects.all()
+    snapshot = catalogue.current()
+    # A category newer than the snapshot is looked up in the database below.
+    if snapshot is not None and (not category_id or snapshot.category(category_id)):
+        context = {
+            'medicines': snapshot.entries(snapshot.select(category=category_id)),
+            'categories': snapshot.categories(),
+            'current_category': snapshot.category(category_id) if category_id else None,
+        }
+        return _render_medicine_list(request, context)
+
+    medicines = pricing.with_effective_price(Medicine.objects.select_related('category'))
+    categories = Category.objects.annotate(medicine_count=Count('medicines'))
     current_category = None
     
     if category_id:
@@ -46,24 +74,40 @@ def medicine_list(request, category_id=None):
         'categories': categories,
         'current_category': current_category,
     }
+    return _render_medicine_list(request, context)
+
+
+def _jinja2_fragment(template_name, medicines):
+    # With JINJA2_CATALOGUE the loop over the catalogue is rendered by Jinja2
+    # and dropped into the Django page, so the layout exists once.
+    if not getattr(settings, 'JINJA2_CATALOGUE', False):
+        return None
+    return mark_safe(engines['jinja2'].get_template(template_name).render({'medicines': medicines}))
+
+
+def _render_medicine_list(request, context):
+    context['medicine_grid'] = _jinja2_fragment('pharmacy/medicine_grid.html', context['medicines'])
     return render(request, 'pharmacy/medicine_list.html', context)
 
 
 def medicine_detail(request, pk):
-    medicine = get_object_or_404(Medicine, pk=pk)
-    related_medicines = Medicine.objects.filter(category=medicine.category).exclude(pk=pk)[:4]
+    medicine = objectcache.get_or_404(Medicine, pk)
+    related_medicines = pricing.with_effective_price(
+        Medicine.objects.filter(category_id=medicine.category_id).exclude(pk=pk))[:4]
     context = {
         'medicine': medicine,
+        'effective_price': pricing.effective_prices([medicine.pk]).get(medicine.pk, medicine.price),
         'related_medicines': related_medicines,
     }
     return render(request, 'pharmacy/medicine_detail.html', context)
 
 
+@admission_control('search')
 def search_medicines(request):
     query = request.GET.get('q', '')
-    medicines = Medicine.objects.filter(
+    medicines = pricing.with_effective_price(Medicine.objects.select_related('category').filter(
         Q(name__icontains=query) | Q(description__icontains=query)
-    ) if query else Medicine.objects.none()
+    )) if query else Medicine.objects.none()
     
     context = {
         'medicines': medicines,
@@ -72,10 +116,14 @@ def search_medicines(request):
     return render(request, 'pharmacy/search_results.html', context)
 
 
-@login_required
 def cart_view(request):
-    cart_items = Cart.objects.filter(user=request.user).select_related('medicine')
-    total = sum(item.total_price for item in cart_items)
+    if not request.user.is_authenticated:
+        cart_items, total = cookiecart.get(request).lines()
+        return render(request, 'pharmacy/cart.html', {'cart_items': cart_items, 'total': total})
+    # Effective prices and the total come from the database in two queries,
+    # exactly as checkout will charge them.
+    cart_items = pricing.cart_items(request.user).order_by('pk')
+    total = pricing.cart_total(cart_items)
     context = {
         'cart_items': cart_items,
         'total': total,
@@ -83,34 +131,56 @@ def cart_view(request):
     return render(request, 'pharmacy/cart.html', context)
 
 
-@login_required
 def add_to_cart(request, medicine_id):
-    medicine = get_object_or_404(Medicine, id=medicine_id)
+    # Cached stock is only advisory here; checkout takes it with a conditional update.
+    medicine = objectcache.get_or_404(Medicine, medicine_id)
     
-    cart_item = Cart.objects.filter(user=request.user, medicine=medicine).first()
-    current_cart_qty = cart_item.quantity if cart_item else 0
+    if request.user.is_authenticated:
+        cart_item = Cart.objects.filter(user=request.user, medicine=medicine).first()
+        current_cart_qty = cart_item.quantity if cart_item else 0
+    else:
+        cart = cookiecart.get(request)
+        current_cart_qty = cart.quantity(medicine.pk)
     
     if current_cart_qty + 1 > medicine.stock:
+        metrics.CART_ADDITIONS.labels('out_of_stock').inc()
+        metrics.STOCK_REJECTIONS.labels('add_to_cart').inc()
         messages.error(request, f'Sorry, only {medicine.stock} units of {medicine.name} are available.')
         return redirect(request.META.get('HTTP_REFERER', 'medicine_list'))
     
-    if cart_item:
+    if not request.user.is_authenticated:
+        # Anonymous carts live in a signed cookie until login: no database writes.
+        try:
+            cart.set(medicine.pk, current_cart_qty + 1)
+        except cookiecart.CartFull:
+            messages.error(request, 'Your cart is full. Log in to add more medicines.')
+            return redirect(request.META.get('HTTP_REFERER', 'medicine_list'))
+    elif cart_item:
         cart_item.quantity += 1
         cart_item.save()
     else:
         Cart.objects.create(user=request.user, medicine=medicine, quantity=1)
+    metrics.CART_ADDITIONS.labels('added').inc()
     
     messages.success(request, f'{medicine.name} added to cart!')
     return redirect(request.META.get('HTTP_REFERER', 'medicine_list'))
 
 
-@login_required
 def update_cart(request, item_id):
+    try:
+        quantity = int(request.POST.get('quantity', 1))
+    except (TypeError, ValueError):
+        messages.error(request, 'Please enter a whole number of units.')
+        return redirect('cart')
+    if not request.user.is_authenticated:
+        # Cookie cart lines are keyed by medicine id.
+        return _update_cookie_cart(request, item_id, quantity)
     cart_item = get_object_or_404(Cart, id=item_id, user=request.user)
-    quantity = int(request.POST.get('quantity', 1))
     if quantity > 0:
-        if quantity > cart_item.medicine.stock:
-            messages.error(request, f'Sorry, only {cart_item.medicine.stock} units of {cart_item.medicine.name} are available.')
+        medicine = objectcache.get_or_404(Medicine, cart_item.medicine_id)
+        if quantity > medicine.stock:
+            metrics.STOCK_REJECTIONS.labels('update_cart').inc()
+            messages.error(request, f'Sorry, only {medicine.stock} units of {medicine.name} are available.')
             return redirect('cart')
         cart_item.quantity = quantity
         cart_item.save()
@@ -121,20 +191,50 @@ def update_cart(request, item_id):
     return redirect('cart')
 
 
-@login_required
+def _update_cookie_cart(request, medicine_id, quantity):
+    cart = cookiecart.get(request)
+    if not cart.quantity(medicine_id):
+        return redirect('cart')
+    if quantity > 0:
+        medicine = objectcache.get_or_404(Medicine, medicine_id)
+        if quantity > medicine.stock:
+            metrics.STOCK_REJECTIONS.labels('update_cart').inc()
+            messages.error(request, f'Sorry, only {medicine.stock} units of {medicine.name} are available.')
+            return redirect('cart')
+        cart.set(medicine_id, quantity)
+        messages.success(request, 'Cart updated.')
+    else:
+        cart.remove(medicine_id)
+        messages.success(request, 'Item removed from cart.')
+    return redirect('cart')
+
+
 def remove_from_cart(request, item_id):
+    if not request.user.is_authenticated:
+        return _update_cookie_cart(request, item_id, 0)
     cart_item = get_object_or_404(Cart, id=item_id, user=request.user)
     cart_item.delete()
     messages.success(request, 'Item removed from cart.')
     return redirect('cart')
 
 
+def _count_checkout(request, result):
+    # Only submissions count as attempts; GETs merely display the form.
+    if request.method == 'POST':
+        metrics.CHECKOUTS.labels(result).inc()
+
+
 @login_required
+@admission_control('checkout')
 def checkout(request):
     from django.db import transaction
     
-    cart_items = Cart.objects.filter(user=request.user).select_related('medicine')
+    # One clock for the lines and the total, so they agree even if a
+    # promotion starts or ends mid-request.
+    now = timezone.now()
+    cart_items = pricing.cart_items(request.user, now)
     if not cart_items:
+        _count_checkout(request, 'empty_cart')
         messages.warning(request, 'Your cart is empty.')
         return redirect('cart')
     
@@ -144,20 +244,25 @@ def checkout(request):
             stock_errors.append(f'{item.medicine.name} (requested: {item.quantity}, available: {item.medicine.stock})')
     
     if stock_errors:
+        _count_checkout(request, 'out_of_stock')
+        metrics.STOCK_REJECTIONS.labels('checkout').inc()
         messages.error(request, f'Insufficient stock for: {", ".join(stock_errors)}. Please update your cart.')
         return redirect('cart')
     
-    total = sum(item.total_price for item in cart_items)
+    total = pricing.cart_total(cart_items)
     
     if request.method == 'POST':
         form = CheckoutForm(request.POST)
         if form.is_valid():
             try:
-                with transaction.atomic():
-                    for item in cart_items:
-                        medicine = Medicine.objects.select_for_update().get(pk=item.medicine.pk)
-                        if item.quantity > medicine.stock:
-                            raise ValueError(f'Insufficient stock for {medicine.name}')
+                with concurrency_slot('checkout'), transaction.atomic():
+                    # Same medicine order in every checkout, so concurrent
+                    # buyers never wait on each other's rows in a cycle.
+                    for item in sorted(cart_items, key=lambda item: item.medicine_id):
+                        try:
+                            inventory.take(item.medicine, item.quantity)
+                        except inventory.OutOfStock:
+                            raise ValueError(f'Insufficient stock for {item.medicine.name}')
                     
                     order = Order.objects.create(
                         user=request.user,
@@ -166,25 +271,30 @@ def checkout(request):
                         phone=form.cleaned_data['phone'],
                         notes=form.cleaned_data.get('notes', ''),
                     )
+                    workflow.record_created(order, actor=request.user)
                     
                     for item in cart_items:
-                        medicine = Medicine.objects.select_for_update().get(pk=item.medicine.pk)
                         OrderItem.objects.create(
                             order=order,
-                            medicine=medicine,
+                            medicine=item.medicine,
                             quantity=item.quantity,
-                            price=medicine.price,
+                            price=item.unit_price,
                         )
-                        medicine.stock -= item.quantity
-                        medicine.save()
                     
-                    cart_items.delete()
+                    Cart.objects.filter(pk__in=[item.pk for item in cart_items]).delete()
                 
+                metrics.CHECKOUTS.labels('placed').inc()
                 messages.success(request, 'Order placed successfully!')
                 return redirect('order_confirmation', order_id=order.id)
             except ValueError as e:
+                metrics.CHECKOUTS.labels('out_of_stock').inc()
+                metrics.STOCK_REJECTIONS.labels('checkout').inc()
                 messages.error(request, str(e))
                 return redirect('cart')
+            except AdmissionRejected as rejection:
+                metrics.CHECKOUTS.labels('rejected').inc()
+                return rejected_response(rejection)
+        metrics.CHECKOUTS.labels('invalid').inc()
     else:
         form = CheckoutForm()
     
@@ -204,14 +314,19 @@ def order_confirmation(request, order_id):
 
 @login_required
 def order_list(request):
-    orders = Order.objects.filter(user=request.user)
-    return render(request, 'pharmacy/order_list.html', {'orders': orders})
+    paginator = Paginator(CustomerOrders(request.user), 20)
+    page = paginator.get_page(request.GET.get('page'))
+    return render(request, 'pharmacy/order_list.html', {'orders': page, 'page': page})
 
 
 @login_required
 def order_tracking(request, order_id):
-    order = get_object_or_404(Order, id=order_id, user=request.user)
-    return render(request, 'pharmacy/order_tracking.html', {'order': order})
+    order = Order.objects.filter(id=order_id, user=request.user).first()
+    if order is None:
+        order = get_object_or_404(ArchivedOrder, id=order_id, user=request.user)
+    # Events are keyed by order id, so archived orders keep their timeline.
+    events = OrderStatusEvent.objects.filter(order_id=order.id).order_by('created_at', 'id')
+    return render(request, 'pharmacy/order_tracking.html', {'order': order, 'events': events})
 
 
 @login_required
@@ -256,13 +371,19 @@ def is_admin(user):
 @user_passes_test(is_admin)
 def admin_dashboard(request):
     total_users = User.objects.count()
-    total_orders = Order.objects.count()
+    total_orders = Order.objects.count() + ArchivedOrder.objects.count()
     total_medicines = Medicine.objects.count()
-    total_sales = Order.objects.filter(status='delivered').aggregate(
-        total=Sum('total_amount'))['total'] or 0
+    total_sales = sum(
+        model.objects.filter(status='delivered').aggregate(total=Sum('total_amount'))['total'] or 0
+        for model in (Order, ArchivedOrder)
+    )
     
     recent_orders = Order.objects.all()[:5]
-    low_stock = Medicine.objects.filter(stock__lt=10)[:5]
+    snapshot = catalogue.current()
+    if snapshot is not None:
+        low_stock = snapshot.entries(snapshot.select(stock_below=10, limit=5))
+    else:
+        low_stock = Medicine.objects.filter(stock__lt=10)[:5]
     
     context = {
         'total_users': total_users,
@@ -278,8 +399,11 @@ def admin_dashboard(request):
 @login_required
 @user_passes_test(is_admin)
 def admin_medicines(request):
-    medicines = Medicine.objects.all()
-    return render(request, 'pharmacy/admin/medicines.html', {'medicines': medicines})
+    medicines = Medicine.objects.select_related('category')
+    return render(request, 'pharmacy/admin/medicines.html', {
+        'medicines': medicines,
+        'medicine_rows': _jinja2_fragment('pharmacy/admin/medicine_rows.html', medicines),
+    })
 
 
 @login_required
@@ -322,6 +446,45 @@ def admin_delete_medicine(request, pk):
     return render(request, 'pharmacy/admin/medicine_confirm_delete.html', {'medicine': medicine})
 
 
+@login_required
+@user_passes_test(is_admin)
+def admin_bulk_reprice(request):
+    preview = None
+    if request.method == 'POST':
+        form = BulkRepriceForm(request.POST)
+        if form.is_valid():
+            medicines = bulk.medicines_for_reprice(form.cleaned_data['category'],
+                                                   form.cleaned_data['manufacturer'])
+            percentage = form.cleaned_data['percentage']
+            if 'confirm' in request.POST:
+                batches = bulk.apply_reprice(medicines, percentage)
+                messages.success(request, f'Repricing done: {bulk.summarize(batches, "medicines")}.')
+                return redirect('admin_medicines')
+            preview = bulk.preview_reprice(medicines, percentage)
+    else:
+        form = BulkRepriceForm()
+    return render(request, 'pharmacy/admin/bulk_reprice.html', {'form': form, 'preview': preview})
+
+
+@login_required
+@user_passes_test(is_admin)
+def admin_bulk_stock(request):
+    preview = None
+    if request.method == 'POST':
+        form = BulkStockForm(request.POST)
+        if form.is_valid():
+            changes = form.cleaned_data['changes']
+            mode = form.cleaned_data['mode']
+            if 'confirm' in request.POST:
+                batches = bulk.apply_stock_changes(changes, mode)
+                messages.success(request, f'Stock update done: {bulk.summarize(batches, "medicines")}.')
+                return redirect('admin_medicines')
+            preview = bulk.preview_stock_changes(changes, mode)
+    else:
+        form = BulkStockForm()
+    return render(request, 'pharmacy/admin/bulk_stock.html', {'form': form, 'preview': preview})
+
+
 @login_required
 @user_passes_test(is_admin)
 def admin_orders(request):
@@ -335,15 +498,75 @@ def admin_update_order(request, order_id):
     order = get_object_or_404(Order, id=order_id)
     if request.method == 'POST':
         new_status = request.POST.get('status')
+        try:
+            version = int(request.POST.get('version', order.version))
+        except ValueError:
+            version = order.version
         if new_status in dict(Order.STATUS_CHOICES):
-            order.status = new_status
-            order.save()
-            messages.success(request, f'Order #{order.id} status updated to {order.get_status_display()}')
+            try:
+                workflow.transition(order, new_status, actor=request.user, expected_version=version)
+            except workflow.TransitionError as error:
+                messages.error(request, str(error))
+            else:
+                messages.success(request, f'Order #{order.id} status updated to {order.get_status_display()}')
     return redirect('admin_orders')
 
 
+@login_required
+@user_passes_test(is_admin)
+def admin_bulk_order_status(request):
+    preview = None
+    if request.method == 'POST':
+        form = BulkOrderStatusForm(request.POST)
+        if form.is_valid():
+            orders = bulk.orders_for_status_change(form.cleaned_data['order_ids'],
+                                                   form.cleaned_data['from_status'])
+            new_status = form.cleaned_data['status']
+            if 'confirm' in request.POST:
+                batches = bulk.apply_order_status(orders, new_status, actor=request.user)
+                messages.success(request, f'Status update done: {bulk.summarize(batches, "orders")}.')
+                return redirect('admin_orders')
+            preview = bulk.preview_order_status(orders, new_status)
+    else:
+        form = BulkOrderStatusForm()
+    return render(request, 'pharmacy/admin/bulk_order_status.html', {'form': form, 'preview': preview})
+
+
+@login_required
+@user_passes_test(is_admin)
+def admin_admission_stats(request):
+    return JsonResponse(admission_stats())
+
+
+@login_required
+@user_passes_test(is_admin)
+def admin_cache_stats(request):
+    return JsonResponse(objectcache.stats())
+
+
+def _metrics_allowed(request):
+    # Nothing is trusted by default: behind a local proxy every request
+    # arrives from 127.0.0.1, so loopback alone proves nothing.
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    if client_ip(request) in settings.METRICS_ALLOWED_IPS:
+        return True
+    return request.user.is_authenticated and request.user.is_staff
+
+
+def prometheus_metrics(request):
+    if not _metrics_allowed(request):
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    return HttpResponse(metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @login_required
 @user_passes_test(is_admin)
 def admin_users(request):
-    users = User.objects.all()
-    return render(request, 'pharmacy/admin/users.html', {'users': users})
+    page = analytics.customer_page(
+        sort=request.GET.get('sort'),
+        query=request.GET.get('q', ''),
+        cursor=request.GET.get('after'),
+    )
+    return render(request, 'pharmacy/admin/users.html', page)
@@ -0,0 +1,83 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from .analytics import refresh_customer_stats
+from .models import Order, OrderStatusEvent
+
+BATCH_SIZE = 500
+
+
+class TransitionError(Exception):
+    pass
+
+
+class IllegalTransition(TransitionError):
+    pass
+
+
+class StaleOrder(TransitionError):
+    pass
+
+
+def can_transition(from_status, to_status):
+    return to_status in Order.TRANSITIONS.get(from_status, [])
+
+
+def source_statuses(to_status):
+    return [status for status, targets in Order.TRANSITIONS.items() if to_status in targets]
+
+
+def record_created(order, actor=None):
+    OrderStatusEvent.objects.create(order=order, status=order.status, actor=actor, created_at=order.created_at)
+
+
+def transition(order, new_status, actor=None, expected_version=None):
+    # Optimistic concurrency: the UPDATE only matches if nobody changed the
+    # order since it was read, so no row lock is held while the admin decides.
+    if not can_transition(order.status, new_status):
+        raise IllegalTransition(
+            f'Order #{order.pk} cannot go from {order.get_status_display()} to '
+            f'{dict(Order.STATUS_CHOICES).get(new_status, new_status)}.')
+    version = order.version if expected_version is None else expected_version
+    now = timezone.now()
+    with transaction.atomic():
+        updated = Order.objects.filter(pk=order.pk, version=version, status=order.status).update(
+            status=new_status, version=F('version') + 1, updated_at=now)
+        if not updated:
+            raise StaleOrder(f'Order #{order.pk} was changed by someone else. Reload and try again.')
+        OrderStatusEvent.objects.create(order_id=order.pk, status=new_status, actor=actor, created_at=now)
+        transaction.on_commit(lambda: refresh_customer_stats([order.user_id]))
+    order.status = new_status
+    order.version = version + 1
+    order.updated_at = now
+    return order
+
+
+def bulk_transition(orders, new_status, actor=None):
+    # One conditional UPDATE per batch: each row must still have the version
+    # and a legal source status seen when the batch was read. Rows changed in
+    # between are left alone and reported as skipped.
+    sources = source_statuses(new_status)
+    batches = []
+    now = timezone.now()
+    with transaction.atomic():
+        snapshot = list(orders.filter(status__in=sources).order_by('pk').values_list('pk', 'version'))
+        for number, start in enumerate(range(0, len(snapshot), BATCH_SIZE), 1):
+            chunk = dict(snapshot[start:start + BATCH_SIZE])
+            expected = Case(*[When(pk=pk, then=Value(version)) for pk, version in chunk.items()],
+                            output_field=IntegerField())
+            updated = Order.objects.filter(pk__in=chunk, status__in=sources, version=expected).update(
+                status=new_status, version=F('version') + 1, updated_at=now)
+            if updated == len(chunk):
+                moved = list(chunk)
+            else:
+                moved = [pk for pk, version in Order.objects.filter(pk__in=chunk, status=new_status, updated_at=now)
+                         .values_list('pk', 'version') if version == chunk[pk] + 1]
+            OrderStatusEvent.objects.bulk_create([
+                OrderStatusEvent(order_id=pk, status=new_status, actor=actor, created_at=now) for pk in moved
+            ])
+            batches.append({'batch': number, 'matched': len(chunk), 'updated': updated})
+            user_ids = Order.objects.filter(pk__in=moved).order_by().values_list('user', flat=True).distinct()
+            refresh_customer_stats(user_ids)
+    return batches
@@ -20,34 +20,68 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'pharmacy.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'pharmacy.middleware.CompressionMiddleware',
+    'pharmacy.middleware.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'pharmacy.middleware.CookieCartMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
 ROOT_URLCONF = 'skypharma_project.urls'
 
+# Template performance mode. Compiled templates are cached per process unless
+# TEMPLATE_RELOAD is on (the default while DEBUG), and JINJA2_CATALOGUE=1 renders
+# the medicine grid, the part of the catalogue listing that grows with the
+# catalogue, with Jinja2 into the shared Django layout.
+TEMPLATE_RELOAD = os.environ.get('TEMPLATE_RELOAD', '1' if DEBUG else '0') == '1'
+JINJA2_CATALOGUE = os.environ.get('JINJA2_CATALOGUE', '0') == '1'
+
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+if not TEMPLATE_RELOAD:
+    TEMPLATE_LOADERS = [('django.template.loaders.cached.Loader', TEMPLATE_LOADERS)]
+
+TEMPLATE_CONTEXT_PROCESSORS = [
+    'django.template.context_processors.debug',
+    'django.template.context_processors.request',
+    'django.contrib.auth.context_processors.auth',
+    'django.contrib.messages.context_processors.messages',
+    'pharmacy.context_processors.cart_count',
+]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
-            'context_processors': [
-                'django.template.context_processors.debug',
-                'django.template.context_processors.request',
-                'django.contrib.auth.context_processors.auth',
-                'django.contrib.messages.context_processors.messages',
-                'pharmacy.context_processors.cart_count',
-            ],
+            'loaders': TEMPLATE_LOADERS,
+            'context_processors': TEMPLATE_CONTEXT_PROCESSORS,
         },
     },
 ]
 
+if JINJA2_CATALOGUE:
+    # Appended, so whole pages always come from templates/; views ask this
+    # engine for fragments by name.
+    TEMPLATES.append({
+        'NAME': 'jinja2',
+        'BACKEND': 'django.template.backends.jinja2.Jinja2',
+        'DIRS': [BASE_DIR / 'jinja2'],
+        'APP_DIRS': False,
+        'OPTIONS': {
+            'environment': 'pharmacy.jinja2.environment',
+            'auto_reload': TEMPLATE_RELOAD,
+        },
+    })
+
 WSGI_APPLICATION = 'skypharma_project.wsgi.application'
 
 DATABASES = {
@@ -57,6 +91,93 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    # Also the object cache: under main.py every worker must see the others'
+    # invalidations, so set REDIS_URL when running several workers.
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_URL'],
+    } if os.environ.get('REDIS_URL') else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Admission control windows and counters. They must be shared by every
+    # worker and updated atomically, so set REDIS_URL when running several
+    # workers; `manage.py check` warns while this is per process.
+    'admission': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_URL'],
+    } if os.environ.get('REDIS_URL') else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'admission',
+    },
+}
+
+# Read-through cache for Medicine and Category lookups by pk (pharmacy.objectcache).
+# main.py sets SKYPHARMA_WORKERS and logs system check warnings at startup:
+# with more than one worker, a per-process object cache is reported.
+OBJECT_CACHE = 'default'
+PREFORK_WORKERS = int(os.environ.get('SKYPHARMA_WORKERS', 1))
+OBJECT_CACHE_TIMEOUT = 300
+
+# Striped inventory (pharmacy.inventory): medicines switched to striped mode
+# with `manage.py rebalance_stock --enable` keep their stock in this many rows.
+# Their summed total is cached for STOCK_TOTAL_TIMEOUT seconds.
+STOCK_STRIPES = 8
+STOCK_TOTAL_TIMEOUT = 2
+
+# Rate limits (requests per second with a burst allowance) for the costly
+# endpoints. Per-user rejections return 429, global ones and a full checkout
+# concurrency limit return 503, always with Retry-After.
+ADMISSION_CACHE = 'admission'
+ADMISSION_CONTROL = {
+    'search': {
+        'rate': 50, 'burst': 100,
+        'user_rate': 2, 'user_burst': 10,
+    },
+    'checkout': {
+        'methods': ['POST'],
+        'rate': 20, 'burst': 40,
+        'user_rate': 0.2, 'user_burst': 3,
+        'concurrency': 4, 'retry_after': 2,
+    },
+}
+
+# Prometheus metrics served at /metrics (pharmacy.metrics). With METRICS_DIR set,
+# every process writes its samples to a memory-mapped file there and /metrics
+# sums them, so all workers of main.py are reported together; without it each
+# process only reports its own. Scrapes are allowed with
+# "Authorization: Bearer <METRICS_TOKEN>", from METRICS_ALLOWED_IPS and from
+# logged-in staff; by default only staff.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = [ip for ip in os.environ.get('METRICS_ALLOWED_IPS', '').split(',') if ip]
+
+# Reverse proxies (such as a local nginx in front of main.py) whose
+# X-Forwarded-For header names the real client, for the metrics allowlist and
+# per-client rate limits. Empty: REMOTE_ADDR is the client.
+TRUSTED_PROXIES = [ip for ip in os.environ.get('TRUSTED_PROXIES', '').split(',') if ip]
+
+# Catalogue snapshot (pharmacy.catalogue): medicine and category data as
+# fixed-width arrays in one memory-mapped file that every worker shares, used
+# by the catalogue pages, the cart and the low-stock list instead of queries.
+# Empty disables it. Saves mark it stale and one publisher (the main.py
+# arbiter, or `publish_catalogue --if-stale` from cron) rebuilds it at most
+# every CATALOGUE_PUBLISH_DELAY seconds, and at least every CATALOGUE_MAX_AGE
+# so stock levels catch up with sales. Workers look for a new version every
+# CATALOGUE_CHECK_INTERVAL seconds.
+CATALOGUE_DIR = os.environ.get('CATALOGUE_DIR', '')
+CATALOGUE_PUBLISH_DELAY = 2
+CATALOGUE_MAX_AGE = 60
+CATALOGUE_CHECK_INTERVAL = 1
+
+# Anonymous visitors keep their cart in a signed cookie (pharmacy.cookiecart)
+# of at most CART_COOKIE_MAX_ITEMS medicines; it is merged into their Cart
+# rows when they log in.
+CART_COOKIE_NAME = 'cart'
+CART_COOKIE_MAX_ITEMS = 30
+CART_COOKIE_MAX_AGE = 30 * 24 * 3600
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -71,10 +192,39 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']
+STATIC_ROOT = BASE_DIR / 'staticfiles'
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'pharmacy.storage.CompressedManifestStaticFilesStorage',
+    },
+}
+
+# Serve STATIC_ROOT and MEDIA_ROOT from pharmacy.middleware.StaticFilesMiddleware.
+# In DEBUG the development static() routes in skypharma_project/urls.py are used.
+SERVE_STATIC_FILES = not DEBUG
+
+# Response compression (pharmacy.middleware.CompressionMiddleware): zlib level
+# per content type; types not listed here are sent uncompressed.
+COMPRESSION_MIN_SIZE = 1024
+# Random gzip header padding against BREACH; 0 turns it off and allows brotli.
+COMPRESSION_RANDOM_BYTES = 100
+COMPRESSION_LEVELS = {
+    'text/html': 6,
+    'text/css': 6,
+    'text/plain': 6,
+    'text/javascript': 6,
+    'application/javascript': 6,
+    'application/json': 5,
+    'image/svg+xml': 6,
+}
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LOGIN_REDIRECT_URL = '/'